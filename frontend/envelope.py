@@ -11,8 +11,9 @@ from pysynth.params import blocksize
 
 class EnvelopeGUI(tk.Frame):
 
-    def __init__(self, master, oscillator, **kwargs):
+    def __init__(self, master, output, oscillator, **kwargs):
         super().__init__(master=master, **kwargs)
+        self.output = output
         self.oscillator = oscillator
         self.get_envelope_values()
         self.amplitude = 0.0
@@ -181,38 +182,38 @@ class EnvelopeGUI(tk.Frame):
     def change_attack_time(self, *args):
         attack_time = self.a_time.get()
         self.attack_time = attack_time
-        self.oscillator.envelope['attack'] = attack_time
+        self.output.set_envelope(self.oscillator, attack=attack_time)
         self.replot()
 
     def change_decay_time(self, *args):
         decay_time = self.d_time.get()
         self.decay_time = decay_time
-        self.oscillator.envelope['decay'] = decay_time
+        self.output.set_envelope(self.oscillator, decay=decay_time)
         self.replot()
 
     def change_release_time(self, *args):
         release_time = self.r_time.get()
         self.release_time = release_time
-        self.oscillator.envelope['release'] = release_time
+        self.output.set_envelope(self.oscillator, release=release_time)
         if release_time < 0.1: self.dr_shape.set(6)
         self.replot()
 
     def change_sustain(self, *args):
         sustain = self.s_level.get()
         self.sustain_level = sustain * self.max_amp
-        self.oscillator.envelope['sustain'] = sustain
+        self.output.set_envelope(self.oscillator, sustain=sustain)
         self.replot()
 
     def change_a_target(self, *args):
         a_target = 10 ** (-self.a_shape.get())
         self.a_target = a_target
-        self.oscillator.envelope['a_target'] = a_target
+        self.output.set_envelope(self.oscillator, a_target=a_target)
         self.replot()
 
     def change_dr_target(self, *args):
         dr_target = 10 ** (-self.dr_shape.get())
         self.dr_target = dr_target
-        self.oscillator.envelope['dr_target'] = dr_target
+        self.output.set_envelope(self.oscillator, dr_target=dr_target)
         self.replot()
 
     def replot(self):
@@ -3,7 +3,7 @@ from tkinter import ttk
 import numpy as np
 from math import log10
 from pysynth.waveforms import SineWave, SquareWave
-from pysynth.filters import PassFilter
+from pysynth.filters import PassFilter, StateVariableFilterBank
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 from .gui_helpers import LogScale
@@ -47,20 +47,21 @@ class TremoloGUI(tk.LabelFrame):
         self.sensitivity.grid(row=1, column=1)
 
     def set_modulator(self, *args):
-        freq = self.frequency.get()
         waveform = self.waveforms[self.input_waveformtype.get()]
-        self.output.set_am_modulator(waveform())
-        self.set_frequency()
+        modulator = waveform()
+        modulator.frequency = self.frequency.get()
+        modulator.amplitude = self.sensitivity.get()
+        self.output.set_am_modulator(modulator)
 
     def set_frequency(self, *args):
         if self.output.am_modulator:
             freq = self.frequency.get()
-            self.output.am_modulator.frequency = freq
+            self.output.set_parameter(self.output.am_modulator, "frequency", freq)
 
     def set_sensitivity(self, *args):
         if self.output.am_modulator:
             sens = self.sensitivity.get()
-            self.output.am_modulator.amplitude = sens
+            self.output.set_parameter(self.output.am_modulator, "amplitude", sens)
 
 
 class PassFilterGUI(tk.LabelFrame):
@@ -88,15 +89,35 @@ class PassFilterGUI(tk.LabelFrame):
         self.cutoff = LogScale(self.control_frame, command=self.set_cutoff, from_=2, to=4.3, orient=tk.HORIZONTAL, resolution=0.01)
         self.cutoff.set(4.3)
         self.cutoff.grid(row=1, column=1, pady=20)
+        # Resonance slider (Q of the state-variable filter)
+        self.resonance_label = tk.Label(self.control_frame, text='Res.')
+        self.resonance_label.grid(row=2, column=0)
+        self.resonance = tk.Scale(self.control_frame, from_=0.5, to=10, orient=tk.HORIZONTAL, resolution=.1, command=self.set_resonance)
+        self.resonance.set(0.7)
+        self.resonance.grid(row=2, column=1)
+        # Filter engine (the resonance only applies to the state-variable filter)
+        self.engine_label = tk.Label(self.control_frame, text='Engine')
+        self.engine_label.grid(row=3, column=0)
+        self.input_engine = tk.StringVar()
+        self.engine = ttk.OptionMenu(self.control_frame, self.input_engine, self.output.filter_engine, "butterworth", "svf", command=self.set_engine)
+        self.engine.grid(row=3, column=1)
 
     def set_cutoff(self, *args):
         cutoff = self.cutoff.get()
-        self.output.filter_cutoff = 10 ** cutoff
+        self.output.set_filter(cutoff=10 ** cutoff)
+        self.replot()
+
+    def set_resonance(self, *args):
+        self.output.set_filter(resonance=self.resonance.get())
+        self.replot()
+
+    def set_engine(self, *args):
+        self.output.set_filter(engine=self.input_engine.get())
         self.replot()
 
     def set_filter_type(self, *args):
         filter_type = self.input_filter_type.get()
-        self.output.filter_type = filter_type
+        self.output.set_filter(filter_type=filter_type)
         self.replot()
 
     def filter_plot(self):
@@ -115,9 +136,14 @@ class PassFilterGUI(tk.LabelFrame):
         self.canvas.get_tk_widget().pack(side='top', fill='both', expand=1)
 
     def draw(self):
-        cutoff = self.output.filter_cutoff
-        filter_type = self.output.filter_type
-        w, h = PassFilter.frequency_response(cutoff, filter_type)
+        # The settings of the output are only updated between two audio blocks, the plot uses the inputs
+        cutoff = 10 ** self.cutoff.get()
+        filter_type = self.input_filter_type.get() or self.output.filter_type
+        engine = self.input_engine.get() or self.output.filter_engine
+        if engine == "svf":
+            w, h = StateVariableFilterBank.frequency_response(cutoff, self.resonance.get(), filter_type)
+        else:
+            w, h = PassFilter.frequency_response(cutoff, filter_type)
         self.plot.plot(w, np.abs(h), 'b')
         self.plot.set_xscale('log')
         self.plot.axvline(cutoff, color='k')
@@ -1,5 +1,4 @@
 import tkinter as tk
-from pysynth.output import VoiceChannel
 
 class Keys:
 
@@ -35,8 +34,7 @@ class KeyboardGUI(tk.Frame):
             frequency = note * (2 ** octave)
 
             def press_key(event, frequency=frequency, octave=octave):
-                voice = VoiceChannel(output, frequency=frequency)
-                output.add_new_voice(voice)
+                output.note_on(frequency)
 
             def release_key(event, frequency=frequency):
                 output.release_notes(frequency)
@@ -59,8 +57,7 @@ class KeyboardGUI(tk.Frame):
                 frequency = note * (2 ** octave)
 
                 def press_key(event, frequency=frequency, octave=octave):
-                    voice = VoiceChannel(output, frequency=frequency)
-                    output.add_new_voice(voice)
+                    output.note_on(frequency)
 
                 def release_key(event, frequency=frequency):
                     output.release_notes(frequency)
@@ -1,7 +1,7 @@
 import tkinter as tk
 import string
 from tkinter import ttk
-from pysynth.waveforms import SineWave, SquareWave, WhiteNoise
+from pysynth.waveforms import SineWave, SquareWave, TriangleWave, SawtoothWave, PulseWave, WhiteNoise
 from frontend.envelope import EnvelopeGUI
 from pysynth.filters import FreqModulationFilter, ADSREnvelope
 from PIL import ImageTk, Image
@@ -27,11 +27,7 @@ class FmButton(tk.Frame):
         Callback function from Checkbutton object.
         Adds the given oscillator to the list of destination oscillators in the parent.
         """
-        if self.osc_input.get():
-            self.gui.osc.to_oscillators.append(self.oscillator)
-        else:
-            self.gui.osc.to_oscillators.remove(self.oscillator)
-        self.gui.output.route_and_filter()
+        self.output.set_fm_destination(self.gui.osc, self.oscillator, bool(self.osc_input.get()))
 
 
 class OscillatorGUI(tk.Frame):
@@ -66,8 +62,9 @@ class OscillatorGUI(tk.Frame):
         self.waveforms = {
             "sine": SineWave,  
             "square": SquareWave,
-            # "triangle": None,
-            # "sawtooth": None,
+            "triangle": TriangleWave,
+            "sawtooth": SawtoothWave,
+            "pulse": PulseWave,
             "noise": WhiteNoise
             }
          
@@ -109,7 +106,7 @@ class OscillatorGUI(tk.Frame):
 
     def set_frequency_ratio(self, *args):
         try:
-            self.osc.frequency_ratio = float(self.input_ratio.get())
+            self.output.set_parameter(self.osc, "frequency_ratio", float(self.input_ratio.get()))
         except:
             pass
 
@@ -121,12 +118,12 @@ class OscillatorGUI(tk.Frame):
         """
         if self.fixed_var.get() == 0:
             self.input_freq_frame.pack_forget()
-            if self.osc is not None: self.osc.fixed_frequency = False
+            if self.osc is not None: self.output.set_parameter(self.osc, "fixed_frequency", False)
             self.ratio_frame.pack()
         else:
             self.input_freq_frame.pack()
             self.set_frequency()
-            if self.osc is not None: self.osc.fixed_frequency = True
+            if self.osc is not None: self.output.set_parameter(self.osc, "fixed_frequency", True)
             self.ratio_frame.pack_forget()
 
     def amplitude_frame(self):
@@ -154,8 +151,8 @@ class OscillatorGUI(tk.Frame):
         self.op_frame = tk.Frame(self.fm_frame)
         self.op_frame.pack()
 
-        for oscillator in self.output.get_next_oscillators(self.osc):
-            self.fm_button = FmButton(self.op_frame, self, oscillator)
+        for oscillator_gui in self.gui.oscillators[self.number + 1:]:
+            self.fm_button = FmButton(self.op_frame, self, oscillator_gui.osc)
             self.fm_button.pack()
 
     def show_envelope(self, *args):
@@ -179,7 +176,7 @@ class OscillatorGUI(tk.Frame):
 
     def update_osc(self, *args):
         if self.osc is not None:
-            del self.output.oscillators[self.number]
+            self.output.remove_oscillator(self.osc)
         self.create_osc()
         self.show_envelope()
 
@@ -190,24 +187,24 @@ class OscillatorGUI(tk.Frame):
             self.wave_icon = ImageTk.PhotoImage(bw_image)
             self.image_panel.configure(image=self.wave_icon)
             self.waveform["state"] = "disabled"
-            self.osc.disable()
+            self.output.commands.post(self.osc.disable)
         else:
             self.ui_frame.pack()
             self.wave_icon = ImageTk.PhotoImage(self.image)
             self.image_panel.configure(image=self.wave_icon)
             self.waveform["state"] = "normal"
             self.set_amplitude()
-            self.osc.disabled = False
+            self.output.set_parameter(self.osc, "disabled", False)
         self.output.route_and_filter()
 
     def set_frequency(self, *args):
         """
         Set frequency to input value.
         """
-        if self.osc: self.osc.frequency = float(self.input_freq.get())
+        if self.osc: self.output.set_parameter(self.osc, "frequency", float(self.input_freq.get()))
 
     def set_amplitude(self, *args):
         """
         Set amplitude to input value.
         """
-        if self.osc: self.osc.amplitude = float(self.amplitude.get())
+        if self.osc: self.output.set_parameter(self.osc, "amplitude", float(self.amplitude.get()))
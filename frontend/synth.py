@@ -74,8 +74,24 @@ class SynthGUI(tk.Tk):
         """
         Add a status bar at the bottom.
         """
-        self.statusbar = ttk.Label(self, text='Welcome to PySynth', relief=tk.SUNKEN, font='Times 10 italic')
-        self.statusbar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.statusframe = tk.Frame(self, relief=tk.SUNKEN, borderwidth=1)
+        self.statusframe.pack(side=tk.BOTTOM, fill=tk.X)
+        self.statusbar = ttk.Label(self.statusframe, text='Welcome to PySynth', font='Times 10 italic')
+        self.statusbar.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.metricsbar = ttk.Label(self.statusframe, text='', font='Times 10 italic')
+        self.metricsbar.pack(side=tk.RIGHT)
+        self.update_metrics()
+
+    def update_metrics(self):
+        """
+        Show the audio metrics in the status bar (and export them if a metrics file is set), every 500ms.
+        """
+        metrics = self.output.metrics()
+        self.metricsbar['text'] = (f'DSP {100 * metrics["load"]:.0f}%  CPU {100 * metrics["cpu_load"]:.0f}%  '
+                                   f'voices {metrics["voices"]}  late {metrics["deadline_misses"]}  '
+                                   f'xruns {metrics["underflows"] + metrics["overflows"]}')
+        self.output.export_metrics()
+        self.after(500, self.update_metrics)
 
     def selected_algorithm_frame(self):
         """
@@ -143,7 +159,7 @@ class SynthGUI(tk.Tk):
         ADSR envelope display.
         """
         self.oscillators[0]['bg'] = 'SkyBlue1'
-        self.env_gui = EnvelopeGUI(self.display_frame, self.oscillators[0].osc, padx=20, pady=20)
+        self.env_gui = EnvelopeGUI(self.display_frame, self.output, self.oscillators[0].osc, padx=20, pady=20)
 
     def filters_frame(self):
         """
@@ -0,0 +1,133 @@
+class VoiceAllocator:
+    """
+    Assigns voices to a fixed number of slots, and keeps an index of the held notes, so that a note-off finds
+    its voice in constant time. A voice keeps its slot after its note-off, while it is releasing, until it is
+    finished (as reported by the `finished` function) or stolen.
+
+    When all slots are taken, a voice is stolen according to the policy:
+        - "oldest": the voice which started first.
+        - "quietest": the voice with the lowest current envelope amplitude (as reported by the `level` function).
+        - "releasing": the oldest voice which has been released, or the oldest voice if all notes are held.
+    The stolen voice, held or releasing, leaves its slot at once: it is returned by note_on, to be stopped
+    (see VoiceBank.stop), as are the voices which no longer fit when the allocator is resized.
+
+    A note-on on a key which is already held releases the previous voice of the key, which then rings out
+    in its slot like any other released voice, and the key is mapped to the new voice. When all slots are taken,
+    the voice which the key has just released is not stolen by the new voice, unless it has the only slot.
+    """
+    policies = ("oldest", "quietest", "releasing")
+
+    def __init__(self, capacity: int = 4, policy: str = "oldest", level=None, finished=None):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown voice stealing policy {policy}, expected one of {self.policies}')
+        self.policy = policy
+        self.level = level or (lambda voice: 0.0)
+        self.finished = finished or (lambda voice: False)
+        self.notes = {}
+        self.note_count = 0
+        self.slots = []
+        self.slot_of = {}
+        self.resize(capacity)
+
+    def __len__(self):
+        return self.capacity - len(self.free)
+
+    def __contains__(self, voice):
+        return id(voice) in self.slot_of
+
+    def resize(self, capacity: int):
+        """
+        Change the number of slots. Returns the voices which no longer fit, newest first.
+        """
+        voices = sorted(self.voices(), key=lambda voice: self.started[self.slot_of[id(voice)]])
+        held = {id(voice): key for key, voice in self.notes.items()}
+        self.capacity = capacity
+        self.slots = [None] * capacity
+        self.keys = [None] * capacity
+        self.started = [0] * capacity
+        self.held = [False] * capacity
+        self.slot_of = {}
+        self.free = list(range(capacity - 1, -1, -1))
+        self.notes = {}
+        removed = voices[:max(len(voices) - capacity, 0)]
+        for voice in voices[len(removed):]:
+            key = held.get(id(voice))
+            slot = self.assign(key, voice)
+            self.held[slot] = key is not None
+        return removed[::-1]
+
+    def voices(self):
+        """
+        Voices currently in a slot, held or releasing.
+        """
+        return [voice for voice in self.slots if voice is not None]
+
+    def assign(self, key, voice) -> int:
+        slot = self.free.pop()
+        self.note_count += 1
+        self.slots[slot] = voice
+        self.keys[slot] = key
+        self.started[slot] = self.note_count
+        self.held[slot] = True
+        self.slot_of[id(voice)] = slot
+        if key is not None: self.notes[key] = voice
+        return slot
+
+    def remove(self, slot: int):
+        voice = self.slots[slot]
+        del self.slot_of[id(voice)]
+        if self.held[slot] and self.notes.get(self.keys[slot]) is voice:
+            del self.notes[self.keys[slot]]
+        self.slots[slot] = self.keys[slot] = None
+        self.held[slot] = False
+        self.free.append(slot)
+        return voice
+
+    def reclaim(self):
+        """
+        Free the slots of the voices which are finished.
+        """
+        for slot, voice in enumerate(self.slots):
+            if voice is not None and not self.held[slot] and self.finished(voice):
+                self.remove(slot)
+
+    def steal(self, keep: int = None) -> int:
+        """
+        Returns the slot of the voice to be stolen, according to the policy. The slot `keep` is only stolen
+        if there is no other slot.
+        """
+        slots = [slot for slot in range(self.capacity) if slot != keep] or [keep]
+        if self.policy == "quietest":
+            return min(slots, key=lambda slot: (self.level(self.slots[slot]), self.started[slot]))
+        if self.policy == "releasing":
+            released = [slot for slot in slots if not self.held[slot]]
+            if released: slots = released
+        return min(slots, key=lambda slot: self.started[slot])
+
+    def note_on(self, key, voice):
+        """
+        Allocate a slot for a new voice. Returns the slot (None if there are no slots), the voices to be
+        released (the previous voice of the key, if it is held), and the stolen voice (None if no voice is stolen).
+        """
+        released = []
+        stolen = None
+        keep = None
+        if self.capacity == 0: return None, released, stolen
+        if key in self.notes:
+            previous = self.note_off(key)
+            released.append(previous)
+            keep = self.slot_of[id(previous)]
+        if not self.free:
+            self.reclaim()
+        if not self.free:
+            stolen = self.remove(self.steal(keep))
+        return self.assign(key, voice), released, stolen
+
+    def note_off(self, key):
+        """
+        Mark the voice of a key as released. Returns the voice (None if the key is not held).
+        """
+        voice = self.notes.pop(key, None)
+        if voice is not None:
+            self.held[self.slot_of[id(voice)]] = False
+        return voice
@@ -1,40 +1,126 @@
-import sounddevice as sd
 import numpy as np
+import time
+from threading import Thread
+from time import perf_counter
 from scipy.io.wavfile import write
-from pysynth.sample import AudioSample
+from pysynth.recorder import WavRecorder
+from pysynth.commands import Commands
+from pysynth.metrics import CallbackMetrics
+from pysynth.backends import Backend, backends
 import pysynth.params as p
 from pysynth.waveforms import SineWave
 
 
+class RenderAhead:
+    """
+    Ring buffer of audio blocks rendered ahead of time.
+    A dedicated producer thread renders blocks from the source into a preallocated ring of `depth` blocks,
+    and the PortAudio callback only copies blocks out of it, so that GC pauses or GIL contention in the
+    synthesis graph are absorbed by the lookahead rather than causing dropouts.
+    The ring has a single producer and a single consumer, each of which only advances its own index,
+    so no lock is needed. If the ring is empty when the callback reads from it, the callback outputs
+    silence and the underrun is counted.
+    """
+    def __init__(self, depth: int, blocksize: int = p.blocksize, framerate: int = p.framerate):
+        self.depth = depth
+        self.blocksize = blocksize
+        self.blocks = np.zeros((depth, blocksize), dtype=np.float32)
+        self.period = blocksize / framerate
+        self.write_index = 0
+        self.read_index = 0
+        self.underruns = 0
+        self.source = None
+        self.running = False
+        self.thread = None
+
+    def start(self, source):
+        """
+        Start rendering blocks from a new source.
+        """
+        self.stop()
+        self.source = source
+        self.write_index = self.read_index = 0
+        self.running = True
+        self.thread = Thread(target=self.produce, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.running = False
+            self.thread.join()
+            self.thread = None
+
+    def produce(self):
+        """
+        Producer thread: keep the ring full, and sleep for a fraction of a block when it is.
+        """
+        while self.running:
+            if self.write_index - self.read_index < self.depth:
+                self.source.render(self.blocksize, self.blocks[self.write_index % self.depth])
+                self.write_index += 1
+            else:
+                time.sleep(self.period / 4)
+
+    def read(self, out: np.ndarray) -> bool:
+        """
+        Called from the PortAudio callback: copy the next rendered block into out.
+        Returns False, with out filled with silence, on underrun.
+        """
+        if self.read_index < self.write_index:
+            out[:] = self.blocks[self.read_index % self.depth, :len(out)]
+            self.read_index += 1
+            return True
+        out.fill(0.0)
+        self.underruns += 1
+        return False
+
+
 class AudioApi:
     """
-    Api to interface with PortAudio using the sounddevice library.
+    Api to interface with the audio backend, PortAudio (with the sounddevice library) by default.
+    The backend is either a Backend object or the name of one of the backends (see pysynth.backends),
+    e.g "null" to run without a sound card, or "file" to write the audio to a WAV file in the recordings directory.
+    The backend only runs while a source is played (see play and stop).
+    With render_ahead > 0, the synthesis graph is rendered by a separate thread, up to render_ahead
+    blocks ahead of the callback (see RenderAhead).
+
+    Commands posted to self.commands by the control threads are applied by the audio thread before every
+    block is rendered (see render), i.e. by the callback, or by the render-ahead thread.
+
+    The stream clock maps a time (as given by perf_counter) onto a frame of the source (see frame_at).
+    It counts the frames of the source which have been played, and estimates the time at which frame 0 was
+    played, the clock offset. Callbacks can be late, but never early, so the offset is the earliest of
+    the offsets measured at every callback. It is allowed to drift by clock_drift seconds per callback,
+    to follow the drift between the sound card clock and perf_counter.
     """
-    def __init__(self, framerate: int = p.framerate, blocksize: int = p.blocksize, channels: int = 1):
+    clock_drift = 1e-5
+
+    def __init__(self, framerate: int = p.framerate, blocksize: int = p.blocksize, channels: int = 1, render_ahead: int = 0,
+                 backend="portaudio"):
         self.framerate = framerate
         self.channels = channels        
         self.channel_mapping = np.arange(self.channels)
         self.blocksize = blocksize
-        self.data = None
-        self.stream = self.initialize_stream()
-        self.stream.start()
+        self.source = None
+        self.commands = Commands()
+        self.buffer = np.zeros(self.blocksize, dtype=np.float32)
+        self.render_ahead = RenderAhead(render_ahead, blocksize, framerate) if render_ahead > 0 else None
+        self.metrics = CallbackMetrics(blocksize, framerate)
+        self.backend = self.initialize_backend(backend)
         self.volume = 100.0
         self.playing = False
-        self.sample = AudioSample("pysynth.wav")
-        self.recording = False
+        self.recorder = None
+        self.stream_frame = 0
+        self.clock_offset = None
 
-    def initialize_stream(self):
+    def initialize_backend(self, backend):
         """
-        Initialize sounddevice OutputStream.
-        """        
-        stream = sd.OutputStream(
-            samplerate=self.framerate,
-            channels=self.channels,
-            blocksize=self.blocksize,
-            callback=self.callback,
-            dtype='float32')
-
-        return stream
+        Open the audio backend, with the callback as its source of audio.
+        """
+        if not isinstance(backend, Backend):
+            backend = backends[backend](framerate=self.framerate, blocksize=self.blocksize, channels=self.channels)
+        backend.open(self.callback)
+        return backend
 
     def prepare_data_blocks(self, data):
         """
@@ -48,34 +134,110 @@ class AudioApi:
     def callback(self, outdata, frames, time, status):
         """
         PortAudio callback function for callback in OutputStream.
+        The time spent in the callback and the status flags are recorded in self.metrics.
         """
-        if not self.data or not self.playing:
+        started = perf_counter()
+        if self.source is None or not self.playing:
             outdata[:self.blocksize, self.channel_mapping] = np.zeros((self.blocksize, self.channels))
         else:
-            try: 
-                data = next(self.data)
-                if self.recording:
-                    self.sample.join(AudioSample.from_array(data))
-                data = self.prepare_data_blocks(data)
-                outdata[:self.blocksize, self.channel_mapping] =  (self.volume / 100.0) * data
-            except StopIteration:
-                raise sd.CallbackStop
+            data = self.buffer[:frames]
+            offset = started - self.stream_frame / self.framerate
+            if self.clock_offset is None: self.clock_offset = offset
+            else: self.clock_offset = min(offset, self.clock_offset + self.clock_drift)
+            if self.render_ahead:
+                if self.render_ahead.read(data): self.stream_frame += frames
+                else: self.clock_offset = None
+            else:
+                self.render(frames, data)
+                self.stream_frame += frames
+            if self.recorder:
+                self.recorder.write(data)
+            data *= self.volume / 100.0
+            outdata[:frames, self.channel_mapping] = self.prepare_data_blocks(data)
+        self.metrics.record(perf_counter() - started, status)
+
+    def render(self, frames: int, out: np.ndarray):
+        """
+        Apply the pending commands, then render the next block of the source.
+        """
+        self.commands.apply()
+        self.source.render(frames, out)
+
+    def frame_at(self, t: float = None) -> int:
+        """
+        Frame of the source at which an event which happened at time t (perf_counter, now by default) is played.
+        Events are delayed by a constant latency, the time it takes for a block to be rendered ahead of the
+        block being played, so that every event falls into a block which has not been rendered yet.
+        When playback is stopped, events are played at the start of the next block.
+        """
+        clock_offset = self.clock_offset
+        if not self.playing or clock_offset is None: return self.stream_frame
+        if t is None: t = perf_counter()
+        latency = self.blocksize * (1 + (self.render_ahead.depth if self.render_ahead else 0))
+        return int((t - clock_offset) * self.framerate) + latency
+
+    @property
+    def cpu_load(self):
+        """
+        CPU load of the audio backend, e.g as estimated by PortAudio.
+        """
+        return self.backend.cpu_load
+
+    @property
+    def underruns(self):
+        """
+        Number of blocks for which the render-ahead ring was empty.
+        """
+        return self.render_ahead.underruns if self.render_ahead else 0
 
     def play(self, output):
         """
-        Takes an audio data generator as input
-        e.g an Oscillator object.
+        Takes an audio source as input, e.g an Oscillator object,
+        which is pulled with its render() method in the callback.
         """
-        self.data = output.data()
+        self.source = output
+        self.stream_frame = getattr(output, 'frame', 0)
+        self.clock_offset = None
+        # Commands are queued before the audio thread starts, so that they are never applied by two threads
+        self.commands.running = True
+        if self.render_ahead:
+            self.render_ahead.start(self)
         self.playing = True
+        self.backend.start()
 
     def stop(self):
         """
-        Stop audio playback.
+        Stop audio playback and the backend. Commands are applied immediately once the render-ahead thread
+        has stopped.
         """
         self.playing = False
+        self.backend.stop()
+        if self.render_ahead:
+            self.render_ahead.stop()
+        self.commands.running = False
+
+    def close(self):
+        """
+        Stop playback and recording, and close the audio backend.
+        """
+        self.stop()
+        self.save_to_wav()
+        self.backend.close()
+
+    def start_recording(self, path: str = None, sample_format: str = "int16"):
+        """
+        Start streaming the output to a WAV file (see WavRecorder), in the recordings directory by default.
+        """
+        self.save_to_wav()
+        recorder = WavRecorder(path, self.framerate, 1, sample_format, blocksize=self.blocksize)
+        recorder.start()
+        self.recorder = recorder
 
     def save_to_wav(self):
-        self.sample.save_to_wav()
-        self.sample = AudioSample("pysynth.wav")
-        self.recording = False
\ No newline at end of file
+        """
+        Stop recording and finalise the WAV file. Returns its path.
+        """
+        recorder, self.recorder = self.recorder, None
+        if recorder is None: return None
+        recorder.close()
+        return recorder.path
@@ -0,0 +1,165 @@
+import time
+import wave
+import numpy as np
+from threading import Thread, current_thread
+from time import perf_counter
+import pysynth.params as p
+from pysynth.recorder import recording_path
+
+
+class Backend:
+    """
+    Audio backend of the AudioApi: a sink which pulls blocks of audio from a callback of the form
+    callback(outdata, frames, time, status), as defined by sounddevice, with outdata of shape (frames, channels).
+    """
+    def __init__(self, framerate: int = p.framerate, blocksize: int = p.blocksize, channels: int = 1):
+        self.framerate = framerate
+        self.blocksize = blocksize
+        self.channels = channels
+        self.callback = None
+
+    def open(self, callback):
+        self.callback = callback
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.stop()
+
+    @property
+    def cpu_load(self):
+        return 0.0
+
+
+class PortAudioBackend(Backend):
+    """
+    Plays audio through PortAudio, with a sounddevice OutputStream.
+    sounddevice is only imported when the stream is opened, so that the rest of the engine runs without it.
+    """
+    def open(self, callback):
+        import sounddevice as sd
+        super().open(callback)
+        self.stream = sd.OutputStream(
+            samplerate=self.framerate,
+            channels=self.channels,
+            blocksize=self.blocksize,
+            callback=callback,
+            dtype='float32')
+
+    def start(self):
+        self.stream.start()
+
+    def stop(self):
+        self.stream.stop()
+
+    def close(self):
+        self.stream.close()
+
+    @property
+    def cpu_load(self):
+        """
+        CPU load of the stream, as estimated by PortAudio.
+        """
+        return self.stream.cpu_load
+
+
+class NullBackend(Backend):
+    """
+    Discards the audio. The callback is called from a thread, either paced by the wall clock, one block
+    per block duration as a sound card would (realtime=True), or free-running, as fast as blocks are rendered.
+    With max_blocks set, the thread stops by itself after that number of blocks (see wait()).
+    The CPU load is the mean callback time as a fraction of the block duration.
+    """
+    def __init__(self, framerate: int = p.framerate, blocksize: int = p.blocksize, channels: int = 1,
+                 realtime: bool = True, max_blocks: int = None):
+        super().__init__(framerate, blocksize, channels)
+        self.realtime = realtime
+        self.max_blocks = max_blocks
+        self.period = blocksize / framerate
+        self.outdata = np.zeros((blocksize, channels), dtype=np.float32)
+        self.running = False
+        self.thread = None
+        self.blocks = 0
+        self.callback_time = 0.0
+
+    def start(self):
+        if self.thread: return
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread and self.thread is not current_thread():
+            self.thread.join()
+            self.thread = None
+
+    def wait(self):
+        """
+        Wait until max_blocks blocks have been played.
+        """
+        if self.thread: self.thread.join()
+
+    def run(self):
+        deadline = perf_counter()
+        while self.running and (self.max_blocks is None or self.blocks < self.max_blocks):
+            started = perf_counter()
+            self.callback(self.outdata, self.blocksize, None, None)
+            self.callback_time += perf_counter() - started
+            self.blocks += 1
+            self.write(self.outdata)
+            if self.realtime:
+                deadline += self.period
+                delay = deadline - perf_counter()
+                if delay > 0: time.sleep(delay)
+                else: deadline = perf_counter()
+        self.running = False
+
+    def write(self, outdata: np.ndarray):
+        pass
+
+    @property
+    def cpu_load(self):
+        return self.callback_time / (self.blocks * self.period) if self.blocks else 0.0
+
+
+class FileBackend(NullBackend):
+    """
+    Writes every played block to a 16 bit WAV file, in the recordings directory by default (see recording_path).
+    The blocks are paced by the wall clock by default. Free-running (realtime=False) writes blocks as fast as
+    they are rendered, and must be bounded by max_blocks. The file is finalised when the backend is closed.
+    """
+    def __init__(self, path: str = None, framerate: int = p.framerate, blocksize: int = p.blocksize,
+                 channels: int = 1, realtime: bool = True, max_blocks: int = None):
+        if not realtime and max_blocks is None:
+            raise ValueError("A free-running FileBackend needs max_blocks")
+        super().__init__(framerate, blocksize, channels, realtime, max_blocks)
+        self.path = path or recording_path()
+        self.wav = None
+
+    def open(self, callback):
+        super().open(callback)
+        self.wav = wave.open(self.path, 'wb')
+        self.wav.setnchannels(self.channels)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(self.framerate)
+
+    def write(self, outdata: np.ndarray):
+        self.wav.writeframes((np.clip(outdata, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+
+    def close(self):
+        super().close()
+        if self.wav:
+            self.wav.close()
+            self.wav = None
+
+
+backends = {
+    "portaudio": PortAudioBackend,
+    "null": NullBackend,
+    "file": FileBackend
+}
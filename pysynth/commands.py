@@ -0,0 +1,82 @@
+import time
+from itertools import count
+from threading import get_ident
+
+
+class CommandQueue:
+    """
+    Single producer, single consumer ring of commands, i.e functions to be called with their arguments.
+    As in RenderAhead, the producer and the consumer each advance their own index into a preallocated ring,
+    so no lock is needed. The consumer never waits: it applies the commands which are there.
+    If the ring is full, the producer waits for the consumer to make room.
+    Every command is numbered from a sequence, which can be shared by several queues (see Commands).
+    """
+    def __init__(self, size: int = 1024, sequence=None):
+        self.size = size
+        self.sequence = sequence or count()
+        self.commands = [None] * size
+        self.write_index = 0
+        self.read_index = 0
+
+    def __len__(self):
+        return self.write_index - self.read_index
+
+    def post(self, function, *args):
+        while self.write_index - self.read_index >= self.size:
+            time.sleep(0.001)
+        self.commands[self.write_index % self.size] = (next(self.sequence), function, args)
+        self.write_index += 1
+
+    def pending(self):
+        """
+        Take the pending commands out of the ring, as (number, function, args), in the order in which they were posted.
+        """
+        commands = []
+        while self.read_index < self.write_index:
+            slot = self.read_index % self.size
+            commands.append(self.commands[slot])
+            self.commands[slot] = None
+            self.read_index += 1
+        return commands
+
+    def apply(self):
+        """
+        Apply all pending commands, in the order in which they were posted.
+        """
+        for _, function, args in self.pending():
+            function(*args)
+
+
+class Commands:
+    """
+    Commands posted by the control threads (GUI, MIDI) to the audio thread, which applies them between two
+    blocks (see AudioApi.render), so that the audio graph is never modified while a block is being rendered.
+    Every producer thread gets its own CommandQueue, so that every queue has a single producer. The commands of
+    all the queues are numbered from the same sequence, and applied in the order in which they were posted,
+    e.g so that note events from the GUI keyboard and from MIDI are applied in the order in which they happened.
+    When the audio thread is not running, commands are applied immediately.
+    """
+    def __init__(self):
+        self.queues = {}
+        self.sequence = count()
+        self.running = False
+
+    def post(self, function, *args):
+        if not self.running:
+            self.apply()
+            function(*args)
+            return
+        queue = self.queues.get(get_ident())
+        if queue is None:
+            queue = self.queues[get_ident()] = CommandQueue(sequence=self.sequence)
+        queue.post(function, *args)
+
+    def apply(self):
+        queues = list(self.queues.values())
+        if len(queues) == 1:
+            queues[0].apply()
+            return
+        commands = [command for queue in queues for command in queue.pending()]
+        commands.sort(key=lambda command: command[0])
+        for _, function, args in commands:
+            function(*args)
@@ -1,9 +1,22 @@
 import numpy as np
 from abc import ABC
-from pysynth.waveforms import Oscillator, EmptyOscillator
-from typing import List
+from pysynth.waveforms import Oscillator, BaseOscillator, EmptyOscillator, ramp
+from typing import Generator, List
 from pysynth.params import *
-from scipy.signal import butter, lfilter, freqz, lfilter_zi
+from collections import deque
+from functools import lru_cache
+from scipy.signal import butter, lfilter, freqz, lfilter_zi, sosfilt, sosfilt_zi
+
+
+def parameter_ramp(output, target, name: str, frames: int, start: int = 0):
+    """
+    Values of a parameter (attribute or setting `name` of `target`) over the next frames of the block being
+    rendered, from frame `start` of the block, if it is modulated by the modulation matrix of the output
+    (see ModulationMatrix.ramp), otherwise None.
+    """
+    matrix = getattr(output, 'modulation', None)
+    if not matrix: return None
+    return matrix.ramp(target, name, start, frames)
 
 
 class Filter(Oscillator, ABC):
@@ -12,11 +25,16 @@ class Filter(Oscillator, ABC):
     All filters have a state flag, which is updated as the ADSR state of the sources changes. This state flag
     is passed along every stage of the data pipeline, thus allowing to control for idle voices in VoicesSumFilter,
     and remove them.
+
+    Filters are pulled with render(frames, out), which writes the next block into a preallocated float32 array.
+    Intermediate results are written into work buffers which are allocated once per filter (see get_buffer).
+    The data() generator is kept as a compatibility shim on top of render().
     """
     def __init__(self, sources: List[Oscillator]):
         super().__init__(sources[0].framerate if sources else 0)
         self.sources = sources
         self._state = 1
+        self._buffers = {}
 
     @property
     def state(self):
@@ -34,26 +52,223 @@ class Filter(Oscillator, ABC):
         else:
             self._state = state
 
+    def get_buffer(self, name: str, frames: int) -> np.ndarray:
+        """
+        Returns a float32 work buffer of length frames, which is only reallocated if it is too small.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or len(buffer) < frames:
+            buffer = self._buffers[name] = np.zeros(frames, dtype=np.float32)
+        return buffer[:frames]
+
+    def data(self, **kwargs) -> Generator[np.ndarray, None, None]:
+        while True:
+            out = np.zeros(blocksize, dtype=np.float32)
+            self.render(blocksize, out, **kwargs)
+            yield out
+
 
 class AmpModulationFilter(Filter):
     """
     Amplitude modulater. Takes a source oscillator and a modulating oscillator as inputs and generates a modulated signal.
+    The modulator phase is kept by the filter, so that a modulator can be shared between several filters.
     """
     def __init__(self, source: Oscillator, modulator: Oscillator):
         super().__init__([source])
         self.source = source
         self.modulator = modulator
+        self.modulator_phase = 0.0
 
     def __str__(self):
         return f'AmpMod({self.source}, {self.modulator})'
 
-    def data(self):
-        source = self.source.data()
-        modulator = self.modulator.data(single_samples=False)
-        while True:
-            am_envelope = [(1.0 + i) for i in next(modulator)]
-            yield [e * s for (e, s) in zip(am_envelope, next(source))]
-            self.state = self.source.state
+    def render(self, frames: int, out: np.ndarray):
+        am_envelope = self.get_buffer('modulator', frames)
+        increment = self.modulator.frequency / self.modulator.framerate
+        phases, self.modulator_phase = self.modulator.phase_block(self.modulator_phase, increment, frames)
+        np.multiply(self.modulator.waveform(phases), self.modulator.amplitude, out=am_envelope)
+        am_envelope += 1.0
+        self.source.render(frames, out)
+        out *= am_envelope
+        self.state = self.source.state
+
+
+class TremoloLFO:
+    """
+    Tremolo LFO shared by all the voices of an output. The amplitude modulator of the output (am_modulator) is
+    rendered once per block, by the master of the voices (VoiceBank or VoicesSumFilter), into a gain buffer
+    1 + amplitude * waveform(phase), which every voice then multiplies into its own signal.
+    The phase runs on the master clock: it is continuous across notes, and the cost of the tremolo does not
+    depend on the number of voices. The frequency and the amplitude of the modulator can be modulated
+    (see ModulationMatrix), in which case their ramps are followed.
+    """
+    def __init__(self, output, framerate: int = framerate):
+        self.output = output
+        self.framerate = framerate
+        self.phase = 0.0
+        self.gain = np.ones(blocksize, dtype=np.float32)
+        self.active = False
+
+    def advance(self, frames: int, start: int = 0):
+        """
+        Render the gain of the next block of frames, which starts at frame `start` of the block being rendered.
+        Returns None if the output has no tremolo.
+        """
+        modulator = self.output.am_modulator
+        self.active = bool(modulator)
+        if not self.active: return None
+        if len(self.gain) < frames:
+            self.gain = np.ones(frames, dtype=np.float32)
+        gain = self.gain[:frames]
+        frequency = parameter_ramp(self.output, modulator, "frequency", frames, start)
+        amplitude = parameter_ramp(self.output, modulator, "amplitude", frames, start)
+        if frequency is None: frequency = modulator.frequency
+        if amplitude is None: amplitude = modulator.amplitude
+        phases, self.phase = BaseOscillator.phase_block(self.phase, frequency / self.framerate, frames)
+        np.multiply(modulator.waveform(phases), amplitude, out=gain)
+        gain += 1.0
+        return gain
+
+    def block(self, frames: int):
+        """
+        Gain of the current block, as rendered by the last call to advance(), or None if there is no tremolo.
+        """
+        return self.gain[:frames] if self.active else None
+
+
+class TremoloFilter(Filter):
+    """
+    Applies the shared tremolo LFO of the output (see TremoloLFO) to a voice.
+    """
+    def __init__(self, source: Oscillator, lfo: TremoloLFO):
+        super().__init__([source])
+        self.source = source
+        self.lfo = lfo
+
+    def __str__(self):
+        return f'Tremolo({self.source})'
+
+    def render(self, frames: int, out: np.ndarray):
+        self.source.render(frames, out)
+        gain = self.lfo.block(frames)
+        if gain is not None: out *= gain
+        self.state = self.source.state
+
+
+class PitchModulation:
+    """
+    Pitch controls shared by all the voices of an output, rendered once per block by the master of the voices
+    (VoiceBank or VoicesSumFilter) as per-frame pitch offsets in octaves:
+        - pitch bend (see set_bend): the pitch moves linearly to the new bend over bend_time, so that the
+        steps of the MIDI pitch wheel are not heard.
+        - vibrato: a sine LFO of output.vibrato_frequency Hz and output.vibrato_depth semitones, whose phase
+        runs on the master clock. Both can be modulated (see ModulationMatrix).
+    Glide (portamento) is per voice: a new voice starts from the pitch of the previous note, and glides to its
+    own pitch over output.glide_time seconds (see glide_start and glide).
+    """
+    bend_time = 0.005
+
+    def __init__(self, output, framerate: int = framerate):
+        self.output = output
+        self.framerate = framerate
+        self.bend = 0.0
+        self.bend_target = 0.0
+        self.bend_step = 0.0
+        self.phase = 0.0
+        self.last_frequency = None
+        self.octaves = np.zeros(blocksize)
+        self.active = False
+
+    def set_bend(self, ratio: float):
+        """
+        Set the pitch bend, as a frequency ratio.
+        """
+        self.bend_target = np.log2(ratio)
+        self.bend_step = (self.bend_target - self.bend) / max(1.0, self.bend_time * self.framerate)
+
+    def advance(self, frames: int, start: int = 0):
+        """
+        Render the pitch offsets of the next block of frames, which starts at frame `start` of the block being
+        rendered. Returns None if there are none.
+        """
+        output = self.output
+        frequency = parameter_ramp(output, output, "vibrato_frequency", frames, start)
+        depth = parameter_ramp(output, output, "vibrato_depth", frames, start)
+        if frequency is None: frequency = output.vibrato_frequency
+        if depth is None: depth = output.vibrato_depth
+        self.active = bool(self.bend or self.bend_target or np.any(depth))
+        if not self.active:
+            _, self.phase = BaseOscillator.phase_block(self.phase, frequency / self.framerate, frames)
+            return None
+        if len(self.octaves) < frames:
+            self.octaves = np.zeros(frames)
+        octaves = self.octaves[:frames]
+        if self.bend != self.bend_target:
+            np.multiply(ramp(frames) + 1.0, self.bend_step, out=octaves)
+            octaves += self.bend
+            if self.bend_step > 0: np.minimum(octaves, self.bend_target, out=octaves)
+            else: np.maximum(octaves, self.bend_target, out=octaves)
+            self.bend = octaves[-1]
+        else:
+            octaves.fill(self.bend)
+        phases, self.phase = BaseOscillator.phase_block(self.phase, frequency / self.framerate, frames)
+        if np.any(depth): octaves += depth / 12.0 * np.sin(2.0 * np.pi * phases)
+        return octaves
+
+    def block(self, frames: int):
+        """
+        Pitch offsets of the current block, as rendered by the last call to advance(), or None.
+        """
+        return self.octaves[:frames] if self.active else None
+
+    def glide_start(self, frequency: float) -> float:
+        """
+        Called when a voice starts: the pitch offset, in octaves, from which the voice glides to its frequency.
+        """
+        previous, self.last_frequency = self.last_frequency, frequency
+        if not self.output.glide_time or previous is None: return 0.0
+        return float(np.log2(previous / frequency))
+
+    @staticmethod
+    def glide(octaves: np.ndarray, elapsed: np.ndarray, length: np.ndarray, frames: int) -> np.ndarray:
+        """
+        Pitch offsets of gliding voices over a block, of shape (voices, frames), given their starting offsets,
+        the number of frames since they started and the length of their glides, in frames.
+        """
+        remaining = 1.0 - (np.asarray(elapsed, dtype=np.float64)[:, None] + ramp(frames)) / np.asarray(length)[:, None]
+        return np.asarray(octaves)[:, None] * np.clip(remaining, 0.0, 1.0)
+
+
+class PitchFilter(Filter):
+    """
+    Applies the pitch controls shared by the voices (see PitchModulation) and the glide of a voice to the
+    oscillators of the voice, as per-frame frequency ratios (BaseOscillator.pitch), before each block is rendered.
+    Fixed frequency and disabled oscillators are not affected.
+    """
+    def __init__(self, source: Oscillator, oscillators: List[BaseOscillator], pitch: PitchModulation,
+                 glide_octaves: float = 0.0, glide_time: float = 0.0):
+        super().__init__([source])
+        self.source = source
+        self.oscillators = [o for o in oscillators if not o.fixed_frequency and not o.disabled]
+        self.pitch = pitch
+        self.glide_octaves = glide_octaves
+        self.glide_frames = max(1, int(glide_time * self.framerate))
+        self.elapsed = 0
+
+    def __str__(self):
+        return str(self.source)
+
+    def render(self, frames: int, out: np.ndarray):
+        octaves = self.pitch.block(frames)
+        if self.glide_octaves and self.elapsed < self.glide_frames:
+            glide = PitchModulation.glide([self.glide_octaves], [self.elapsed], [self.glide_frames], frames)[0]
+            octaves = glide if octaves is None else octaves + glide
+        self.elapsed += frames
+        ratios = None if octaves is None else np.exp2(octaves)
+        for o in self.oscillators:
+            o.pitch = ratios
+        self.source.render(frames, out)
+        self.state = self.source.state
 
 
 class FreqModulationFilter(Filter):
@@ -63,21 +278,20 @@ class FreqModulationFilter(Filter):
     def __init__(self, source: Oscillator, modulator: Oscillator):
         super().__init__([source])
         self.source = source
-        self.source_data = source.data(modulate=True)
         self.modulator = modulator
-        self.mod_data = modulator.data()
 
     def __str__(self):
         return f'FreqMod({self.source}, {self.modulator})'
 
-    def data(self, modulate=False):
-        while True:
-            modulation = [s + m for (s, m) in zip(next(self.source_data), next(self.mod_data))]
-            if modulate:
-                yield modulation
-            else:
-                yield [a * b for (a, b) in zip(self.source.amps, np.cos(modulation))]
-                self.state = self.source.state
+    def render(self, frames: int, out: np.ndarray, modulate: bool = False):
+        modulation = self.get_buffer('modulator', frames)
+        self.source.render(frames, out, modulate=True)
+        self.modulator.render(frames, modulation)
+        out += modulation
+        if not modulate:
+            np.cos(out, out=out)
+            out *= self.source.amps[:frames]
+            self.state = self.source.state
 
 
 class SumFilter(Filter):
@@ -95,99 +309,539 @@ class SumFilter(Filter):
     def normalise_amplitude(self):
         self.amplitude /= len(self.sources)
 
-    def data(self):
-        sources = [src.data() for src in self.sources]
-        source_data = zip(*sources)
-        amplitude = self.amplitude
-        while True:
-            data = next(source_data)
-            yield [amplitude * sum(v) for v in zip(*data)]
-            self.state = sum([source.state for source in self.sources])
+    @staticmethod
+    def mix(sources: List[Oscillator], frames: int, out: np.ndarray, source_data: np.ndarray, amplitude: float):
+        """
+        Render the sources and accumulate them in place into out: the first source is rendered directly
+        into out, the others into the source_data work buffer.
+        """
+        if not sources:
+            out.fill(0.0)
+            return
+        sources[0].render(frames, out)
+        for source in sources[1:]:
+            source.render(frames, source_data)
+            np.add(out, source_data, out=out)
+        if amplitude != 1.0: out *= amplitude
+
+    def render(self, frames: int, out: np.ndarray):
+        self.mix(self.sources, frames, out, self.get_buffer('source', frames), self.amplitude)
+        self.state = sum([source.state for source in self.sources])
+
+
+class AlgorithmFilter(Filter):
+    """
+    Runs a compiled FM algorithm (a RoutingPlan, see Routing) over a list of ADSR oscillators.
+    Each oscillator is rendered once per block into its own preallocated buffer, in the order of the plan.
+    Modulated oscillators are frequency modulated (as in FreqModulationFilter) by the sum of their parents'
+    buffers, normalised by the number of parents, and the carriers are summed into the output.
+    Silent (disabled) oscillators only update their envelope.
+    """
+    def __init__(self, oscillators: List[Oscillator], plan):
+        super().__init__(list(oscillators))
+        self.plan = plan
+        self.buffers = np.zeros((len(self.sources), blocksize), dtype=np.float32)
+
+    def __str__(self):
+        return f'Algorithm{tuple(str(s) for s in self.sources)}'
+
+    def render(self, frames: int, out: np.ndarray):
+        if self.buffers.shape[1] < frames:
+            self.buffers = np.zeros((len(self.sources), frames), dtype=np.float32)
+        modulation = self.get_buffer('modulation', frames)
+        for node, parents, silent in self.plan.steps:
+            source = self.sources[node]
+            signal = self.buffers[node, :frames]
+            if silent:
+                source.amps = source.envelope(frames)
+                signal.fill(0.0)
+            elif parents:
+                modulation[:] = self.buffers[parents[0], :frames]
+                for parent in parents[1:]:
+                    modulation += self.buffers[parent, :frames]
+                if len(parents) > 1: modulation /= len(parents)
+                source.render(frames, signal, modulate=True)
+                signal += modulation
+                np.cos(signal, out=signal)
+                signal *= source.amps[:frames]
+            else:
+                source.render(frames, signal)
+
+        carriers = self.plan.carriers
+        out[:] = self.buffers[carriers[0], :frames]
+        for carrier in carriers[1:]:
+            out += self.buffers[carrier, :frames]
+        if len(carriers) > 1: out /= len(carriers)
+        states = [self.sources[carrier].state for carrier in carriers]
+        self._state = max(states) if any(states) else IDLE
 
 
 class VoicesSumFilter(Filter):
     """
     Takes the filtered output of multiple voices as input and generates a single output from them.
+    The voices are accumulated in place into the output buffer (see SumFilter.mix).
+    Voices are added and removed through a queue of requests, which is applied at the start of each block,
+    so that the list of sources is never modified while it is being rendered. Idle voices are dropped at the
+    end of the block. The tremolo LFO and the pitch controls shared by the voices, if any, are advanced once per
+    block, before the voices are rendered.
     """
-    def __init__(self, sources: List[Oscillator] = [], amplitude: float = 1.0, normalise: bool = True):
+    def __init__(self, sources: List[Oscillator] = [], amplitude: float = 1.0, normalise: bool = True,
+                 lfo: TremoloLFO = None, pitch: PitchModulation = None):
         super().__init__(list(sources))
         self.amplitude = amplitude
+        self.lfo = lfo
+        self.pitch = pitch
         self.sources = [PopFilter(source) for source in self.sources]
+        self.requests = deque()
         if normalise: self.normalise_amplitude()
 
     def __str__(self):
         return f'Sum{tuple(str(s) for s in self.sources)}'
 
     def add_source(self, source):
-        self.sources.append(source)
-        self.generators.append(source.data())
-        self.source_data = zip(*self.generators)
+        self.requests.append((True, source))
 
     def remove_source(self, source):
-        index = self.sources.index(source)
-        self.sources.remove(source)
-        del self.generators[index]
+        self.requests.append((False, source))
 
-    def prepare_source_data(self):
-        self.generators = [src.data() for src in self.sources]
-        self.source_data = zip(*self.generators)
+    def apply_requests(self):
+        """
+        Apply the pending add/remove requests, in the order in which they were made.
+        """
+        while self.requests:
+            add, source = self.requests.popleft()
+            if add: self.sources.append(source)
+            elif source in self.sources: self.sources.remove(source)
 
     def normalise_amplitude(self):
         self.amplitude /= len(self.sources)
 
-    def data(self):
-        self.prepare_source_data()
-        while True:
-            try:
-                data = next(self.source_data)
-                yield [self.amplitude * sum(v) for v in zip(*data)]
-                for source in self.sources:
-                    if source.state == 0:
-                        self.remove_source(source)
-            except StopIteration:
-                yield [0.0 for _ in range(blocksize)]
+    def render(self, frames: int, out: np.ndarray):
+        self.apply_requests()
+        if self.lfo: self.lfo.advance(frames)
+        if self.pitch: self.pitch.advance(frames)
+        SumFilter.mix(self.sources, frames, out, self.get_buffer('source', frames), self.amplitude)
+        if any(source.state == 0 for source in self.sources):
+            self.sources = [source for source in self.sources if source.state != 0]
 
 
 class PassFilter(Filter):
     """
     Uses a butterworth filter function (from the scipy library) to change the audio
     bandwidth. Can be a lowpass or a highpass filter.
+
+    The filter coefficients are memoised in a bounded LRU cache, keyed by cutoff, filter type, order
+    and framerate, so they are only designed once rather than on every block. With sos=True the filter
+    is run as cascaded second-order sections (sosfilt), which is more stable at very low cutoffs.
+
+    If an output is given, the filter follows the cutoff of the output while it is modulated (see ModulationMatrix):
+    the filter is designed once per block, for the cutoff in the middle of the block, rounded to a grid of
+    cutoff_steps per octave (see quantize) so that the designs of a sweep stay in the cache.
     """
-    def __init__(self, source: Oscillator, cutoff: float, filter_type: str):
+    cutoff_steps = 12
+
+    def __init__(self, source: Oscillator, cutoff: float, filter_type: str, sos: bool = False, output=None):
         super().__init__([source])
         self.source = source
         self.cutoff = cutoff
         self.filter_type = filter_type
+        self.sos = sos
+        self.output = output
+        self.zi = None
+
+    @classmethod
+    def quantize(cls, cutoff: float, framerate: int = framerate) -> float:
+        """
+        Modulated cutoff, rounded to a grid of cutoff_steps per octave, within the range of the filter design.
+        """
+        octaves = np.round(np.log2(max(cutoff, 10.0)) * cls.cutoff_steps) / cls.cutoff_steps
+        return float(min(2.0 ** octaves, 0.49 * framerate))
+
+    @classmethod
+    def block_cutoff(cls, output, cutoff: float, frames: int, start: int = 0, framerate: int = framerate) -> float:
+        """
+        Cutoff of a block: the cutoff in the middle of the block, quantized, if it is modulated, or the given cutoff.
+        """
+        cutoffs = parameter_ramp(output, output, "filter_cutoff", frames, start)
+        if cutoffs is None: return cutoff
+        return cls.quantize(cutoffs[frames // 2], framerate)
 
     @staticmethod
-    def butterworth(cutoff, filter_type, order=3):
-        return butter(order, cutoff, fs=framerate, btype=filter_type, analog=False)
+    @lru_cache(maxsize=256)
+    def butterworth(cutoff, filter_type, order=3, framerate=framerate, output='ba'):
+        """
+        Returns the coefficients of a butterworth filter: (b, a) polynomials by default, or second-order
+        sections if output='sos'. The arrays are shared through the cache and must not be modified.
+        """
+        return butter(order, cutoff, fs=framerate, btype=filter_type, analog=False, output=output)
 
     @staticmethod
     def frequency_response(cutoff, filter_type, order=3):
         b, a = PassFilter.butterworth(cutoff, filter_type, order)
         return freqz(b, a, fs=framerate, worN=500)
 
+    def initial_state(self, cutoff, filter_type, order=3):
+        if self.sos:
+            return sosfilt_zi(PassFilter.butterworth(cutoff, filter_type, order, self.framerate, output='sos'))
+        return lfilter_zi(*PassFilter.butterworth(cutoff, filter_type, order, self.framerate))
+
     def butterworth_filter(self, data, cutoff, filter_type, zi, order=3):
-        b, a = PassFilter.butterworth(cutoff, filter_type, order)
+        if self.sos:
+            sos = PassFilter.butterworth(cutoff, filter_type, order, self.framerate, output='sos')
+            return sosfilt(sos, data, axis=0, zi=zi)
+        b, a = PassFilter.butterworth(cutoff, filter_type, order, self.framerate)
         y, zf = lfilter(b, a, data, axis=0, zi=zi)
         return y, zf
 
-    def data(self):
-        source = self.source.data()
-        zi = lfilter_zi(*PassFilter.butterworth(self.cutoff, self.filter_type))
-        while True:
-            filtered_data, zi = self.butterworth_filter(next(source), self.cutoff, self.filter_type, zi)
-            yield filtered_data
-            self.state = self.source.state
+    def render(self, frames: int, out: np.ndarray):
+        cutoff = self.block_cutoff(self.output, self.cutoff, frames, framerate=self.framerate)
+        if self.zi is None:
+            self.zi = self.initial_state(cutoff, self.filter_type)
+        self.source.render(frames, out)
+        out[:], self.zi = self.butterworth_filter(out, cutoff, self.filter_type, self.zi)
+        self.state = self.source.state
 
     @classmethod
-    def lowpass(cls, *args):
-        return cls(*args, filter_type="low")
+    def lowpass(cls, *args, **kwargs):
+        return cls(*args, filter_type="low", **kwargs)
 
     @classmethod
-    def highpass(cls, *args):
-        return cls(*args, filter_type="high")
+    def highpass(cls, *args, **kwargs):
+        return cls(*args, filter_type="high", **kwargs)
+
+
+class PassFilterBank:
+    """
+    Butterworth pass filter for a bank of voices (see VoiceBank).
+    Rather than running one PassFilter per voice, all voices are filtered in a single lfilter (or sosfilt)
+    call along axis 1 of a (voices, frames) block. The filter state of every voice slot is stacked in one array,
+    of shape (slots, order) for lfilter, or (sections, slots, 2) for sosfilt, from which the state of the active
+    voices is sliced before filtering and written back afterwards.
+    """
+    def __init__(self, capacity: int, sos: bool = False, order: int = 3, framerate: int = framerate):
+        self.capacity = capacity
+        self.sos = sos
+        self.order = order
+        self.framerate = framerate
+        self.zi = None
+
+    def coefficients(self, cutoff, filter_type):
+        output = 'sos' if self.sos else 'ba'
+        return PassFilter.butterworth(cutoff, filter_type, self.order, self.framerate, output=output)
+
+    def initial_state(self, coefficients):
+        """
+        Initial state of a single voice, as in PassFilter.
+        """
+        if self.sos: return sosfilt_zi(coefficients)
+        return lfilter_zi(*coefficients)
+
+    def reset(self, slot: int):
+        """
+        Reset the filter state of a voice slot, when a new voice starts in it.
+        """
+        if self.zi is None: return
+        if self.sos: self.zi[:, slot] = self.initial_zi
+        else: self.zi[slot] = self.initial_zi
+
+    def resize(self, slots: np.ndarray, capacity: int):
+        """
+        Change the number of slots, moving the filter state of the given slots to the first ones (see VoiceBank.resize).
+        """
+        self.capacity = capacity
+        if self.zi is None: return
+        zi = self.zi
+        if self.sos:
+            self.zi = np.repeat(self.initial_zi[:, None, :], capacity, axis=1)
+            self.zi[:, :len(slots)] = zi[:, slots]
+        else:
+            self.zi = np.tile(self.initial_zi, (capacity, 1))
+            self.zi[:len(slots)] = zi[slots]
+
+    def filter(self, data: np.ndarray, slots: np.ndarray, cutoff: float, filter_type: str) -> np.ndarray:
+        """
+        Filter a (voices, frames) block, whose rows are the voices in the given slots.
+        """
+        coefficients = self.coefficients(cutoff, filter_type)
+        if self.zi is None:
+            self.initial_zi = self.initial_state(coefficients)
+            if self.sos: self.zi = np.repeat(self.initial_zi[:, None, :], self.capacity, axis=1)
+            else: self.zi = np.tile(self.initial_zi, (self.capacity, 1))
+        if self.sos:
+            filtered, self.zi[:, slots] = sosfilt(coefficients, data, axis=1, zi=self.zi[:, slots])
+        else:
+            filtered, self.zi[slots] = lfilter(*coefficients, data, axis=1, zi=self.zi[slots])
+        return filtered
+
+
+class StateVariableFilterBank:
+    """
+    Modulatable filter for a bank of voices: a topology-preserving transform (trapezoidal) state-variable
+    filter, lowpass, highpass or bandpass, with 12dB/octave slopes. Unlike the butterworth filters, the cutoff
+    and the resonance can change at every sample, without designing new filters and without clicks: the state
+    of the filter (the two integrators) stays valid whatever the coefficients.
+
+    The filter is a recurrence on the state s of each voice, s[n + 1] = M[n] s[n] + u[n], which is linear in the
+    state. When the cutoff and the resonance of a voice are constant over a block, M and the ratio of u to the
+    input are constant, and the voice is filtered by lfilter, like the butterworth filters (see filter_fixed).
+    Otherwise, the block is cut into chunks of scan_frames (a power of 2), which are run side by side (see
+    filter_moving): the maps (M[n], u[n]) of each chunk are composed pairwise, in log2(scan_frames) steps, into
+    the map which carries the state from the start of the chunk to its end, the state is carried from chunk to
+    chunk, and the recurrence then steps through the samples of all the chunks of all the voices at once. A block
+    takes about log2(scan_frames) + frames / scan_frames + scan_frames array operations, rather than one per sample.
+
+    The cutoff of every voice (see cutoffs) follows the cutoff of the output, which is ramped from block to block,
+    with key tracking (in octaves per octave from keytrack_reference) and an optional filter envelope per voice
+    (any object with the values() method of a ControlSource, evaluated every control_period frames).
+    """
+    keytrack_reference = 440.0
+    scan_frames = 64
+    default_envelope = {"amount": 0.0, "attack": 0.01, "decay": 0.2, "sustain": 0.0, "release": 0.2}
+
+    def __init__(self, capacity: int, framerate: int = framerate, control_period: int = control_period):
+        self.capacity = capacity
+        self.framerate = framerate
+        self.control_period = control_period
+        self.state = np.zeros((capacity, 2))
+        self.keys = np.full(capacity, self.keytrack_reference)
+        self.envelopes = [None] * capacity
+        self.cutoff = None
+        self.resonance = None
+
+    def note_on(self, slot: int, frequency: float, envelope=None):
+        """
+        Reset the filter of a voice slot when a new voice starts in it, with the note frequency for key
+        tracking and its filter envelope.
+        """
+        self.state[slot] = 0.0
+        self.keys[slot] = frequency
+        self.envelopes[slot] = envelope
+
+    def note_off(self, slot: int):
+        if self.envelopes[slot] is not None: self.envelopes[slot].gate(False)
+
+    def resize(self, slots: np.ndarray, capacity: int):
+        """
+        Change the number of slots, moving the state of the given slots to the first ones (see VoiceBank.resize).
+        """
+        state, keys, envelopes = self.state, self.keys, self.envelopes
+        self.capacity = capacity
+        self.state = np.zeros((capacity, 2))
+        self.state[:len(slots)] = state[slots]
+        self.keys = np.full(capacity, self.keytrack_reference)
+        self.keys[:len(slots)] = keys[slots]
+        self.envelopes = [envelopes[slot] for slot in slots] + [None] * (capacity - len(slots))
+
+    @staticmethod
+    def frequency_response(cutoff, resonance, filter_type, framerate=framerate):
+        """
+        Frequency response of the filter at a fixed cutoff, which is the bilinear transform of the analog
+        state-variable filter, prewarped at the cutoff.
+        """
+        g = np.tan(np.pi * cutoff / framerate)
+        k = 1.0 / resonance
+        a = [1.0 + g * k + g * g, 2.0 * (g * g - 1.0), 1.0 - g * k + g * g]
+        if filter_type in ("low", "lowpass"): b = [g * g, 2.0 * g * g, g * g]
+        elif filter_type in ("high", "highpass"): b = [1.0, -2.0, 1.0]
+        else: b = [g * k, 0.0, -g * k]
+        return freqz(b, a, fs=framerate, worN=500)
+
+    def smooth(self, name: str, target, frames: int) -> np.ndarray:
+        """
+        Ramp of a parameter over a block, from its value at the end of the previous block to the target,
+        so that parameter changes between blocks are not heard as steps. The ramp is geometric.
+        The target can also be a ramp of one value per frame (e.g a modulated parameter), which is followed as is.
+        """
+        start = getattr(self, name)
+        if np.ndim(target):
+            setattr(self, name, float(target[-1]))
+            return target
+        setattr(self, name, target)
+        if start is None or start == target: return np.full(frames, target, dtype=np.float64)
+        return start * (target / start) ** ((ramp(frames) + 1.0) / frames)
+
+    def envelope(self, envelope, frames: int) -> np.ndarray:
+        """
+        Values of a filter envelope over a block, interpolated linearly between its control points.
+        """
+        ends = np.append(np.arange(self.control_period, frames, self.control_period), frames)
+        values = np.append(envelope.value, envelope.values(ends))
+        return np.interp(ramp(frames), np.append(0, ends), values)
+
+    def cutoffs(self, slots: np.ndarray, frames: int, cutoff, keytrack: float = 0.0,
+                envelope_amount: float = 0.0) -> np.ndarray:
+        """
+        Cutoffs of the voices in the given slots for the next block of frames, of shape (voices, frames).
+        The cutoff of the output is a value, which is smoothed, or a ramp over the block (see smooth).
+        The envelope amount is in octaves.
+        """
+        octaves = np.zeros((len(slots), 1))
+        if keytrack: octaves = octaves + keytrack * np.log2(self.keys[slots] / self.keytrack_reference)[:, None]
+        if envelope_amount:
+            envelopes = [self.envelopes[slot] for slot in slots]
+            if any(e is not None for e in envelopes):
+                octaves = octaves + np.array([envelope_amount * self.envelope(e, frames) if e is not None
+                                              else np.zeros(frames) for e in envelopes])
+        return self.smooth("cutoff", cutoff, frames) * 2.0 ** octaves
+
+    def filter(self, data: np.ndarray, slots: np.ndarray, cutoffs: np.ndarray, resonance: float,
+               filter_type: str) -> np.ndarray:
+        """
+        Filter a (voices, frames) block, whose rows are the voices in the given slots, with cutoffs of shape
+        (voices, frames) (see cutoffs). The resonance is the Q of the filter: 1/sqrt(2) is flat, higher
+        values give a resonant peak at the cutoff. Both can be arrays, e.g ramps, which broadcast to the block.
+        The voices whose cutoff and resonance are constant over the block are filtered by filter_fixed, the
+        others by filter_moving.
+        """
+        frames = data.shape[1]
+        if np.ndim(resonance) <= 1: resonance = self.smooth("resonance", resonance, frames)
+        cutoffs, resonance = np.broadcast_to(cutoffs, data.shape), np.broadcast_to(resonance, data.shape)
+        fixed = (cutoffs == cutoffs[:, :1]).all(axis=1) & (resonance == resonance[:, :1]).all(axis=1)
+        out = np.empty(data.shape, dtype=np.float32)
+        if fixed.any():
+            out[fixed] = self.filter_fixed(data[fixed], slots[fixed], cutoffs[fixed, 0], resonance[fixed, 0],
+                                           filter_type)
+        if not fixed.all():
+            moving = ~fixed
+            out[moving] = self.filter_moving(data[moving], slots[moving], cutoffs[moving], resonance[moving],
+                                             filter_type)
+        return out
+
+    def coefficients(self, cutoffs: np.ndarray, resonance: np.ndarray):
+        """
+        Coefficients k, a1, a2 and a3 of the filter, for arrays of cutoffs and resonances.
+        """
+        k = 1.0 / np.maximum(resonance, 0.05)
+        g = np.tan(np.pi / self.framerate * np.clip(cutoffs, 10.0, 0.49 * self.framerate))
+        a1 = 1.0 / (1.0 + g * (g + k))
+        a2 = g * a1
+        return k, a1, a2, g * a2
+
+    @staticmethod
+    def outputs(x, p1, p2, k, a1, a2, a3, filter_type: str):
+        """
+        Outputs of the filter, from the input and the state before each sample.
+        """
+        lowpass = a2 * p1 + (1.0 - a3) * p2 + a3 * x
+        if filter_type in ("low", "lowpass"): return lowpass
+        bandpass = a1 * p1 - a2 * p2 + a2 * x
+        if filter_type in ("high", "highpass"): return x - k * bandpass - lowpass
+        return k * bandpass
+
+    def filter_fixed(self, data: np.ndarray, slots: np.ndarray, cutoffs: np.ndarray, resonance: np.ndarray,
+                     filter_type: str) -> np.ndarray:
+        """
+        Filter the voices whose cutoff and resonance (one value per voice) are constant over the block. The
+        recurrence is then time-invariant: each component of the state is a second order IIR filter of the input
+        (see lfilter), whose initial conditions are the response to the state of the voice alone. The voices
+        with the same cutoff and resonance are filtered together.
+        """
+        k, a1, a2, a3 = self.coefficients(cutoffs, resonance)
+        m11, m12, m21, m22 = 2.0 * a1 - 1.0, -2.0 * a2, 2.0 * a2, 1.0 - 2.0 * a3
+        b1, b2 = 2.0 * a2, 2.0 * a3
+        trace, determinant = m11 + m22, m11 * m22 - m12 * m21
+        s1, s2 = self.state[slots, 0], self.state[slots, 1]
+        h1, h2 = m11 * s1 + m12 * s2, m21 * s1 + m22 * s2
+        zi1 = np.stack((h1, m11 * h1 + m12 * h2 - trace * h1), axis=1)
+        zi2 = np.stack((h2, m21 * h1 + m22 * h2 - trace * h2), axis=1)
+        # State before each sample
+        p1, p2 = np.empty(data.shape, dtype=np.float32), np.empty(data.shape, dtype=np.float32)
+        p1[:, 0], p2[:, 0] = s1, s2
+        _, groups = np.unique(np.stack((cutoffs, resonance), axis=1), axis=0, return_inverse=True)
+        for group in range(groups.max() + 1):
+            rows = np.flatnonzero(groups == group)
+            v = rows[0]
+            a = (1.0, -trace[v], determinant[v])
+            q1 = lfilter((b1[v], m12[v] * b2[v] - m22[v] * b1[v]), a, data[rows], axis=1, zi=zi1[rows])[0]
+            q2 = lfilter((b2[v], m21[v] * b1[v] - m11[v] * b2[v]), a, data[rows], axis=1, zi=zi2[rows])[0]
+            p1[rows, 1:], p2[rows, 1:] = q1[:, :-1], q2[:, :-1]
+            self.state[slots[rows], 0], self.state[slots[rows], 1] = q1[:, -1], q2[:, -1]
+        k, a1, a2, a3 = (c.astype(np.float32)[:, None] for c in (k, a1, a2, a3))
+        return self.outputs(data, p1, p2, k, a1, a2, a3, filter_type)
+
+    def filter_moving(self, data: np.ndarray, slots: np.ndarray, cutoffs: np.ndarray, resonance: np.ndarray,
+                      filter_type: str) -> np.ndarray:
+        """
+        Filter the voices whose cutoff or resonance moves over the block, with one map of the state per sample.
+        """
+        frames = data.shape[1]
+
+        # The samples are laid out as arrays of shape (scan_frames, voices, chunks), whose rows are the samples
+        # at one position in all the chunks
+        chunks = -(-frames // self.scan_frames)
+        padding = chunks * self.scan_frames - frames
+        def chunked(array):
+            array = np.broadcast_to(array, data.shape)
+            if padding: array = np.pad(array, ((0, 0), (0, padding)), mode='edge')
+            return np.ascontiguousarray(array.reshape(len(slots), chunks, self.scan_frames).transpose(2, 0, 1),
+                                        dtype=np.float32)
+        x = chunked(data)
+        k, a1, a2, a3 = self.coefficients(chunked(cutoffs), chunked(resonance))
+
+        # Affine maps of the state from each sample to the next, s -> M s + u
+        m11, m12, m21, m22 = 2.0 * a1 - 1.0, -2.0 * a2, 2.0 * a2, 1.0 - 2.0 * a3
+        u1, u2 = 2.0 * a2 * x, 2.0 * a3 * x
+
+        # First pass: the map of each chunk, composed from the maps of its samples pairwise, in log2(scan_frames)
+        # steps, which takes the state at the start of the chunk to the state at its end
+        maps = (m11, m12, m21, m22, u1, u2)
+        while len(maps[0]) > 1:
+            (b11, b12, b21, b22, c1, c2), (a11, a12, a21, a22, d1, d2) = [m[0::2] for m in maps], [m[1::2] for m in maps]
+            maps = (a11 * b11 + a12 * b21, a11 * b12 + a12 * b22, a21 * b11 + a22 * b21, a21 * b12 + a22 * b22,
+                    a11 * c1 + a12 * c2 + d1, a21 * c1 + a22 * c2 + d2)
+        p11, p12, p21, p22, f1, f2 = (m[0] for m in maps)
+
+        # State at the start of each chunk, from one chunk to the next
+        s1, s2 = np.empty((len(slots), chunks), dtype=np.float32), np.empty((len(slots), chunks), dtype=np.float32)
+        state1, state2 = self.state[slots, 0], self.state[slots, 1]
+        for chunk in range(chunks):
+            s1[:, chunk], s2[:, chunk] = state1, state2
+            state1, state2 = (p11[:, chunk] * state1 + p12[:, chunk] * state2 + f1[:, chunk],
+                              p21[:, chunk] * state1 + p22[:, chunk] * state2 + f2[:, chunk])
+
+        # Second pass: the state before each sample, from the start of its chunk
+        p1, p2 = np.empty_like(x), np.empty_like(x)
+        for n in range(self.scan_frames):
+            p1[n], p2[n] = s1, s2
+            s1, s2 = m11[n] * s1 + m12[n] * s2 + u1[n], m21[n] * s1 + m22[n] * s2 + u2[n]
+        if padding: self.state[slots] = np.stack((p1, p2))[:, frames % self.scan_frames, :, -1].T
+        else: self.state[slots] = np.stack((state1, state2), axis=1)
+
+        y = self.outputs(x, p1, p2, k, a1, a2, a3, filter_type)
+        return y.transpose(1, 2, 0).reshape(len(slots), -1)[:, :frames]
+
+
+class StateVariableFilter(Filter):
+    """
+    State-variable filter of a single voice (see StateVariableFilterBank), used by VoiceChannel. The filter
+    settings (filter_type, filter_cutoff, filter_resonance, filter_keytrack and the amount of the filter
+    envelope) are read from the output at every block, so that changes apply to the sounding voices, and the
+    cutoff and the resonance follow their ramps when they are modulated (see ModulationMatrix).
+    """
+    def __init__(self, source: Oscillator, output, frequency: float, envelope=None):
+        super().__init__([source])
+        self.source = source
+        self.output = output
+        self.bank = StateVariableFilterBank(1, self.framerate)
+        self.bank.note_on(0, frequency, envelope)
+        self.slots = np.zeros(1, dtype=np.int64)
+
+    def __str__(self):
+        return f'SVF({self.source})'
+
+    def release(self):
+        self.bank.note_off(0)
+
+    def render(self, frames: int, out: np.ndarray):
+        self.source.render(frames, out)
+        output = self.output
+        cutoff = parameter_ramp(output, output, "filter_cutoff", frames)
+        resonance = parameter_ramp(output, output, "filter_resonance", frames)
+        if cutoff is None: cutoff = output.filter_cutoff
+        if resonance is None: resonance = output.filter_resonance
+        cutoffs = self.bank.cutoffs(self.slots, frames, cutoff, output.filter_keytrack, output.filter_envelope["amount"])
+        out[:] = self.bank.filter(out[None], self.slots, cutoffs, resonance, output.filter_type)[0]
+        self.state = self.source.state
 
 
 class ADSREnvelope(Filter):
@@ -216,18 +870,43 @@ class ADSREnvelope(Filter):
     reached in a given time (attack_time), it can be shown that:
 
     rate = (1.0 / attack_time) * log(target / (max_amplitude + target))
+
+    Rather than stepping through this recurrence one sample at a time, each block is computed in closed form.
+    The recurrence y(x + 1) = y(x) * m + base has the fixed point c = base / (1 - m), hence:
+
+    y(x) = c + (y(0) - c) * m^x
+
+    which is evaluated for a whole segment with np.power. The sample at which the envelope crosses its threshold
+    (maximum amplitude for attack, sustain level for decay, zero for release) is located in the segment, and the
+    envelope switches to the next state at that exact sample, within the block.
+
+    The envelope is computed for a unit maximum amplitude (the targets are scaled accordingly, so that its shape
+    is unchanged), and multiplied by the amplitude of the oscillator, which can thus be modulated.
+    Given the output and the oscillator of the output it was copied from (target, see VoiceChannel), the envelope
+    follows the modulated parameters of that oscillator (see ModulationMatrix): amplitude, frequency (or frequency
+    ratio), waveform parameters and envelope settings. The times and the sustain level are taken at the start of
+    each block, and an envelope which sustains over a whole block follows the ramp of the sustain level.
     """ 
-    def __init__(self, source: Oscillator):
+    envelope_settings = ("attack", "decay", "sustain", "release")
+
+    def __init__(self, source: Oscillator, output=None, target=None):
         super().__init__([source])
         self.source = source
-        self.amps = [0.0 for _ in range(blocksize)]
-        self.max_amp = source.amplitude
+        self.output = output
+        self.target = target
+        self.note_frequency = None
+        self.amps = np.zeros(blocksize)
+        self.level = 0.0
+        self.amplitude = source.amplitude
+        reference = self.amplitude if self.amplitude > 0 else 1.0
+        self.max_amp = 1.0
         self.attack_t = source.envelope['attack']
         self.decay_t = source.envelope['decay']
         self.sustain_level = source.envelope['sustain'] * self.max_amp
         self.release_t = source.envelope['release']
-        self.a_target = source.envelope['a_target']
-        self.dr_target = source.envelope['dr_target']
+        self.a_target = source.envelope['a_target'] / reference
+        self.dr_target = source.envelope['dr_target'] / reference
+        self.set_multipliers()
 
     def __str__(self):
         return str(self.source)
@@ -238,93 +917,149 @@ class ADSREnvelope(Filter):
         """
         return (1.0 / (time * self.framerate)) * np.log(target / base)
 
+    def set_multipliers(self):
+        """
+        Calculate the multipliers exp(rate) and the asymptotes c of the attack and decay segments.
+        """
+        self.attack_multiplier = self.decay_multiplier = self.release_multiplier = 0.0
+        self.attack_asymptote = self.max_amp + self.a_target
+        self.decay_asymptote = self.sustain_level - self.dr_target
+        self.release_asymptote = - self.dr_target
+        if self.attack_t != 0.0:
+            self.attack_multiplier = np.exp(self.get_rate(target=self.a_target, time=self.attack_t, base=(self.max_amp + self.a_target)))
+        if self.decay_t != 0.0:
+            self.decay_multiplier = np.exp(self.get_rate(target=self.dr_target, time=self.decay_t, base=(self.max_amp - self.sustain_level + self.dr_target)))
+
     def release(self):
         """
         This method is called in Output.release_notes(). Whereas the exp(rate) can be calculated in advance
         for attack and decay, here it will only be calculated on when the envelope state is set to RELEASE,
-        based on the current value of the amplitude (self.amps[-1]).
+        based on the current value of the amplitude (self.level). A modulated release time is taken when the
+        note is released.
         """
-        self.release_multiplier = np.exp(self.get_rate(target=self.dr_target, time=self.release_t, base=(self.amps[-1] + self.dr_target)))
-        self.release_base = - self.dr_target * (1 - self.release_multiplier)
+        if self.release_t != 0.0:
+            self.release_multiplier = np.exp(self.get_rate(target=self.dr_target, time=self.release_t, base=(self.level + self.dr_target)))
         self._state = RELEASE
 
-    def data(self, modulate=False):
-        amplitude = 0.0
-        max_amp = self.max_amp
-        attack = self.attack_t
-        decay = self.decay_t
-        sustain_level = self.sustain_level
-        release = self.release_t
-        source_data = self.source.data(modulate=modulate)
-        self.release_multiplier = 0.0
-
-        # Calculate multipliers here for optimization
-        if attack != 0.0:
-            attack_multiplier = np.exp(self.get_rate(target=self.a_target, time=attack, base=(max_amp + self.a_target)))
-            attack_base = (max_amp + self.a_target) * (1 - attack_multiplier)
-        if decay != 0.0:
-            decay_multiplier = np.exp(self.get_rate(target=self.dr_target, time=decay, base=(max_amp - sustain_level + self.dr_target)))
-            decay_base = (sustain_level - self.dr_target) * (1 - decay_multiplier)
+    @staticmethod
+    def segment(level, multiplier, asymptote, frames):
+        """
+        Closed form of an exponential envelope segment starting at a given level.
+        Returns frames + 1 values, the last one being the starting level of the next block.
+        """
+        return asymptote + (level - asymptote) * np.power(multiplier, np.arange(frames + 1))
 
-        while True:
+    def modulate_settings(self, frames: int):
+        """
+        Take the envelope settings which are modulated at the start of the block. Returns the ramp of the sustain
+        level over the block, or None if it is not modulated.
+        """
+        settings = {}
+        for name in self.envelope_settings:
+            values = parameter_ramp(self.output, self.target.envelope, name, frames)
+            if values is not None: settings[name] = values
+        if not settings: return None
+        if "attack" in settings: self.attack_t = max(float(settings["attack"][0]), 0.0)
+        if "decay" in settings: self.decay_t = max(float(settings["decay"][0]), 0.0)
+        if "release" in settings: self.release_t = max(float(settings["release"][0]), 0.0)
+        sustain = settings.get("sustain")
+        if sustain is not None:
+            sustain = np.clip(sustain, 0.0, 1.0) * self.max_amp
+            self.sustain_level = float(sustain[0])
+        if settings.keys() - {"release"}:
+            release_multiplier = self.release_multiplier
+            self.set_multipliers()
+            self.release_multiplier = release_multiplier
+        return sustain
+
+    def modulated_frequency(self, frames: int):
+        """
+        Frequency of the oscillator over the block, if its frequency (fixed frequency oscillators) or its
+        frequency ratio is modulated, otherwise None.
+        """
+        if self.source.fixed_frequency: return parameter_ramp(self.output, self.target, "frequency", frames)
+        ratios = parameter_ramp(self.output, self.target, "frequency_ratio", frames)
+        if ratios is None or self.note_frequency is None: return None
+        return self.note_frequency * ratios
+
+    def envelope(self, frames: int = blocksize, sustain: np.ndarray = None) -> np.ndarray:
+        """
+        Compute the amplitude envelope for the next block of frames, switching state at the exact
+        sample at which a segment reaches its threshold. The sustain level can be given as a ramp over the block,
+        which is followed if the envelope sustains over the whole block.
+        """
+        if self.state != SUSTAIN: sustain = None
+        amps = np.zeros(frames)
+        n = 0
+        while n < frames:
             if self.state == ATTACK:
-                if attack == 0.0:
-                    amplitude = max_amp
+                if self.attack_t == 0.0:
+                    self.level = self.max_amp
                     self.state = DECAY
-                else:
-                    block = []
-                    self.amps = []
-                    for _ in range(blocksize):
-                        block.append(next(source_data))
-                        self.amps.append(amplitude)
-                        amplitude = attack_base + amplitude * attack_multiplier
-                    if modulate: yield block
-                    else: yield [a * b for (a, b) in zip(self.amps, block)]
-                    if amplitude >= max_amp: self.state = DECAY
-
-            if self.state == DECAY:
-                if decay == 0.0:
-                    amplitude = max_amp
+                    continue
+                segment = self.segment(self.level, self.attack_multiplier, self.attack_asymptote, frames - n)
+                crossed = segment[:-1] >= self.max_amp
+                next_state, next_level = DECAY, self.max_amp
+            elif self.state == DECAY:
+                if self.decay_t == 0.0:
+                    self.level = self.sustain_level
                     self.state = SUSTAIN
+                    continue
+                segment = self.segment(self.level, self.decay_multiplier, self.decay_asymptote, frames - n)
+                crossed = segment[:-1] <= self.sustain_level
+                next_state, next_level = SUSTAIN, self.sustain_level
+            elif self.state == SUSTAIN:
+                if sustain is not None:
+                    amps[:] = sustain
+                    self.sustain_level = float(sustain[-1])
                 else:
-                    block = []
-                    self.amps = []
-                    for _ in range(blocksize):
-                        block.append(next(source_data))
-                        self.amps.append(amplitude)
-                        amplitude = decay_base + amplitude * decay_multiplier
-                    if modulate: yield block
-                    else: yield [a * b for (a, b) in zip(self.amps, block)]
-                    if amplitude <= sustain_level: self.state = SUSTAIN
-
-            if self.state == SUSTAIN:
-                block = []
-                self.amps = []
-                amplitude = sustain_level
-                for _ in range(blocksize):
-                    block.append(next(source_data))
-                    self.amps.append(sustain_level)
-                if modulate: yield block
-                else: yield [a * b for (a, b) in zip(self.amps, block)]
-
-            if self.state == RELEASE:
-                if release == 0.0:
-                    self.state = IDLE
-                elif amplitude > 0:
-                    block = []
-                    self.amps = []
-                    for _ in range(blocksize):
-                        block.append(next(source_data))
-                        self.amps.append(amplitude)
-                        amplitude = self.release_base + amplitude * self.release_multiplier
-                    if modulate: yield block
-                    else: yield [a * b for (a, b) in zip(self.amps, block)]
-                else:
+                    amps[n:] = self.sustain_level
+                self.level = self.sustain_level
+                break
+            elif self.state == RELEASE:
+                if self.release_t == 0.0 or self.level <= 0:
+                    self.level = 0.0
                     self.state = IDLE
+                    continue
+                segment = self.segment(self.level, self.release_multiplier, self.release_asymptote, frames - n)
+                crossed = segment[:-1] <= 0.0
+                next_state, next_level = IDLE, 0.0
+            else:
+                self.level = 0.0
+                break
+
+            if crossed.any():
+                end = int(np.argmax(crossed))
+                amps[n:n + end] = segment[:end]
+                self.level = next_level
+                self.state = next_state
+                n += end
+            else:
+                amps[n:] = segment[:-1]
+                self.level = segment[-1]
+                n = frames
+        return amps
 
-            if self.state == IDLE:
-                self.amps = [0.0 for _ in range(blocksize)]
-                yield self.amps
+    def render(self, frames: int, out: np.ndarray, modulate: bool = False):
+        """
+        The source is pulled a whole block at a time, and multiplied by the envelope and the amplitude.
+        With modulate=True, the source phases (in radians) are passed on unchanged, and the envelope
+        is made available in self.amps for FreqModulationFilter.
+        """
+        frequency = amplitude = sustain = None
+        parameters = {}
+        if self.target is not None:
+            frequency = self.modulated_frequency(frames)
+            amplitude = parameter_ramp(self.output, self.target, "amplitude", frames)
+            sustain = self.modulate_settings(frames)
+            for name in self.source.waveform_parameters:
+                values = parameter_ramp(self.output, self.target, name, frames)
+                if values is not None: parameters[name] = values
+        phases = self.source.advance(frames, frequency)
+        self.amps = self.envelope(frames, sustain)
+        self.amps *= self.amplitude if amplitude is None else amplitude
+        if modulate: np.multiply(phases, 2.0 * np.pi, out=out)
+        else: np.multiply(self.amps, self.source.waveform(phases, self.source.increment, **parameters), out=out)
 
 
 class PopFilter(Filter):
@@ -335,25 +1070,17 @@ class PopFilter(Filter):
     def __init__(self, source: Oscillator):
         super().__init__([source])
         self.source = source
+        self.fade_frames = int(fade_in_time * framerate)
+        self.faded_frames = 0
 
     def __str__(self):
         return str(self.source)
 
-    def data(self):
-        source_data = self.source.data()
-        frame_nr = fade_in_time * framerate
-        if frame_nr > 0: increment = 1 / frame_nr
-        fade_factor = 0.0
-
-        while frame_nr > 0:
-            data = next(source_data)
-            for i, frame in enumerate(data):
-                data[i] = frame * fade_factor
-                if frame_nr > 0: 
-                    frame_nr -= 1
-                    fade_factor += increment
-            yield data
-        
-        while True:
-            yield next(source_data)
-            self.state = self.source.state
\ No newline at end of file
+    def render(self, frames: int, out: np.ndarray):
+        self.source.render(frames, out)
+        if self.faded_frames < self.fade_frames:
+            fade = (self.faded_frames + np.arange(frames)) / self.fade_frames
+            np.minimum(fade, 1.0, out=fade)
+            out *= fade
+            self.faded_frames += frames
+        self.state = self.source.state
@@ -0,0 +1,101 @@
+import os
+from bisect import bisect_left
+import pysynth.params as p
+
+
+class CallbackMetrics:
+    """
+    Timing and xrun counters for the PortAudio callback.
+    Every callback records its render time into a histogram whose buckets are fractions of the block
+    deadline (the duration of a block), and counts a deadline miss if it took longer than a block.
+    The underflow/overflow flags reported by PortAudio are counted separately, so that a slow synthesis
+    graph (deadline misses) can be told apart from a device problem (xruns with fast callbacks).
+    Recording only updates a few counters, so it is cheap enough to be done on every callback.
+    """
+    bucket_fractions = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0)
+
+    def __init__(self, blocksize: int = p.blocksize, framerate: int = p.framerate):
+        self.deadline = blocksize / framerate
+        self.buckets = [fraction * self.deadline for fraction in self.bucket_fractions]
+        self.reset()
+
+    def reset(self):
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self.callbacks = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+        self.deadline_misses = 0
+        self.underflows = 0
+        self.overflows = 0
+
+    def record(self, duration: float, status=None):
+        """
+        Record the render time of one callback, and the PortAudio status flags it was called with.
+        """
+        self.callbacks += 1
+        self.total_time += duration
+        self.last_time = duration
+        if duration > self.max_time: self.max_time = duration
+        self.histogram[bisect_left(self.buckets, duration)] += 1
+        if duration > self.deadline: self.deadline_misses += 1
+        if status:
+            if status.output_underflow: self.underflows += 1
+            if status.output_overflow: self.overflows += 1
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.callbacks if self.callbacks else 0.0
+
+    @property
+    def load(self):
+        """
+        Mean render time as a fraction of the block deadline.
+        """
+        return self.mean_time / self.deadline
+
+    def summary(self):
+        return {
+            "callbacks": self.callbacks,
+            "mean_time": self.mean_time,
+            "max_time": self.max_time,
+            "last_time": self.last_time,
+            "deadline": self.deadline,
+            "deadline_misses": self.deadline_misses,
+            "underflows": self.underflows,
+            "overflows": self.overflows,
+            "load": self.load
+        }
+
+    def to_text(self, **gauges) -> str:
+        """
+        Metrics in the Prometheus text exposition format, as read by the node exporter textfile collector.
+        Additional gauges (e.g cpu_load, voices) can be passed as keyword arguments.
+        """
+        lines = [
+            "# TYPE pysynth_callback_seconds histogram"
+        ]
+        count = 0
+        for bucket, value in zip(self.buckets, self.histogram):
+            count += value
+            lines.append(f'pysynth_callback_seconds_bucket{{le="{bucket:.6f}"}} {count}')
+        lines.append(f'pysynth_callback_seconds_bucket{{le="+Inf"}} {self.callbacks}')
+        lines.append(f'pysynth_callback_seconds_sum {self.total_time:.6f}')
+        lines.append(f'pysynth_callback_seconds_count {self.callbacks}')
+        for name in ("deadline_misses", "underflows", "overflows"):
+            lines.append(f'# TYPE pysynth_{name}_total counter')
+            lines.append(f'pysynth_{name}_total {getattr(self, name)}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE pysynth_{name} gauge')
+            lines.append(f'pysynth_{name} {value}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str, **gauges):
+        """
+        Write the metrics to a text file. The file is written next to its destination and then renamed,
+        so that readers never see a partially written file.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.to_text(**gauges))
+        os.replace(temp_path, path)
@@ -2,36 +2,71 @@ import pygame.midi as midi
 from pygame import time
 from pygame.midi import MidiException
 from threading import Thread
-from .output import VoiceChannel
+from queue import SimpleQueue
+from time import perf_counter
 
 
 class MidiEvent:
-
-    def __init__(self, midi_output):
-        self.data = midi_output[0]
+    """
+    Decoded MIDI channel message, from a [[status, data1, data2, data3], timestamp] event as read by pygame.midi.
+    If the first byte is a data byte (running status), the status of the previous message is used.
+    A note-on with velocity 0 is a note-off. Event types: "On", "Off", "Control" (control number and value),
+    "PitchBend" (bend in [-1, 1)) or None for other messages.
+    """
+    def __init__(self, midi_output, running_status: int = None):
+        data = list(midi_output[0])
         self.timestamp = midi_output[1]
-        self._event_type = self.data[0] #key press or release
-        self.note_number = self.data[1]
-        self.velocity = self.data[2]
-        self.frequency = midi.midi_to_frequency(self.note_number)    
+        if data[0] < 0x80 and running_status is not None:
+            data = [running_status] + data[:3]
+        self.data = data
+        self.status = data[0]
+        self.channel = self.status & 0x0F
+        self.note_number = data[1]
+        self.velocity = data[2]
+        self.control = self.value = None
+        self.bend = 0.0
+        kind = self.status & 0xF0
+        if kind == 0x90 and self.velocity > 0:
+            self._event_type = "On"
+        elif kind in (0x80, 0x90):
+            self._event_type = "Off"
+        elif kind == 0xB0:
+            self._event_type = "Control"
+            self.control, self.value = data[1], data[2]
+        elif kind == 0xE0:
+            self._event_type = "PitchBend"
+            self.bend = (((data[2] << 7) | data[1]) - 8192) / 8192
+        else:
+            self._event_type = None
+        self.frequency = midi.midi_to_frequency(self.note_number)
 
     @property
     def event_type(self):
-        if self._event_type == 144:
-            return "On"
-        elif self._event_type == 128:
-            return "Off"   
+        return self._event_type
 
 
 class MidiController:
+    """
+    Reads events from a MIDI input device. A reader thread drains and decodes the events of the device,
+    and hands them in batches, through a thread-safe queue, to a dispatcher thread which applies them to
+    the output (see Output.process_midi_events).
+    Event timestamps are given by the PortMidi clock, in milliseconds: clock_offset maps them onto
+    perf_counter times, so that Output can schedule the notes at the right frame of the audio stream.
+    """
+    read_size = 1024
+    min_wait = 1
+    max_wait = 20
 
     def __init__(self, output):
         midi.init()
+        self.clock_offset = perf_counter() - midi.time() / 1000
         self._midi_active = False
         self.input_devices = self.get_input_devices()
         self.default_device_id = midi.get_default_input_id()
         self.controller = None
         self.midi_thread = None
+        self.dispatch_thread = None
+        self.events = SimpleQueue()
         self.output = output
 
     @property
@@ -66,10 +101,13 @@ class MidiController:
         Changes input device and starts listening thread if midi enabled.
         Can be called from gui.
         """
+        self.close_controller()
         self.controller = self._input_device(device_id)
         if self.active:
             self.midi_thread = Thread(target=self.update_oscillators)
+            self.dispatch_thread = Thread(target=self.dispatch_events)
             self.midi_thread.start()
+            self.dispatch_thread.start()
 
     def _input_device(self, device_id: int):
         """
@@ -84,22 +122,43 @@ class MidiController:
             self.close_controller()
             return None
 
+    def event_time(self, midi_event: MidiEvent) -> float:
+        """
+        Time of a MIDI event, on the perf_counter clock.
+        """
+        return self.clock_offset + midi_event.timestamp / 1000
+
     def update_oscillators(self):
         """
-        Extract midi info from controller if active and add a new voice.
+        Reader thread: drain all the pending events of the controller at every wakeup, decode them and
+        pass them on in a single batch. The polling interval is adaptive: it is reset to min_wait as soon as
+        events arrive, and doubled at every idle wakeup, up to max_wait.
         """
+        wait = self.min_wait
+        running_status = None
         while self.active:
-            if self.controller.poll():
-                midi_event = MidiEvent(self.controller.read(1)[0])
-                if midi_event.event_type == "On":
-                    try:
-                        voice = VoiceChannel(self.output, frequency=int(midi_event.frequency))
-                        self.output.add_new_voice(voice)
-                    except AttributeError:
-                        pass
-                if midi_event.event_type == "Off":
-                    self.output.release_notes(int(midi_event.frequency))
-            time.wait(20)
+            batch = []
+            while self.controller.poll():
+                for midi_output in self.controller.read(self.read_size):
+                    midi_event = MidiEvent(midi_output, running_status)
+                    if midi_event.status < 0xF0: running_status = midi_event.status
+                    if midi_event.event_type: batch.append(midi_event)
+            if batch:
+                self.events.put(batch)
+                wait = self.min_wait
+            else:
+                wait = min(2 * wait, self.max_wait)
+            time.wait(wait)
+        self.events.put(None)
+
+    def dispatch_events(self):
+        """
+        Dispatcher thread: apply the batches of events to the output, in order.
+        """
+        while True:
+            batch = self.events.get()
+            if batch is None: return
+            self.output.process_midi_events(batch, self.event_time)
 
     def close_controller(self):
         """
@@ -108,7 +167,8 @@ class MidiController:
         if self.midi_thread:
             self.active = False
             self.midi_thread.join()
-            self.midi_thread = None
+            self.dispatch_thread.join()
+            self.midi_thread = self.dispatch_thread = None
             self.controller.close()
         
     @staticmethod
@@ -0,0 +1,256 @@
+import numpy as np
+from abc import ABC, abstractmethod
+from pysynth.params import *
+from pysynth.waveforms import Oscillator, BaseOscillator, SineWave, ramp
+from pysynth.filters import Filter
+
+
+class ControlSource(ABC):
+    """
+    Abstract control rate modulation source (LFO, envelope, MIDI controller).
+    A source is not evaluated for every sample, but at the control points of a block, i.e every control_period
+    frames (see ModulationMatrix). Its value at the current position of the stream is kept in self.value.
+    """
+    def __init__(self, framerate: int = framerate):
+        self.framerate = framerate
+        self.value = 0.0
+
+    @abstractmethod
+    def values(self, offsets: np.ndarray) -> np.ndarray:
+        """
+        Values of the source at the given frame offsets from the start of the block. The last offset is the end
+        of the block, where the source is left.
+        """
+        pass
+
+    def gate(self, on: bool):
+        """
+        Note on (on=True) or off, for the sources which follow the notes.
+        """
+        pass
+
+
+class ControlLFO(ControlSource):
+    """
+    Low frequency oscillator, in [-1, 1]. The waveform is taken from an oscillator object (a sine by default).
+    """
+    def __init__(self, frequency: float = 1.0, waveform: BaseOscillator = None, framerate: int = framerate):
+        super().__init__(framerate)
+        self.frequency = frequency
+        self.waveform = waveform or SineWave()
+        self.phase = 0.0
+        self.value = float(self.waveform.waveform(np.zeros(1))[0])
+
+    def values(self, offsets: np.ndarray) -> np.ndarray:
+        phases = self.phase + self.frequency / self.framerate * offsets
+        self.phase = phases[-1] % 1.0
+        values = self.waveform.waveform(phases)
+        self.value = values[-1]
+        return values
+
+
+class ControlEnvelope(ControlSource):
+    """
+    Linear ADSR envelope, in [0, 1], with times in seconds. The envelope is retriggered by every note on,
+    and released when no notes are held (see Output.note_on and Output.release_notes).
+    """
+    def __init__(self, attack: float = 0.01, decay: float = 0.1, sustain: float = 1.0, release: float = 0.1,
+                 framerate: int = framerate):
+        super().__init__(framerate)
+        self.attack = attack
+        self.decay = decay
+        self.sustain = sustain
+        self.release = release
+        self.state = IDLE
+        self.rate = 0.0
+
+    def gate(self, on: bool):
+        if on: self.enter(ATTACK)
+        elif self.state != IDLE: self.enter(RELEASE)
+
+    def enter(self, state: int):
+        """
+        Switch to a new state. The rate (change of level per frame) of a segment is set when it starts.
+        """
+        self.state = state
+        time, distance = {ATTACK: (self.attack, 1.0 - self.value), DECAY: (self.decay, self.value - self.sustain),
+                          RELEASE: (self.release, self.value)}.get(state, (0.0, 0.0))
+        self.rate = distance / (time * self.framerate) if time > 0 else np.inf
+
+    def step(self, frames: float):
+        """
+        Advance the envelope by a number of frames.
+        """
+        while frames > 0 and self.state in (ATTACK, DECAY, RELEASE):
+            target, next_state = {ATTACK: (1.0, DECAY), DECAY: (self.sustain, SUSTAIN), RELEASE: (0.0, IDLE)}[self.state]
+            needed = abs(target - self.value) / self.rate if self.rate > 0 else 0.0
+            if needed <= frames:
+                self.value = target
+                frames -= needed
+                self.enter(next_state)
+            else:
+                self.value += np.sign(target - self.value) * self.rate * frames
+                frames = 0
+
+    def values(self, offsets: np.ndarray) -> np.ndarray:
+        values = np.empty(len(offsets))
+        position = 0
+        for n, offset in enumerate(offsets):
+            self.step(offset - position)
+            values[n] = self.value
+            position = offset
+        return values
+
+
+class MidiControl(ControlSource):
+    """
+    Value of a MIDI controller, in [0, 1], as stored by Output.control_change. Changes of the controller are
+    ramped over a control period, which avoids zipper noise.
+    """
+    def __init__(self, output, control: int, default: float = 0.0, framerate: int = framerate):
+        super().__init__(framerate)
+        self.output = output
+        self.control = control
+        self.value = default
+
+    def values(self, offsets: np.ndarray) -> np.ndarray:
+        self.value = self.output.controls.get(self.control, self.value)
+        return np.full(len(offsets), self.value)
+
+
+class ModulationRoute:
+    """
+    Modulation of a numeric parameter (attribute `name` of `target`, or item `name` of a dict target such as the
+    envelope settings of an oscillator) by a control source. The value which is set between blocks is the base
+    of the modulation, which is either:
+        - "add": base + depth * source
+        - "multiply": base * (1 + depth * source)
+        - "octaves": base * 2 ** (depth * source), e.g for frequencies and cutoffs.
+    The modulated value is clipped to [minimum, maximum].
+    """
+    modes = ("add", "multiply", "octaves")
+
+    def __init__(self, target, name: str, source: ControlSource, depth: float = 1.0, mode: str = "add",
+                 minimum: float = None, maximum: float = None):
+        if mode not in self.modes:
+            raise ValueError(f'Unknown modulation mode {mode}, expected one of {self.modes}')
+        self.target = target
+        self.name = name
+        self.source = source
+        self.depth = depth
+        self.mode = mode
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __str__(self):
+        return f'{self.source.__class__.__name__} -> {self.target.__class__.__name__}.{self.name}'
+
+    @property
+    def key(self):
+        return (id(self.target), self.name)
+
+    def base(self):
+        """
+        Current value of the parameter, i.e the base of the modulation.
+        """
+        if isinstance(self.target, dict): return self.target[self.name]
+        return getattr(self.target, self.name)
+
+    def modulate(self, base, control: np.ndarray) -> np.ndarray:
+        if self.mode == "add": values = base + self.depth * control
+        elif self.mode == "multiply": values = base * (1.0 + self.depth * control)
+        else: values = base * 2.0 ** (self.depth * control)
+        if self.minimum is not None or self.maximum is not None:
+            values = np.clip(values, self.minimum, self.maximum)
+        return values
+
+
+class ModulationMatrix:
+    """
+    Control rate modulation. The sources are evaluated once per control period (control_period frames), and
+    every modulated parameter follows the linear interpolation of the control points: before a block is rendered,
+    one ramp of the values of each modulated parameter over the block is computed, and the audio source is then
+    rendered in a single pass. The parameters themselves are never modified: the engines read the ramps of the
+    parameters they support (see ramp), in the same way as they take per-frame cutoffs and pitch ratios, so that
+    settings made between blocks (see Commands) change the base of the modulation. Routes which act on the same
+    parameter are applied in turn, in the order in which they were added.
+
+    The routes are only modified by the audio thread, between blocks (see Output.modulate).
+    """
+    def __init__(self, control_period: int = control_period):
+        self.control_period = control_period
+        self.routes = []
+        self.ramps = {}
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add(self, route: ModulationRoute):
+        self.routes.append(route)
+
+    def remove(self, route: ModulationRoute):
+        if route in self.routes: self.routes.remove(route)
+
+    def sources(self):
+        return list({id(route.source): route.source for route in self.routes}.values())
+
+    def gate(self, on: bool):
+        for source in self.sources():
+            source.gate(on)
+
+    def ramp(self, target, name: str, start: int = 0, frames: int = None):
+        """
+        Values of a parameter over the block being rendered, from frame `start` of the block, or None if the
+        parameter is not modulated.
+        """
+        values = self.ramps.get((id(target), name))
+        if values is None: return None
+        return values[start:] if frames is None else values[start:start + frames]
+
+    def render(self, frames: int, out: np.ndarray, source: Oscillator):
+        """
+        Render a block of an audio source, with the modulated parameters.
+        """
+        if not self.routes:
+            source.render(frames, out)
+            return
+
+        # Control points, at the end of every control period, and the values of the sources
+        ends = np.append(np.arange(self.control_period, frames, self.control_period), frames)
+        points = np.append(0, ends)
+        controls = {}
+        for control_source in self.sources():
+            start = control_source.value
+            controls[id(control_source)] = np.append(start, control_source.values(ends))
+
+        values = {}
+        for route in self.routes:
+            base = values[route.key] if route.key in values else route.base()
+            values[route.key] = route.modulate(base, controls[id(route.source)])
+        positions = ramp(frames)
+        self.ramps = {key: np.interp(positions, points, value) for key, value in values.items()}
+        try:
+            source.render(frames, out)
+        finally:
+            self.ramps = {}
+
+
+class ModulatedFilter(Filter):
+    """
+    Renders an audio source (e.g a VoiceBank) through a ModulationMatrix. The frame clock of the source is
+    passed on, so that the filter can stand in for its source in AudioApi.play.
+    """
+    def __init__(self, source: Oscillator, matrix: ModulationMatrix):
+        super().__init__([source])
+        self.source = source
+        self.matrix = matrix
+
+    def __str__(self):
+        return f'Modulated({self.source})'
+
+    @property
+    def frame(self):
+        return getattr(self.source, 'frame', 0)
+
+    def render(self, frames: int, out: np.ndarray):
+        self.matrix.render(frames, out, self.source)
@@ -1,9 +1,14 @@
-from pysynth.params import blocksize, framerate
+from pysynth.params import blocksize, framerate, IDLE
 from copy import deepcopy, copy
 from pysynth.audio_api import AudioApi
-from pysynth.filters import AmpModulationFilter, FreqModulationFilter, SumFilter, PassFilter, PopFilter, VoicesSumFilter, ADSREnvelope
+from pysynth.filters import TremoloFilter, TremoloLFO, FreqModulationFilter, SumFilter, PassFilter, PopFilter, VoicesSumFilter, ADSREnvelope, \
+    StateVariableFilter, StateVariableFilterBank, PitchModulation, PitchFilter
 from pysynth.routing import Routing
+from pysynth.voices import VoiceBank, VoicePool
+from pysynth.patch import FrozenPatch
+from pysynth.allocator import VoiceAllocator
 from pysynth.waveforms import EmptyOscillator
+from pysynth.modulation import ModulationMatrix, ModulationRoute, ModulatedFilter, ControlEnvelope
 
 
 class Output:
@@ -11,22 +16,62 @@ class Output:
     Central output object for implementing the audio logic.
     Keeps a reference of all created oscillators and VoiceChannel objects.
     Sends data to PortAudio through the AudioApi object.
+
+    By default all voices are rendered together by a VoiceBank (batched=True). Otherwise each VoiceChannel
+    runs its own filter pipeline, and the voices are summed by a VoicesSumFilter.
+    render_ahead sets the number of blocks rendered ahead of the audio callback (see AudioApi).
+    If metrics_file is set, export_metrics() writes the audio metrics to it.
+    backend is the audio backend of the AudioApi, e.g "null" to run without a sound card.
+    voice_policy selects the voice stealing policy of the VoiceAllocator: "oldest", "quietest" or "releasing".
+
+    The audio graph is only modified by the audio thread: changes from the GUI and MIDI threads which affect it
+    (the list of oscillators, their parameters, envelopes and FM destinations, the routing, tremolo and filter
+    settings) are posted as commands (see Commands), and applied between two blocks.
+    Note events are posted as commands too, with the frame of the stream at which they are played: the voice
+    allocator, the voice pool and the voices are only used by the audio thread, which schedules the events
+    at their frame (see VoiceBank.schedule).
+    Parameters of the audio graph can be modulated at control rate by LFOs, envelopes and MIDI controllers
+    (see modulate and ModulationMatrix).
     """
-    def __init__(self):
-        self.audio_api = AudioApi()
+    def __init__(self, batched: bool = True, render_ahead: int = 0, metrics_file: str = None, backend="portaudio",
+                 voice_policy: str = "oldest"):
+        self.audio_api = AudioApi(render_ahead=render_ahead, backend=backend)
+        self.commands = self.audio_api.commands
+        self.metrics_file = metrics_file
+        self.batched = batched
         self.am_modulator = None
         self.filter_type = "lowpass"
         self.filter_cutoff = 18000
+        self.filter_sos = False
+        self.filter_engine = "butterworth"
+        self.filter_resonance = 2 ** -0.5
+        self.filter_keytrack = 0.0
+        self.filter_envelope = dict(StateVariableFilterBank.default_envelope)
+        self.glide_time = 0.0
+        self.vibrato_frequency = 5.0
+        self.vibrato_depth = 0.0
         self.oscillators = []
-        self.active_voices = []
-        self.max_voices = 4
+        self.allocator = VoiceAllocator(4, voice_policy, level=self.voice_level, finished=self.voice_finished)
+        self.voice_pool = VoicePool(in_use=self.allocator.__contains__)
+        self.sustain = False
+        self.sustained = []
+        self.controls = {}
+        self.pitch_bend_range = 2
+        self.modulation = ModulationMatrix()
         self.open_audio()
 
     def add_oscillator(self, oscillator, index):
         """
-        Adds an oscillator to the list, and recalculates the routing.
+        Adds an oscillator to the list, and recalculates the routing, from the audio thread.
         """
-        self.oscillators.insert(index, oscillator)
+        self.commands.post(self.oscillators.insert, index, oscillator)
+        self.route_and_filter()
+
+    def remove_oscillator(self, oscillator):
+        """
+        Removes an oscillator from the list, and recalculates the routing, from the audio thread.
+        """
+        self.commands.post(self.oscillators.remove, oscillator)
         self.route_and_filter()
 
     def get_next_oscillators(self, osc):
@@ -39,36 +84,275 @@ class Output:
 
     def set_am_modulator(self, waveform):
         """
-        This function is called when 
+        This function is called when the tremolo waveform is changed.
         """
-        self.am_modulator = waveform
+        self.commands.post(setattr, self, "am_modulator", waveform)
         self.route_and_filter()
 
-    def add_new_voice(self, voice):
+    def set_parameter(self, target, name: str, value):
         """
-        A new VoiceChannel object is created each time a key is pressed, and added to the voice list.
+        Set an attribute which is read by the audio thread, e.g the frequency of the tremolo modulator,
+        between two blocks.
         """
+        self.commands.post(setattr, target, name, value)
 
-        if len(self.active_voices) >= self.max_voices:
-            self.active_voices[-1].release_notes()
-            self.active_voices.pop()
-        self.final_output.add_source(PopFilter(voice.filtered_output))
-        self.active_voices.append(voice)
+    def set_envelope(self, oscillator, **settings):
+        """
+        Change the envelope settings of an oscillator (the oscillator.envelope dict, see ADSREnvelope) between
+        two blocks. The new settings apply to the next notes.
+        """
+        self.commands.post(oscillator.envelope.update, settings)
 
-    def release_notes(self, frequency):
+    def set_fm_destination(self, oscillator, destination, enabled: bool):
         """
-        This function is called when a key is released, and the voice channel is removed.
+        Add an oscillator to the FM destinations of another (to_oscillators), or remove it, and recalculate
+        the routing, from the audio thread.
         """
-        for voice in self.active_voices:
-            if voice.frequency == frequency: 
-                voice.release_notes()
-                index = self.active_voices.index(voice)
-                del self.active_voices[index]
+        self.commands.post(self.apply_fm_destination, oscillator, destination, enabled)
+        self.route_and_filter()
+
+    @staticmethod
+    def apply_fm_destination(oscillator, destination, enabled: bool):
+        destinations = [o for o in oscillator.to_oscillators if o is not destination]
+        oscillator.to_oscillators = destinations + [destination] if enabled else destinations
+
+    def modulated_parameters(self, target) -> tuple:
+        """
+        Names of the parameters of an object of the audio graph which the voices read from the modulation matrix:
+        filter and vibrato settings of the output, frequency and amplitude of the tremolo modulator, parameters
+        of the oscillators and their envelope settings (the oscillator.envelope dict).
+        """
+        if target is self: return ("filter_cutoff", "filter_resonance", "vibrato_frequency", "vibrato_depth")
+        if target is not None and target is self.am_modulator: return ("frequency", "amplitude")
+        for oscillator in self.oscillators:
+            if target is oscillator:
+                return ("amplitude", "frequency", "frequency_ratio") + oscillator.waveform_parameters
+            if target is oscillator.envelope: return ADSREnvelope.envelope_settings
+        return ()
+
+    def modulate(self, target, name: str, source, depth: float = 1.0, mode: str = "add", **kwargs) -> ModulationRoute:
+        """
+        Modulate a numeric parameter of an object of the audio graph (e.g self.filter_cutoff, the frequency
+        of the tremolo modulator, or the amplitude or the attack of an oscillator) at control rate
+        (see ModulationMatrix and modulated_parameters). Returns the route, for unmodulate.
+        """
+        if name not in self.modulated_parameters(target):
+            raise ValueError(f'{target.__class__.__name__}.{name} cannot be modulated')
+        route = ModulationRoute(target, name, source, depth, mode, **kwargs)
+        self.commands.post(self.modulation.add, route)
+        return route
+
+    def unmodulate(self, route: ModulationRoute):
+        self.commands.post(self.modulation.remove, route)
+
+    def set_filter(self, filter_type: str = None, cutoff: float = None, resonance: float = None,
+                   keytrack: float = None, envelope: dict = None, engine: str = None):
+        """
+        Change the settings of the pass filter: type, cutoff frequency, and for the state-variable filter
+        (filter_engine "svf"), resonance (Q), key tracking (octaves per octave) and filter envelope settings
+        (amount in octaves, attack, decay, sustain, release). With the state-variable filter, the sounding
+        voices follow the changes of cutoff and resonance, which are ramped over a block.
+        The engine is "butterworth" (the default) or "svf". With a VoiceBank, the sounding voices switch to the
+        new engine, otherwise it applies to the next notes.
+        """
+        if engine is not None: self.set_parameter(self, "filter_engine", engine)
+        if filter_type is not None: self.set_parameter(self, "filter_type", filter_type)
+        if cutoff is not None: self.set_parameter(self, "filter_cutoff", cutoff)
+        if resonance is not None: self.set_parameter(self, "filter_resonance", resonance)
+        if keytrack is not None: self.set_parameter(self, "filter_keytrack", keytrack)
+        if envelope is not None: self.set_parameter(self, "filter_envelope", {**self.filter_envelope, **envelope})
+
+    def set_vibrato(self, frequency: float = None, depth: float = None):
+        """
+        Change the frequency (Hz) and/or the depth (semitones) of the vibrato of all voices.
+        """
+        if frequency is not None: self.set_parameter(self, "vibrato_frequency", frequency)
+        if depth is not None: self.set_parameter(self, "vibrato_depth", depth)
+
+    def set_glide(self, glide_time: float):
+        """
+        Change the glide (portamento) time, in seconds, from the pitch of a note to the next one. 0 disables glide.
+        """
+        self.set_parameter(self, "glide_time", glide_time)
+
+    def note_on(self, frequency: float, time: float = None):
+        """
+        Start a new voice, at the frame of the stream which corresponds to the time of the event (perf_counter,
+        now by default, see AudioApi.frame_at). The voice is started by the audio thread (see start_note), which
+        is the only thread which uses the voice allocator and the voice pool.
+        """
+        self.commands.post(self.start_note, frequency, self.audio_api.frame_at(time))
+
+    def start_note(self, frequency: float, frame: int):
+        """
+        With a VoiceBank, the voice is taken from the voice pool, with the frozen settings of the oscillators,
+        and scheduled at the frame of the event. Otherwise, a VoiceChannel is created, with its own filter
+        pipeline, and starts at the next block.
+        """
+        if self.batched:
+            voice = self.voice_pool.acquire(FrozenPatch.freeze(self.oscillators), frequency)
+        else:
+            voice = VoiceChannel(self, frequency=frequency)
+        self.add_new_voice(voice, frame)
+        self.modulation.gate(True)
+
+    def add_new_voice(self, voice, frame: int = None):
+        """
+        A new voice is created each time a key is pressed (see note_on), and given a slot by the voice allocator.
+        If the key is already held, its previous voice is released. If all the slots are taken, the stolen voice is
+        stopped.
+        """
+        slot, released, stolen = self.allocator.note_on(voice.frequency, voice)
+        for old_voice in released:
+            self.release_voice(old_voice, frame)
+        if stolen is not None: self.stop_voice(stolen, frame)
+        if slot is None: return
+        if self.batched:
+            self.final_output.schedule(frame, voice)
+        else:
+            self.final_output.add_source(PopFilter(voice.filtered_output))
+
+    def release_voice(self, voice, frame: int = None):
+        """
+        Set a voice to its release state, at a frame of the stream with a VoiceBank (now by default),
+        otherwise at the next block.
+        """
+        if self.batched:
+            self.final_output.schedule(self.audio_api.frame_at() if frame is None else frame, voice, on=False)
+        else:
+            voice.release_notes()
+
+    def stop_voice(self, voice, frame: int = None):
+        """
+        Stop a voice which has lost its slot. With a VoiceBank, it fades out quickly at a frame of the stream
+        (now by default, see VoiceBank.stop), otherwise it is released at the next block.
+        """
+        if self.batched:
+            self.final_output.schedule_stop(self.audio_api.frame_at() if frame is None else frame, voice)
+        else:
+            voice.release_notes()
+
+    def release_notes(self, frequency, time: float = None):
+        """
+        This function is called when a key is released. The note is ended by the audio thread (see end_note).
+        """
+        self.commands.post(self.end_note, frequency, self.audio_api.frame_at(time))
+
+    def end_note(self, frequency, frame: int):
+        """
+        Release the voice of a key, which is found in the allocator's index, or hold it if the sustain pedal is down.
+        """
+        voice = self.allocator.note_off(frequency)
+        if voice is None: return
+        if self.sustain: self.sustained.append(voice)
+        else: self.release_voice(voice, frame)
+        if not self.allocator.notes: self.modulation.gate(False)
+
+    def control_change(self, control: int, value: int, time: float = None):
+        """
+        MIDI control change. The sustain pedal (64) holds the released notes until it is lifted, and
+        all notes off (123) releases all held notes: both are applied by the audio thread, as note events.
+        The values of other controllers are stored in self.controls, scaled to [0, 1].
+        """
+        if control == 64:
+            self.commands.post(self.set_sustain, value >= 64, self.audio_api.frame_at(time))
+        elif control == 123:
+            self.commands.post(self.all_notes_off, self.audio_api.frame_at(time))
+        else:
+            self.controls[control] = value / 127
+
+    def set_sustain(self, sustain: bool, frame: int):
+        self.sustain = sustain
+        if not self.sustain:
+            for voice in self.sustained: self.release_voice(voice, frame)
+            self.sustained = []
+
+    def all_notes_off(self, frame: int):
+        for frequency in list(self.allocator.notes):
+            self.end_note(frequency, frame)
+
+    def pitch_bend(self, bend: float, time: float = None):
+        """
+        MIDI pitch bend, with bend in [-1, 1] and a range of pitch_bend_range semitones. The bend applies to
+        the sounding voices, at the frame of the event with a VoiceBank, otherwise at the next block.
+        """
+        ratio = 2 ** (bend * self.pitch_bend_range / 12)
+        if self.batched:
+            self.final_output.schedule_bend(self.audio_api.frame_at(time), ratio)
+        else:
+            self.commands.post(self.final_output.pitch.set_bend, ratio)
+
+    def process_midi_events(self, events, event_time=None):
+        """
+        Apply a batch of decoded MIDI events (see MidiEvent). event_time maps an event onto its perf_counter time.
+        """
+        for event in events:
+            time = event_time(event) if event_time else None
+            if event.event_type == "On": self.note_on(event.frequency, time)
+            elif event.event_type == "Off": self.release_notes(event.frequency, time)
+            elif event.event_type == "Control": self.control_change(event.control, event.value, time)
+            elif event.event_type == "PitchBend": self.pitch_bend(event.bend, time)
+
+    @property
+    def active_voices(self):
+        """
+        Voices in the allocator's slots, held or releasing.
+        """
+        return self.allocator.voices()
+
+    @property
+    def max_voices(self):
+        return self.allocator.capacity
+
+    @max_voices.setter
+    def max_voices(self, max_voices: int):
+        self.commands.post(self.resize_voices, max_voices)
+
+    def resize_voices(self, max_voices: int):
+        """
+        Change the number of slots of the voice allocator, from the audio thread, and stop the voices which
+        no longer fit. With a VoiceBank, the bank is resized too (see bank_capacity).
+        """
+        removed = self.allocator.resize(max_voices)
+        if not self.batched:
+            for voice in removed: voice.release_notes()
+            return
+        for voice in removed:
+            self.final_output.stop(voice)
+        self.final_output.resize(self.bank_capacity(max_voices))
+
+    @staticmethod
+    def bank_capacity(max_voices: int) -> int:
+        """
+        Number of slots of the VoiceBank for max_voices voices: one for each slot of the voice allocator, and as
+        many again for the voices which fade out after they have been stolen (see VoiceBank.stop).
+        """
+        return 2 * max_voices
+
+    def voice_level(self, voice) -> float:
+        """
+        Current envelope amplitude of a voice (the loudest of its carriers).
+        """
+        if self.batched: return self.final_output.voice_level(voice)
+        return voice.level()
+
+    def voice_finished(self, voice) -> bool:
+        """
+        True once the release of a voice is over.
+        """
+        if self.batched: return voice.slot is None
+        return voice.filtered_output.state == IDLE
 
     def route_and_filter(self):
         """
-        Perform routing (creating the FM data pipeline).
+        Perform routing (creating the FM data pipeline), from the audio thread.
         """
+        self.commands.post(self.apply_routing)
+
+    def apply_routing(self):
+        if self.batched:
+            self.final_output.update_routing()
+            return
         for voice in self.active_voices:
             voice.route_and_filter()
 
@@ -76,19 +360,51 @@ class Output:
         """
         This function is called if the user picks a new FM algorithm in the gui.
         The appropriate function is obtained from an Algorithms class, which flags 
-        each oscillator with their FM 'destination' where necessary.
+        each oscillator with their FM 'destination' where necessary, from the audio thread.
         """
+        self.commands.post(self.apply_algorithm, algo)
+        self.route_and_filter()
+
+    def apply_algorithm(self, algo):
         algorithms = Algorithms(self.oscillators)
         algo_function = algorithms.algorithm_switch().get(algo)
         algo_function()
-        self.route_and_filter()
 
     def open_audio(self):
         """
         Perform routing, filtering and start playback.
         """
-        self.final_output = VoicesSumFilter(normalise=False)
-        self.audio_api.play(self.final_output)
+        if self.batched:
+            self.final_output = VoiceBank(self, capacity=self.bank_capacity(self.max_voices))
+        else:
+            self.final_output = VoicesSumFilter(normalise=False, lfo=TremoloLFO(self), pitch=PitchModulation(self))
+        self.audio_api.play(ModulatedFilter(self.final_output, self.modulation))
+
+    def voice_count(self):
+        """
+        Number of voices currently being rendered, including released voices which are still sounding.
+        """
+        if self.batched: return int(self.final_output.active.sum())
+        return len(self.final_output.sources)
+
+    def metrics(self):
+        """
+        Audio callback timing, xrun counters, DSP load and voice count.
+        """
+        metrics = self.audio_api.metrics.summary()
+        metrics["cpu_load"] = self.audio_api.cpu_load
+        metrics["render_ahead_underruns"] = self.audio_api.underruns
+        metrics["voices"] = self.voice_count()
+        return metrics
+
+    def export_metrics(self, path: str = None):
+        """
+        Write the audio metrics to a text file (see CallbackMetrics.to_text).
+        """
+        path = path or self.metrics_file
+        if path is None: return
+        self.audio_api.metrics.export(path, cpu_load=self.audio_api.cpu_load,
+                                      render_ahead_underruns=self.audio_api.underruns, voices=self.voice_count())
 
     def stop(self):
         """
@@ -96,11 +412,17 @@ class Output:
         """
         self.audio_api.stop()
 
-    def record_to_wav(self):
-        self.audio_api.recording = True
+    def close(self):
+        """
+        Stop audio playback and close the audio backend.
+        """
+        self.audio_api.close()
+
+    def record_to_wav(self, sample_format: str = "int16"):
+        self.audio_api.start_recording(sample_format=sample_format)
 
     def save_to_wav(self):
-        self.audio_api.save_to_wav()
+        return self.audio_api.save_to_wav()
 
 
 class Algorithms:
@@ -156,30 +478,36 @@ class Algorithms:
 
 class VoiceChannel:
     """
-    A VoiceChannel object is instantiated each time a key is pressed. Upon instantiation, 
-    a deep copy is made of the synth's oscillators to ensure seperate data channels for each note,
-    then the FM pipeline is generated.
+    A VoiceChannel object is instantiated each time a key is pressed, when the output does not render its voices
+    with a VoiceBank (see Output.note_on). Upon instantiation, a deep copy is made of the synth's oscillators
+    to ensure seperate data channels for each note, then the FM pipeline is generated. The envelope of each copy
+    follows the modulated parameters of the oscillator it was copied from (see ADSREnvelope).
     """
     def __init__(self, output, frequency):
+        self.output = output
         oscillators = deepcopy(output.oscillators)
-        self.oscillators = [ADSREnvelope(o) for o in oscillators]
+        self.oscillators = [ADSREnvelope(o, output, target) for o, target in zip(oscillators, output.oscillators)]
         self.am_modulator = output.am_modulator
+        self.lfo = output.final_output.lfo
+        self.pitch = output.final_output.pitch
+        self.glide_octaves = self.pitch.glide_start(frequency)
+        self.glide_time = output.glide_time
+        self.pitch_filter = None
         self.filter_type = output.filter_type
         self.filter_cutoff = output.filter_cutoff
+        self.filter_sos = output.filter_sos
+        self.filter_engine = output.filter_engine
+        self.filter_envelope = self.get_filter_envelope()
         self.set_frequency(frequency)
         self.frequency = frequency
         self.route_and_filter()
 
     def route_and_filter(self):
         """
-        Instantiate a Routing object which outputs the carrier waves after FM modulation.
-        The resulting waves are then summed.
+        Instantiate a Routing object which outputs the sum of the carrier waves after FM modulation.
         """
         routing = Routing(self.oscillators)
-        carriers = routing.get_final_output()
-        if len(carriers) > 1: 
-            output = routing.sum_signals(carriers)
-        else: output = carriers[0]
+        output = routing.get_final_output()
         self.filtered_output = self.apply_final_filters(output)
 
     def apply_final_filters(self, signal):
@@ -188,23 +516,47 @@ class VoiceChannel:
         """
         final_output = self.tremolo(signal)
         final_output = self.pass_filter(final_output)
-        return final_output
+        return self.pitch_modulation(final_output)
+
+    def pitch_modulation(self, source):
+        """
+        Apply the pitch bend, vibrato and glide to the oscillators of the voice. The progress of the glide is
+        kept when the pipeline is rebuilt.
+        """
+        previous = self.pitch_filter
+        self.pitch_filter = PitchFilter(source, [o.source for o in self.oscillators], self.pitch,
+                                        self.glide_octaves, self.glide_time)
+        if previous is not None: self.pitch_filter.elapsed = previous.elapsed
+        return self.pitch_filter
 
     def tremolo(self, source):
         """
-        Add a tremolo effect (amplitude modulation) to the audio data pipeline.
+        Add a tremolo effect (amplitude modulation) to the audio data pipeline, from the LFO shared by all voices.
         """
         if self.am_modulator:
-            return AmpModulationFilter(source=source, modulator=self.am_modulator)
+            return TremoloFilter(source=source, lfo=self.lfo)
         else:
             return source
 
+    def get_filter_envelope(self):
+        settings = dict(self.output.filter_envelope)
+        if not settings.pop("amount"): return None
+        envelope = ControlEnvelope(**settings)
+        envelope.gate(True)
+        return envelope
+
     def pass_filter(self, source):
         """
-        Add a filter (butterworth) to the audio data pipeline.
+        Add a filter (state-variable or butterworth) to the audio data pipeline.
+        The state-variable filter follows the filter settings of the output while the note is playing.
         """
-        if self.filter_type == "lowpass": return PassFilter.lowpass(source, self.filter_cutoff)
-        elif self.filter_type == "highpass": return PassFilter.highpass(source, self.filter_cutoff)
+        if self.filter_engine == "svf":
+            self.state_variable_filter = StateVariableFilter(source, self.output, self.frequency, self.filter_envelope)
+            return self.state_variable_filter
+        if self.filter_type == "lowpass":
+            return PassFilter.lowpass(source, self.filter_cutoff, sos=self.filter_sos, output=self.output)
+        elif self.filter_type == "highpass":
+            return PassFilter.highpass(source, self.filter_cutoff, sos=self.filter_sos, output=self.output)
 
     def set_frequency(self, frequency):
         """
@@ -216,10 +568,19 @@ class VoiceChannel:
             else:
                 ratio = o.source.frequency_ratio
                 o.source.frequency = frequency * ratio
+                o.note_frequency = frequency
+
+    def level(self) -> float:
+        """
+        Current envelope amplitude of the loudest carrier.
+        """
+        return max(self.oscillators[n].level * self.oscillators[n].amplitude
+                   for n in Routing(self.oscillators).get_plan().carriers)
 
     def release_notes(self):
         """
         Upon release of the note, set oscillators to decay state.
         """
         for o in self.oscillators:
-            o.release()
\ No newline at end of file
+            o.release()
+        if self.filter_engine == "svf": self.state_variable_filter.release()
\ No newline at end of file
@@ -2,6 +2,7 @@
 framerate=44100
 blocksize=2048
 fade_in_time=0.005
+control_period=64
 
 # Envelope states
 IDLE=0
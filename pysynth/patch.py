@@ -0,0 +1,196 @@
+import json
+import numpy as np
+from copy import deepcopy
+from pysynth.waveforms import SineWave, SquareWave, TriangleWave, SawtoothWave, PulseWave, WhiteNoise
+from pysynth.filters import ADSREnvelope, StateVariableFilterBank
+
+
+class Patch:
+    """
+    Synth settings, as used by Output and VoiceChannel: the oscillators (waveform, amplitude, frequency ratio,
+    envelope and FM destinations), the tremolo modulator and the pass filter settings.
+    A Patch can stand in for an Output wherever voices are created from these settings, e.g for offline rendering.
+    """
+    waveforms = {
+        "sine": SineWave,
+        "square": SquareWave,
+        "triangle": TriangleWave,
+        "sawtooth": SawtoothWave,
+        "pulse": PulseWave,
+        "noise": WhiteNoise
+    }
+
+    def __init__(self, oscillators, am_modulator=None, filter_type: str = "lowpass", filter_cutoff: float = 18000, filter_sos: bool = False,
+                 filter_engine: str = "butterworth", filter_resonance: float = 2 ** -0.5, filter_keytrack: float = 0.0,
+                 filter_envelope: dict = None, glide_time: float = 0.0, vibrato_frequency: float = 5.0,
+                 vibrato_depth: float = 0.0):
+        self.oscillators = oscillators
+        self.am_modulator = am_modulator
+        self.filter_type = filter_type
+        self.filter_cutoff = filter_cutoff
+        self.filter_sos = filter_sos
+        self.filter_engine = filter_engine
+        self.filter_resonance = filter_resonance
+        self.filter_keytrack = filter_keytrack
+        self.filter_envelope = {**StateVariableFilterBank.default_envelope, **(filter_envelope or {})}
+        self.glide_time = glide_time
+        self.vibrato_frequency = vibrato_frequency
+        self.vibrato_depth = vibrato_depth
+
+    def freeze(self):
+        return FrozenPatch.freeze(self.oscillators)
+
+    @classmethod
+    def from_output(cls, output):
+        """
+        Snapshot of the current settings of an Output object.
+        """
+        return cls(deepcopy(output.oscillators), deepcopy(output.am_modulator), output.filter_type,
+                   output.filter_cutoff, output.filter_sos, output.filter_engine, output.filter_resonance,
+                   output.filter_keytrack, output.filter_envelope, output.glide_time, output.vibrato_frequency,
+                   output.vibrato_depth)
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        """
+        Create a patch from a dictionary of the following form (all keys are optional):
+
+        {
+            "algorithm": "stack",
+            "oscillators": [{"waveform": "sine", "amplitude": 0.1, "frequency_ratio": 1.0, "fixed_frequency": false,
+                             "frequency": 440.0, "disabled": false, "to_oscillators": [1],
+                             "envelope": {"attack": 0.01, "decay": 0.1, "sustain": 0.8, "release": 0.2}}, ...],
+            "tremolo": {"waveform": "sine", "frequency": 5.0, "sensitivity": 0.5},
+            "filter": {"type": "lowpass", "cutoff": 18000, "sos": false, "engine": "butterworth", "resonance": 0.707,
+                       "keytrack": 0.0, "envelope": {"amount": 2.0, "attack": 0.01, "decay": 0.2, "sustain": 0.0,
+                                                     "release": 0.2}},
+            "pitch": {"glide": 0.0, "vibrato": {"frequency": 5.0, "depth": 0.0}}
+        }
+
+        The FM algorithm is either one of the Algorithms presets (for 4 oscillators), or given by the
+        positions of the destinations of each oscillator in "to_oscillators". By default, the patch is made
+        of 4 sine oscillators with the stack algorithm, as in the GUI. The filter engine is either "butterworth"
+        (the default) or "svf" (state-variable filter, see StateVariableFilterBank), which the resonance, key tracking
+        and filter envelope settings apply to. Pulse oscillators take a "width". The glide time is in seconds,
+        the vibrato depth in semitones.
+        """
+        from pysynth.output import Algorithms
+        oscillator_settings = settings.get("oscillators", [{} for _ in range(4)])
+        oscillators = []
+        for n, osc_settings in enumerate(oscillator_settings):
+            waveform = cls.waveforms[osc_settings.get("waveform", "sine")]
+            osc = waveform(frequency=osc_settings.get("frequency", 440.0), amplitude=osc_settings.get("amplitude", 0.1),
+                           name=osc_settings.get("name", f'Oscillator {chr(ord("A") + n)}'))
+            osc.frequency_ratio = osc_settings.get("frequency_ratio", 1.0)
+            osc.fixed_frequency = osc_settings.get("fixed_frequency", False)
+            osc.envelope.update(osc_settings.get("envelope", {}))
+            if "width" in osc_settings: osc.width = osc_settings["width"]
+            if osc_settings.get("disabled", False): osc.disable()
+            oscillators.append(osc)
+        for osc, osc_settings in zip(oscillators, oscillator_settings):
+            osc.to_oscillators = [oscillators[n] for n in osc_settings.get("to_oscillators", [])]
+
+        algorithm = settings.get("algorithm", "stack" if "oscillators" not in settings else None)
+        if algorithm is not None:
+            Algorithms(oscillators).algorithm_switch()[algorithm]()
+
+        am_modulator = None
+        if "tremolo" in settings:
+            tremolo = settings["tremolo"]
+            am_modulator = cls.waveforms[tremolo.get("waveform", "sine")]()
+            am_modulator.frequency = tremolo.get("frequency", 5.0)
+            am_modulator.amplitude = tremolo.get("sensitivity", 0.5)
+
+        filter_settings = settings.get("filter", {})
+        pitch_settings = settings.get("pitch", {})
+        vibrato = pitch_settings.get("vibrato", {})
+        return cls(oscillators, am_modulator, filter_settings.get("type", "lowpass"),
+                   filter_settings.get("cutoff", 18000), filter_settings.get("sos", False),
+                   filter_settings.get("engine", "butterworth"), filter_settings.get("resonance", 2 ** -0.5),
+                   filter_settings.get("keytrack", 0.0), filter_settings.get("envelope"),
+                   pitch_settings.get("glide", 0.0), vibrato.get("frequency", 5.0), vibrato.get("depth", 0.0))
+
+    @classmethod
+    def from_json(cls, path: str):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+class FrozenPatch:
+    """
+    Immutable snapshot of the oscillator settings which a VoiceBank copies into a voice at note-on:
+    frequency settings, amplitudes and envelope parameters, with the envelope multipliers and asymptotes computed
+    once (see ADSREnvelope, whose envelopes have a unit amplitude). Each parameter is a read-only array with one
+    value per oscillator, shared by all the voices played with the same settings, so that starting a voice only
+    copies a few arrays, instead of deep copying the oscillators.
+
+    Frozen patches are cached on the settings they are made of (see get_key): the oscillators can still be
+    edited from the GUI, and the next note-on freezes the new settings.
+    """
+    __slots__ = ('key', 'frequency', 'frequency_ratio', 'fixed_frequency', 'amplitude', 'max_amp', 'sustain_level',
+                 'attack_t', 'decay_t', 'release_t', 'dr_target', 'attack_multiplier', 'decay_multiplier',
+                 'attack_asymptote', 'decay_asymptote')
+    patches = {}
+    max_patches = 128
+
+    def __init__(self, oscillators):
+        envelopes = [ADSREnvelope(o) for o in oscillators]
+        values = {
+            "key": self.get_key(oscillators),
+            "frequency": [o.frequency for o in oscillators],
+            "frequency_ratio": [o.frequency_ratio for o in oscillators],
+            # Disabled oscillators keep their frequency, as in VoiceChannel.set_frequency
+            "fixed_frequency": [o.fixed_frequency or o.disabled for o in oscillators]
+        }
+        for name in self.__slots__[4:]:
+            values[name] = [getattr(e, name) for e in envelopes]
+        for name, value in values.items():
+            if name != "key":
+                value = np.array(value, dtype=bool if name == "fixed_frequency" else np.float64)
+                value.setflags(write=False)
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenPatch is immutable")
+
+    def __reduce__(self):
+        return (FrozenPatch.from_key, (self.key,))
+
+    def __len__(self):
+        return len(self.key)
+
+    @staticmethod
+    def get_key(oscillators):
+        return tuple((o.frequency, o.amplitude, o.frequency_ratio, o.fixed_frequency, o.disabled,
+                      tuple(o.envelope.items())) for o in oscillators)
+
+    @classmethod
+    def freeze(cls, oscillators):
+        """
+        Returns the (cached) frozen patch of the current settings of a list of oscillators.
+        """
+        key = cls.get_key(oscillators)
+        patch = cls.patches.get(key)
+        if patch is None:
+            if len(cls.patches) >= cls.max_patches: cls.patches.clear()
+            patch = cls.patches[key] = cls(oscillators)
+        return patch
+
+    @classmethod
+    def from_key(cls, key):
+        """
+        Rebuild a frozen patch from its key, e.g when it is unpickled.
+        """
+        oscillators = []
+        for frequency, amplitude, frequency_ratio, fixed_frequency, disabled, envelope in key:
+            osc = SineWave(frequency=frequency, amplitude=amplitude)
+            osc.frequency_ratio, osc.fixed_frequency, osc.disabled = frequency_ratio, fixed_frequency, disabled
+            osc.envelope = dict(envelope)
+            oscillators.append(osc)
+        return cls.freeze(oscillators)
+
+    def frequencies(self, frequency: float) -> np.ndarray:
+        """
+        Frequency of each oscillator for a note.
+        """
+        return np.where(self.fixed_frequency, self.frequency, frequency * self.frequency_ratio)
@@ -0,0 +1,145 @@
+import os
+import struct
+import time
+import numpy as np
+from datetime import datetime
+from threading import Thread
+import pysynth.params as p
+
+
+def recording_path(directory: str = 'recordings') -> str:
+    """
+    Returns the first free path of the form recordings/pysynth_<date>_<n>.wav.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    file_no = 0
+    while True:
+        filename = ''.join(['pysynth_', datetime.now().strftime("%m_%d_%Y_"), str(file_no), '.wav'])
+        filepath = os.path.join(directory, filename)
+        if not os.path.exists(filepath): return filepath
+        file_no += 1
+
+
+class WavRecorder:
+    """
+    Streams audio blocks to a WAV file from a background thread.
+    The audio callback only copies each block into a ring of preallocated blocks (write()). As in RenderAhead,
+    the ring has a single producer and a single consumer which each advance their own index, so no lock
+    is needed. The writer thread converts the blocks to the sample format and appends them to the file.
+    The WAV header is written with empty sizes when the recording starts, and patched when it is closed,
+    so the recording length is only bounded by the disk.
+
+    Sample formats: "float32", "int16" and "int24". Integer formats are dithered with triangular (TPDF)
+    noise of 1 LSB peak, unless dither is False. If the ring is full, i.e the disk cannot keep up,
+    the block is dropped and counted in dropped_blocks.
+    """
+    formats = {
+        # sample format: (WAV format tag, bytes per sample)
+        "float32": (3, 4),
+        "int16": (1, 2),
+        "int24": (1, 3)
+    }
+
+    def __init__(self, path: str = None, framerate: int = p.framerate, channels: int = 1, sample_format: str = "int16",
+                 dither: bool = True, blocksize: int = p.blocksize, depth: int = 256):
+        if sample_format not in self.formats:
+            raise ValueError(f'Unknown sample format {sample_format}, expected one of {list(self.formats)}')
+        self.path = path or recording_path()
+        self.framerate = framerate
+        self.channels = channels
+        self.sample_format = sample_format
+        self.dither = dither and sample_format != "float32"
+        self.depth = depth
+        self.blocks = np.zeros((depth, blocksize, channels), dtype=np.float32)
+        self.lengths = np.zeros(depth, dtype=np.int64)
+        self.write_index = 0
+        self.read_index = 0
+        self.dropped_blocks = 0
+        self.frames = 0
+        self.period = blocksize / framerate
+        self.file = None
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.file = open(self.path, 'wb')
+        self.write_header()
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data: np.ndarray):
+        """
+        Called from the audio callback: copy a block of shape (frames,) or (frames, channels) into the ring.
+        """
+        if self.write_index - self.read_index >= self.depth:
+            self.dropped_blocks += 1
+            return
+        slot = self.write_index % self.depth
+        frames = len(data)
+        block = self.blocks[slot, :frames]
+        block[:] = data.reshape(frames, -1)
+        self.lengths[slot] = frames
+        self.write_index += 1
+
+    def run(self):
+        """
+        Writer thread: drain the ring into the file until the recorder is closed.
+        """
+        while self.running or self.read_index < self.write_index:
+            if self.read_index < self.write_index:
+                slot = self.read_index % self.depth
+                self.file.write(self.encode(self.blocks[slot, :self.lengths[slot]]))
+                self.frames += int(self.lengths[slot])
+                self.read_index += 1
+            else:
+                time.sleep(self.period)
+
+    def encode(self, block: np.ndarray) -> bytes:
+        """
+        Convert a block of float samples to the bytes of the sample format.
+        """
+        if self.sample_format == "float32":
+            return block.astype('<f4').tobytes()
+        bits = 16 if self.sample_format == "int16" else 24
+        scale = 2 ** (bits - 1) - 1
+        data = block.astype(np.float64) * scale
+        if self.dither:
+            data += np.random.uniform(-0.5, 0.5, data.shape) + np.random.uniform(-0.5, 0.5, data.shape)
+        data = np.clip(np.round(data), -scale - 1, scale)
+        if bits == 16:
+            return data.astype('<i2').tobytes()
+        return data.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+
+    def write_header(self):
+        """
+        Write the RIFF header, with the sizes of the recorded data (0 when the recording starts).
+        Float data has an extended fmt chunk and a fact chunk, as required for non-PCM formats.
+        """
+        format_tag, sample_width = self.formats[self.sample_format]
+        data_size = self.frames * self.channels * sample_width
+        block_align = self.channels * sample_width
+        fmt = struct.pack('<HHIIHH', format_tag, self.channels, self.framerate,
+                          self.framerate * block_align, block_align, 8 * sample_width)
+        if format_tag == 3:
+            fmt += struct.pack('<H', 0)
+            extra = b'fact' + struct.pack('<II', 4, self.frames)
+        else:
+            extra = b''
+        header = b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt + extra + b'data' + struct.pack('<I', data_size)
+        self.file.seek(0)
+        self.file.write(b'RIFF' + struct.pack('<I', len(header) + data_size + (data_size & 1)) + header)
+
+    def close(self):
+        """
+        Write the remaining blocks, patch the header and close the file.
+        """
+        if not self.thread: return
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() & 1: self.file.write(b'\0')
+        self.write_header()
+        self.file.close()
@@ -0,0 +1,401 @@
+"""
+Headless offline rendering: renders a timed list of notes (or a Standard MIDI File) with a patch,
+as fast as the CPU allows, and streams the result to a WAV file.
+
+    python -m pysynth.render notes.mid -o pysynth.wav --patch patch.json
+"""
+import argparse
+import json
+import os
+import struct
+import wave
+import numpy as np
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from time import perf_counter
+from typing import List
+import pysynth.params as p
+from pysynth.patch import Patch, FrozenPatch
+from pysynth.voices import VoiceBank, Voice
+from pysynth.waveforms import BaseOscillator
+
+
+Note = namedtuple('Note', ['start', 'duration', 'frequency', 'velocity'], defaults=[127])
+Event = namedtuple('Event', ['frame', 'on', 'index'])
+
+
+def note_to_frequency(note_number: int) -> float:
+    return 440.0 * 2 ** ((note_number - 69) / 12)
+
+
+def read_note_list(path: str) -> List[Note]:
+    """
+    Read a JSON list of notes of the form {"start": 0.0, "duration": 0.5, "note": 60} (or "frequency": 261.6),
+    with start and duration in seconds, and an optional MIDI velocity ("velocity": 100, 127 by default).
+    """
+    with open(path) as f:
+        notes = json.load(f)
+    return [Note(n["start"], n["duration"], n["frequency"] if "frequency" in n else note_to_frequency(n["note"]),
+                 n.get("velocity", 127)) for n in notes]
+
+
+def read_variable_length(data: bytes, position: int):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80: return value, position
+
+
+def read_midi_file(path: str) -> List[Note]:
+    """
+    Read the notes of a Standard MIDI File (format 0 or 1), with start and duration in seconds.
+    Tempo changes are taken into account, a note-on with velocity 0 is a note-off, and overlapping notes
+    on the same key and channel are paired first in, first out.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'MThd':
+        raise ValueError(f'{path} is not a Standard MIDI File')
+    header_length, _, track_count, division = struct.unpack('>IHHh', data[4:14])
+    position = 8 + header_length
+
+    events = []
+    tempos = [(0, 500000)]
+    for _ in range(track_count):
+        chunk_type, length = struct.unpack('>4sI', data[position:position + 8])
+        position += 8
+        end = position + length
+        if chunk_type != b'MTrk':
+            position = end
+            continue
+        tick = 0
+        status = None
+        while position < end:
+            delta, position = read_variable_length(data, position)
+            tick += delta
+            if data[position] & 0x80:
+                status = data[position]
+                position += 1
+            if status == 0xFF:
+                meta_type = data[position]
+                length, position = read_variable_length(data, position + 1)
+                if meta_type == 0x51:
+                    tempos.append((tick, int.from_bytes(data[position:position + 3], 'big')))
+                position += length
+                status = None
+            elif status in (0xF0, 0xF7):
+                length, position = read_variable_length(data, position)
+                position += length
+                status = None
+            else:
+                kind, channel = status & 0xF0, status & 0x0F
+                size = 1 if kind in (0xC0, 0xD0) else 2
+                message = data[position:position + size]
+                position += size
+                if kind == 0x90 and message[1] > 0:
+                    events.append((tick, 1, channel, message[0], message[1]))
+                elif kind in (0x80, 0x90):
+                    events.append((tick, 0, channel, message[0], 0))
+        position = end
+
+    def seconds(tick):
+        if division < 0:
+            frames_per_second, ticks_per_frame = -(division >> 8), division & 0xFF
+            return tick / (frames_per_second * ticks_per_frame)
+        # Sorted on the tick only: the default tempo comes first, and is overridden by a tempo at tick 0
+        time, last_tick, tempo = 0.0, 0, 500000
+        for tempo_tick, new_tempo in sorted(tempos, key=lambda t: t[0]):
+            if tempo_tick >= tick: break
+            time += (tempo_tick - last_tick) * tempo / (division * 1e6)
+            last_tick, tempo = tempo_tick, new_tempo
+        return time + (tick - last_tick) * tempo / (division * 1e6)
+
+    notes = []
+    sounding = {}
+    for tick, on, channel, note_number, velocity in sorted(events, key=lambda e: (e[0], e[1])):
+        key = (channel, note_number)
+        if on:
+            sounding.setdefault(key, []).append((seconds(tick), velocity))
+        elif sounding.get(key):
+            start, velocity = sounding[key].pop(0)
+            notes.append(Note(start, seconds(tick) - start, note_to_frequency(note_number), velocity))
+    return sorted(notes)
+
+
+class OfflineRenderer:
+    """
+    Renders notes through the same voice engine as Output (a VoiceBank),
+    without an audio stream. Blocks are rendered one after the other as fast as possible, and note events
+    are scheduled at their exact frame (see VoiceBank.schedule). The amplitude of a voice is scaled by the
+    velocity of its note (see velocity_amplitude).
+    After the last note-off, rendering carries on until all voices are idle (at most `tail` seconds).
+    The patch can be a Patch or an Output object.
+    """
+    def __init__(self, patch, blocksize: int = p.blocksize, capacity: int = 32, tail: float = 10.0):
+        self.patch = patch
+        self.framerate = p.framerate
+        self.blocksize = blocksize
+        self.capacity = capacity
+        self.tail = tail
+
+    @staticmethod
+    def velocity_amplitude(velocity: int) -> float:
+        """
+        Amplitude of a voice for a MIDI velocity: linear, 1.0 at velocity 127.
+        """
+        return velocity / 127
+
+    def get_events(self, notes: List[Note]) -> List[Event]:
+        """
+        Note-on and note-off events sorted by frame, note-offs first at equal frames.
+        """
+        events = []
+        for n, note in enumerate(notes):
+            start = int(round(note.start * self.framerate))
+            end = max(start + 1, int(round((note.start + note.duration) * self.framerate)))
+            events += [Event(start, True, n), Event(end, False, n)]
+        return sorted(events, key=lambda e: (e.frame, e.on))
+
+    def blocks(self, notes: List[Note]):
+        """
+        Generator of rendered blocks. The same buffer is reused for every block.
+        """
+        events = self.get_events(notes)
+        max_frame = (events[-1].frame if events else 0) + int(self.tail * self.framerate)
+        yield from self.play(VoiceBank(self.patch, capacity=self.capacity), notes, events, max_frame)
+
+    def play(self, bank: VoiceBank, notes: List[Note], events: List[Event], max_frame: int):
+        """
+        Generator of the blocks rendered by a bank which plays note events, from the frame of its clock until
+        the last event, and then until all its voices are idle (at most until max_frame).
+        """
+        patch = FrozenPatch.freeze(self.patch.oscillators)
+        voices = {}
+        for event in events:
+            if event.on:
+                note = notes[event.index]
+                voices[event.index] = Voice(patch, note.frequency, self.velocity_amplitude(note.velocity))
+            bank.schedule(event.frame, voices[event.index], event.on)
+        last_frame = events[-1].frame if events else bank.frame
+        buffer = np.zeros(self.blocksize, dtype=np.float32)
+        while bank.frame < last_frame or (bank.active.any() and bank.frame < max_frame):
+            bank.render(self.blocksize, buffer)
+            yield buffer
+
+    def render(self, notes: List[Note]) -> np.ndarray:
+        """
+        Render the notes into a single array.
+        """
+        return np.concatenate([block.copy() for block in self.blocks(notes)] or [np.zeros(0, dtype=np.float32)])
+
+    def render_to_wav(self, notes: List[Note], path: str) -> int:
+        """
+        Render the notes and stream them block by block to a 16 bit WAV file.
+        Returns the number of frames written.
+        """
+        frames = 0
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(self.framerate)
+            for block in self.blocks(notes):
+                wav.writeframes((np.clip(block, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+                frames += len(block)
+        return frames
+
+
+class ParallelRenderer(OfflineRenderer):
+    """
+    Renders notes on several cores, by time segments. The notes are split where all the voices are idle: at the
+    start of a block before a note-on, when the releases of all the earlier notes are over (see segments).
+    Each segment is rendered by an ordinary VoiceBank, whose clock starts at the frame of the segment, so that
+    it is rendered on the same blocks as in OfflineRenderer (the block grid, split at the frames of the note
+    events), and whose tremolo and vibrato LFOs and glide start where those of the single bank of
+    OfflineRenderer are at that frame (see clocks). As the bank is empty at the start of a segment in both
+    cases, the voices are allocated, and stolen, in the same slots: the mix is the same as that of
+    OfflineRenderer sample for sample, except for white noise, which is drawn from a generator seeded for each
+    segment, so that it is reproducible.
+
+    The segments are spread over a pool of worker processes, which write them into a shared memory buffer, so
+    that no audio is pickled back to the parent process. The segments do not overlap, so the buffer is the mix.
+    The work can only be spread over as many processes as there are segments: a piece without rests longer
+    than the release of the patch is a single segment, which is rendered in the current process.
+    The patch must be picklable, i.e a Patch rather than an Output.
+    """
+    def __init__(self, patch, blocksize: int = p.blocksize, capacity: int = 32, tail: float = 10.0,
+                 workers: int = None, seed: int = 0):
+        super().__init__(patch, blocksize=blocksize, capacity=capacity, tail=tail)
+        self.workers = workers or os.cpu_count() or 1
+        self.seed = seed
+
+    def release_frames(self) -> int:
+        """
+        Number of frames after a note-off after which its voice is certainly freed: the longest release of the
+        oscillators, and two blocks, for the block in which the release ends and the rounding of the envelopes.
+        """
+        release = max((o.envelope["release"] for o in self.patch.oscillators), default=0.0)
+        return int(np.ceil(release * self.framerate)) + 2 * self.blocksize
+
+    def segments(self, events: List[Event]):
+        """
+        Split the events into segments which can be rendered independently, as (start frame, events) tuples.
+        A segment starts at the start of the block of its first note-on.
+        """
+        segments = []
+        release = self.release_frames()
+        sounding, idle_frame = 0, 0
+        for event in events:
+            if event.on:
+                start = event.frame - event.frame % self.blocksize
+                if not segments or (sounding == 0 and start >= idle_frame): segments.append((start, []))
+                sounding += 1
+            else:
+                sounding -= 1
+                idle_frame = max(idle_frame, event.frame + release)
+            segments[-1][1].append(event)
+        return segments
+
+    def clocks(self, notes: List[Note], events: List[Event], starts: List[int]):
+        """
+        Phases of the tremolo and vibrato LFOs, and frequency of the last note (from which the next note
+        glides), of the bank of OfflineRenderer at each of the start frames (sorted). The phases are advanced
+        on the same blocks as in OfflineRenderer, as in TremoloLFO.advance and PitchModulation.advance.
+        """
+        modulator = self.patch.am_modulator
+        frames = sorted({event.frame for event in events})
+        lfo_phase, pitch_phase, last_frequency = 0.0, 0.0, None
+        frame, index = 0, 0
+        clocks = []
+        for start in starts:
+            while frame < start:
+                end = (frame // self.blocksize + 1) * self.blocksize
+                boundary = bisect_right(frames, frame)
+                if boundary < len(frames): end = min(end, frames[boundary])
+                if modulator:
+                    _, lfo_phase = BaseOscillator.phase_block(lfo_phase, modulator.frequency / self.framerate, end - frame)
+                _, pitch_phase = BaseOscillator.phase_block(pitch_phase, self.patch.vibrato_frequency / self.framerate,
+                                                            end - frame)
+                frame = end
+            while index < len(events) and events[index].frame < start:
+                if events[index].on: last_frequency = notes[events[index].index].frequency
+                index += 1
+            clocks.append((lfo_phase, pitch_phase, last_frequency))
+        return clocks
+
+    def split(self, notes: List[Note], segments):
+        """
+        Split the segments into one group per worker, longest first (by the total duration of their notes),
+        each segment going to the least loaded worker.
+        """
+        loads = [sum(notes[event.index].duration for event in events if event.on) for _, events in segments]
+        groups = [[] for _ in range(min(self.workers, len(segments)) or 1)]
+        totals = [0.0] * len(groups)
+        for n in sorted(range(len(segments)), key=lambda n: -loads[n]):
+            worker = totals.index(min(totals))
+            groups[worker].append(n)
+            totals[worker] += loads[n]
+        return groups
+
+    def render_segments(self, notes: List[Note], segments, clocks, indices: List[int], max_frame: int,
+                        out: np.ndarray) -> List[int]:
+        """
+        Render segments into the mix, each with its own bank. Returns the frames at which they end.
+        """
+        ends = []
+        for n in indices:
+            np.random.seed((self.seed + n) % 2 ** 32)
+            start, events = segments[n]
+            bank = VoiceBank(self.patch, capacity=self.capacity)
+            bank.frame = start
+            bank.lfo.phase, bank.pitch.phase, bank.pitch.last_frequency = clocks[n]
+            for block in self.play(bank, notes, events, max_frame):
+                out[bank.frame - len(block):bank.frame] = block
+            ends.append(bank.frame)
+        return ends
+
+    def render(self, notes: List[Note]) -> np.ndarray:
+        events = self.get_events(notes)
+        if not events: return np.zeros(0, dtype=np.float32)
+        max_frame = events[-1].frame + int(self.tail * self.framerate)
+        length = -(-max_frame // self.blocksize) * self.blocksize
+        segments = self.segments(events)
+        clocks = self.clocks(notes, events, [start for start, _ in segments])
+        groups = self.split(notes, segments)
+        ends = [0] * len(segments)
+        if len(groups) == 1:
+            mix = np.zeros(length, dtype=np.float32)
+            for n, end in zip(groups[0], self.render_segments(notes, segments, clocks, groups[0], max_frame, mix)):
+                ends[n] = end
+        else:
+            memory = shared_memory.SharedMemory(create=True, size=length * 4)
+            try:
+                mix = np.ndarray(length, dtype=np.float32, buffer=memory.buf)
+                mix.fill(0.0)
+                with ProcessPoolExecutor(len(groups)) as executor:
+                    futures = [executor.submit(mix_shared, self, notes, segments, clocks, group, max_frame,
+                                               memory.name, length) for group in groups]
+                    for group, future in zip(groups, futures):
+                        for n, end in zip(group, future.result()): ends[n] = end
+                mix = mix.copy()
+            finally:
+                memory.close()
+                memory.unlink()
+        for (start, _), end in zip(segments[1:], ends):
+            if end > start:
+                raise RuntimeError(f'A segment is still sounding at frame {start}, where the next one starts')
+        return mix[:max(ends)]
+
+    def blocks(self, notes: List[Note]):
+        mix = self.render(notes)
+        for start in range(0, len(mix), self.blocksize):
+            yield mix[start:start + self.blocksize]
+
+
+def mix_shared(renderer: ParallelRenderer, notes: List[Note], segments, clocks, indices: List[int], max_frame: int,
+               name: str, length: int) -> List[int]:
+    """
+    Worker process function of ParallelRenderer: render segments into the shared memory buffer of the mix.
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        mix = np.ndarray(length, dtype=np.float32, buffer=memory.buf)
+        ends = renderer.render_segments(notes, segments, clocks, indices, max_frame, mix)
+        del mix
+        return ends
+    finally:
+        memory.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m pysynth.render', description='Render notes to a WAV file.')
+    parser.add_argument('notes', help='Standard MIDI File (.mid) or JSON note list')
+    parser.add_argument('-o', '--output', default='pysynth.wav', help='WAV file to write')
+    parser.add_argument('-p', '--patch', help='JSON patch file (see Patch.from_dict)')
+    parser.add_argument('--blocksize', type=int, default=p.blocksize)
+    parser.add_argument('--voices', type=int, default=32, help='maximum number of simultaneous voices')
+    parser.add_argument('--tail', type=float, default=10.0, help='maximum release time after the last note, in seconds')
+    parser.add_argument('-j', '--workers', type=int, default=0,
+                        help='render the notes in parallel on this number of processes (0: single process)')
+    args = parser.parse_args(args)
+
+    notes = read_midi_file(args.notes) if args.notes.lower().endswith(('.mid', '.midi')) else read_note_list(args.notes)
+    patch = Patch.from_json(args.patch) if args.patch else Patch.from_dict({})
+    if args.workers:
+        renderer = ParallelRenderer(patch, blocksize=args.blocksize, capacity=args.voices, tail=args.tail,
+                                    workers=args.workers)
+    else:
+        renderer = OfflineRenderer(patch, blocksize=args.blocksize, capacity=args.voices, tail=args.tail)
+    started = perf_counter()
+    frames = renderer.render_to_wav(notes, args.output)
+    elapsed = perf_counter() - started
+    duration = frames / renderer.framerate
+    print(f'Rendered {len(notes)} notes, {duration:.2f}s of audio to {args.output} in {elapsed:.2f}s '
+          f'({duration / elapsed if elapsed else float("inf"):.1f}x realtime)')
+
+
+if __name__ == '__main__':
+    main()
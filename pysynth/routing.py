@@ -1,88 +1,103 @@
-from copy import copy
-from collections import ChainMap
-from pysynth.filters import FreqModulationFilter, SumFilter
+from collections import namedtuple
+from pysynth.filters import AlgorithmFilter
+
+
+Step = namedtuple('Step', ['node', 'parents', 'silent'])
+
+
+class RoutingPlan:
+    """
+    Compiled FM algorithm. The oscillators are referred to by their position in the oscillator list.
+        - steps: one Step per oscillator, in topological order, i.e. every oscillator comes after the
+        oscillators which modulate it (its 'parents'). Disabled oscillators are flagged as silent.
+        - carriers: output oscillators, i.e. they do not modulate another oscillator, and are summed
+        into the final output.
+
+    For instance, stacked routing compiles to the following steps:
+
+    [Step(node=0, parents=[], silent=False), Step(node=1, parents=[0], silent=False),
+     Step(node=2, parents=[1], silent=False), Step(node=3, parents=[2], silent=False)]
+
+    with carriers [3].
+    """
+    def __init__(self, steps, carriers):
+        self.steps = steps
+        self.carriers = carriers
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return f'RoutingPlan(steps={self.steps}, carriers={self.carriers})'
+
 
 class Routing:
     """
     For a given set of oscillators, the Routing object creates the FM data pipeline.
+    The FM algorithm is compiled into a flat RoutingPlan, which only depends on the FM destinations
+    (to_oscillators) and disabled flags of the oscillators. Plans are cached on these, so that every
+    new voice, and every switch back to a previous algorithm, reuses an existing plan.
     """
+    plans = {}
+
     def __init__(self, oscillators):
         self.oscillators = oscillators
 
-    def freq_modulate(self, source, modulator):
-        return FreqModulationFilter(source=source, modulator=modulator)
-
-    def sum_signals(self, signals):
-        return SumFilter(signals)
-
     def get_carriers(self):
         """
         Returns the list of carrier oscillators in self.oscillators
         i.e. they are output oscillators and do not modulate another oscillator.
         """
-        return [o for o in self.oscillators if not o.source.to_oscillators]
+        return [self.oscillators[n] for n in self.get_plan().carriers]
 
-    def get_parents(self, node):
+    @staticmethod
+    def get_key(sources):
         """
-        For a given oscillater, get list of the nodes that modulate it.
+        Cache key of an algorithm: the FM destinations of each oscillator (as positions in the list)
+        and their disabled flag.
         """
-        parents = []
-        for o in self.oscillators:
-            for i in range(len(o.source.to_oscillators)):
-                if o.source.to_oscillators and o.source.to_oscillators[i] == node.source:
-                    parents.append(o)
-        return parents
-
-    def get_mod_tree(self, nodes):
-        """
-        Recursive method to generate a modulation tree.
-        Returns a nested dictionary where each key is an oscillator whose value
-        is a dictionary of its modulating 'parents'.
-
-        For instance, parallel routing will return a dictionary with the following form:
-
-        {<Oscillator A>: {}, <Oscillator B>: {}, <Oscillator C>: {}, <Oscillator D>: {}}
+        positions = {id(o): n for n, o in enumerate(sources)}
+        return tuple((tuple(positions.get(id(t), -1) for t in o.to_oscillators), o.disabled) for o in sources)
 
-        Stacked routing will return a dictionary with the following form:
-
-        {<Oscillator A>: {<Oscillator B>: {<Oscillator C>: {<Oscillator D>: {}}}}}
+    @classmethod
+    def compile(cls, sources):
         """
-        for n, node in enumerate(nodes):
-            node_dict = {}
-            node_dict[node] = self.get_parents(node)
-            nodes[n] = node_dict
-            if len(nodes[n][node]) > 0: 
-                self.get_mod_tree(nodes[n][node])
-            nodes[n][node] = dict(ChainMap(*nodes[n][node]))
-        return dict(ChainMap(*nodes))
-
-    def do_routing(self, tree):
+        Returns the (cached) RoutingPlan for a list of oscillators.
         """
-        Iterative function to establish the frequency modulation algorithm.
-        Recursively traverses a nested list of oscillators until it finds an oscillator
-        whose modulating 'parents' are themselves unmodulated. The signals from the parents
-        are then summed, and the node is replaced by an FM object with the node and its summed 
-        parent signals (or single parent signal) as inputs.
+        key = cls.get_key(sources)
+        plan = cls.plans.get(key)
+        if plan is None:
+            plan = cls.plans[key] = cls.topological_sort(key)
+        return plan
 
-        For instance, parallel routing will return the following object:
+    @staticmethod
+    def topological_sort(key):
+        """
+        Compile an algorithm key into a RoutingPlan, in linear time: the parents of every oscillator are
+        collected in one pass over the FM destinations, then the oscillators are sorted depth first, starting
+        from the carriers.
+        """
+        parents = [[] for _ in key]
+        for n, (targets, _) in enumerate(key):
+            for target in targets:
+                if target >= 0: parents[target].append(n)
+        carriers = [n for n, (targets, _) in enumerate(key) if not targets]
 
-        [<Oscillator D>, <Oscillator C>, <Oscillator B>, <Oscillator A>]
+        steps = []
+        visited = set()
+        def visit(node):
+            if node in visited: return
+            visited.add(node)
+            for parent in parents[node]: visit(parent)
+            steps.append(Step(node, parents[node], key[node][1]))
+        for carrier in carriers: visit(carrier)
+        return RoutingPlan(steps, carriers)
 
-        Stacked routing will return the following object:
-        
-        FreqMod(<Oscillator D>, FreqMod(<Oscillator C>, FreqMod(<Oscillator B>, <Oscillator A>)))
-        """
-        for node, parents in tree.items():
-            if len(parents.keys()) > 0:
-                self.do_routing(parents)
-                if len(parents.keys()) > 1:
-                    freq_mod = self.freq_modulate(node, SumFilter(parents.keys()))
-                else: freq_mod = self.freq_modulate(node, next(iter(parents.keys())))
-                del tree[node]
-                tree[freq_mod] = {}
-        return list(tree.keys())
+    def get_plan(self):
+        return self.compile([o.source for o in self.oscillators])
 
     def get_final_output(self):
-        carriers = self.get_carriers()
-        tree = self.get_mod_tree(carriers)
-        return self.do_routing(tree)
\ No newline at end of file
+        """
+        Returns a single filter which runs the compiled FM algorithm over the oscillators.
+        """
+        return AlgorithmFilter(self.oscillators, self.get_plan())
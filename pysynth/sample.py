@@ -1,25 +1,54 @@
-import os
 import numpy as np
 import pysynth.params as p
 from typing import List
 from pysynth.waveforms import Oscillator
+from pysynth.recorder import recording_path
 from scipy.io.wavfile import write
-from datetime import datetime
 
 
 class AudioSample:
+    """
+    Audio data stored in a list of preallocated float32 chunks of shape (chunk_frames, channels).
+    Appending data fills the free space of the last chunk and allocates new chunks as needed, so that
+    appending is O(1) amortized and the existing data is never copied.
+
+    Slicing a sample (sample[start:stop]) returns a new sample whose chunks are views of the chunks
+    of the original sample, without copying the audio data. The frames property returns the data as a
+    single array, which is a view if the data is held in a single chunk.
+    """
+    chunk_frames = 2 ** 16
 
     def __init__(self, name: str, framerate: int = p.framerate, channels: int = 1):
         self.name = name
         self._framerate = framerate
-        self._frames = []
         self._channels = channels
+        self._chunks = []
+        self._length = 0
+        self._free = 0
 
     def __len__(self):
         """
         Returns the total number of frames in the sample.
         """
-        return len(self._frames)
+        return self._length
+
+    def __getitem__(self, index):
+        """
+        Zero-copy slice of the sample, e.g sample[framerate:2 * framerate] for the second second.
+        """
+        if not isinstance(index, slice):
+            raise TypeError("AudioSample indices must be slices")
+        start, stop, step = index.indices(self._length)
+        if step != 1:
+            raise ValueError("AudioSample slices must be contiguous")
+        view = AudioSample(self.name, self.framerate, self.channels)
+        position = 0
+        for chunk in self.chunks():
+            chunk_start, chunk_stop = max(start - position, 0), min(stop - position, len(chunk))
+            if chunk_start < chunk_stop: view._chunks.append(chunk[chunk_start:chunk_stop])
+            position += len(chunk)
+        view._length = max(stop - start, 0)
+        return view
 
     @property
     def framerate(self):
@@ -30,52 +59,84 @@ class AudioSample:
         return self._channels
 
     @property
-    def frames(self):
-        return self._frames
+    def duration(self):
+        return self._length / self._framerate
+
+    def chunks(self):
+        """
+        Views of the used part of each chunk, of shape (frames, channels).
+        """
+        for chunk in self._chunks[:-1]:
+            yield chunk
+        if self._chunks:
+            yield self._chunks[-1][:len(self._chunks[-1]) - self._free]
+
+    @property
+    def frames(self) -> np.ndarray:
+        """
+        Audio data of shape (frames,) for mono samples, or (frames, channels).
+        Chunks are merged into a single one first, if needed.
+        """
+        if len(self._chunks) > 1:
+            self._chunks = [np.concatenate(list(self.chunks()))]
+            self._free = 0
+        data = next(self.chunks(), np.zeros((0, self.channels), dtype=np.float32))
+        return data[:, 0] if self.channels == 1 else data
+
+    def reserve(self, frames: int) -> np.ndarray:
+        """
+        Returns a writable view of the next `frames` frames of the sample, which are added to the sample.
+        The frames are allocated in the last chunk, or in a new chunk if they do not fit.
+        """
+        if frames > self._free:
+            if self._chunks:
+                self._chunks[-1] = self._chunks[-1][:len(self._chunks[-1]) - self._free]
+            self._chunks.append(np.zeros((max(frames, self.chunk_frames), self.channels), dtype=np.float32))
+            self._free = len(self._chunks[-1])
+        chunk = self._chunks[-1]
+        start = len(chunk) - self._free
+        self._free -= frames
+        self._length += frames
+        return chunk[start:start + frames]
+
+    def append(self, data: np.ndarray):
+        """
+        Copy audio data of shape (frames,) or (frames, channels) at the end of the sample.
+        """
+        data = np.asarray(data, dtype=np.float32)
+        if data.ndim < 2: data = data.reshape(-1, 1)
+        assert(data.shape[1] in (1, self.channels))
+        if len(data) == 0: return
+        self.reserve(len(data))[:] = data
 
     def join(self, other):
         assert(self.framerate == other.framerate)
-        self._frames += other._frames
+        for chunk in other.chunks():
+            self.append(chunk)
 
     @classmethod
     def from_array(cls, array: List[float], framerate: int = p.framerate, name: str = ""):
         """
-        Generate an audio sample from an array of audio data.
+        Generate an audio sample from an array of audio data, of shape (frames,) or (frames, channels).
         """
-        sample = cls(name=name, framerate=framerate, channels=1)
-        sample._frames += array
+        array = np.asarray(array, dtype=np.float32)
+        sample = cls(name=name, framerate=framerate, channels=1 if array.ndim < 2 else array.shape[1])
+        sample.append(array)
         return sample
 
     @classmethod
     def from_oscillator(cls, osc: Oscillator, duration: float):
         """
         Generate an audio sample of a given duration from an oscillator object.
+        The oscillator renders directly into the chunks of the sample, one chunk at a time.
         """
         sample = cls(name=osc.__class__.__name__, framerate=osc.framerate, channels=1)
-
-        block_gen = osc.data()
         total_frames = int(duration * osc.framerate)
-        num_blocks, last_block = divmod(total_frames, p.blocksize)
-        
-        if last_block > 0: num_blocks +=1
-        
-        if num_blocks > 0:
-            for block in block_gen:
-                num_blocks -= 1
-                if num_blocks == 0: block = block[:last_block]
-                sample.join(AudioSample.from_array(block, osc.framerate))
-                if num_blocks == 0: break
-
+        while total_frames > 0:
+            frames = min(total_frames, cls.chunk_frames)
+            osc.render(frames, sample.reserve(frames)[:, 0])
+            total_frames -= frames
         return sample
 
     def save_to_wav(self):
-        if not os.path.exists('recordings'):
-            os.makedirs('recordings')
-        file_no = 0
-        filename = ''.join(['pysynth_', datetime.now().strftime("%m_%d_%Y_"), str(file_no), '.wav'])
-        filepath = os.path.join('recordings', filename)
-        while os.path.exists(filepath):
-            file_no += 1
-            filename = ''.join(['pysynth_', datetime.now().strftime("%m_%d_%Y_"), str(file_no), '.wav'])
-            filepath = os.path.join('recordings', filename)
-        write(filepath, self.framerate, np.asarray(self._frames))
\ No newline at end of file
+        write(recording_path(), self.framerate, self.frames)
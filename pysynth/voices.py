@@ -0,0 +1,583 @@
+import heapq
+import numpy as np
+from collections import deque
+from pysynth.params import *
+from pysynth.waveforms import Oscillator, ramp
+from pysynth.filters import PassFilter, PassFilterBank, StateVariableFilterBank, TremoloLFO, PitchModulation, ADSREnvelope, \
+    parameter_ramp
+from pysynth.modulation import ControlEnvelope
+from pysynth.routing import Routing
+
+
+PENDING = -1
+
+
+class Voice:
+    """
+    A note played by a VoiceBank: the frozen settings it was started with, its frequency, its amplitude (e.g from
+    the velocity of the note, 1.0 by default), and the slot of the
+    bank it is rendered in (PENDING while its note-on is scheduled, None once it is finished). The state of the voice (phases, envelope stages and
+    levels, filter state) is held by the bank, in the columns of its state arrays at that slot.
+    """
+    __slots__ = ('patch', 'frequency', 'amplitude', 'slot')
+
+    def __init__(self, patch=None, frequency: float = 0.0, amplitude: float = 1.0):
+        self.patch = patch
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.slot = None
+
+    def __repr__(self):
+        return f'Voice(frequency={self.frequency}, slot={self.slot})'
+
+
+class VoicePool:
+    """
+    Pre-warmed pool of Voice objects, so that no object is created at note-on.
+    A voice is reused once it is finished in the bank and no longer referenced elsewhere (the `in_use` function,
+    e.g membership of a VoiceAllocator). If all the voices are in use, the pool grows.
+    """
+    def __init__(self, size: int = 64, in_use=None):
+        self.voices = [Voice() for _ in range(size)]
+        self.in_use = in_use or (lambda voice: False)
+        self.next = 0
+
+    def acquire(self, patch, frequency: float, amplitude: float = 1.0) -> Voice:
+        for _ in range(len(self.voices)):
+            voice = self.voices[self.next]
+            self.next = (self.next + 1) % len(self.voices)
+            if voice.slot is None and not self.in_use(voice): break
+        else:
+            voice = Voice()
+            self.voices.append(voice)
+        voice.patch = patch
+        voice.frequency = frequency
+        voice.amplitude = amplitude
+        return voice
+
+
+class VoiceBank(Oscillator):
+    """
+    Batched voice engine.
+    All the voices of a patch share the same FM topology, so rather than running a separate filter pipeline for
+    each VoiceChannel, the state of every voice (frequency, phase and envelope of each oscillator) is kept in arrays
+    of shape (oscillators, voices). Each stage of the pipeline (envelopes, FM, sums, tremolo, pass filter and fade-in)
+    is then computed for all voices at once, on blocks of shape (voices, frames). The tremolo is rendered once per
+    block by a single LFO (see TremoloLFO), and multiplied into all the voices. Pitch bend, vibrato and glide
+    (see PitchModulation) give per-frame phase increments, which are integrated with a cumulative sum.
+
+    Every voice occupies one of a fixed number of slots in the bank (see resize). The slot is freed once all the
+    carriers of the voice are idle, i.e. once the release of the note is over, or once a stopped voice has faded
+    out (see stop). Voices are started from the frozen settings of the patch (see FrozenPatch and Voice).
+
+    The parameters which are modulated by the modulation matrix of the output (see ModulationMatrix) are read as
+    ramps over each block, rather than from the frozen settings: the amplitude, frequency (fixed frequency
+    oscillators) or frequency ratio, and waveform parameters of the oscillators, their envelope settings
+    (see modulate_envelopes), the tremolo and vibrato settings, and the cutoff and resonance of the filter.
+
+    Note events can be scheduled at a given frame of the bank's clock (the number of frames it has rendered):
+    they are queued by the control thread, and applied by render() at their exact frame, the block being split
+    at every event which falls inside it. Events which are late are applied at the start of the block.
+    """
+    slot_arrays = ('active', 'stopping', 'started', 'faded_frames', 'voice_amplitude', 'note_frequency', 'glide_octaves',
+                   'glide_elapsed', 'glide_frames', 'frequency', 'phase', 'stage', 'level', 'amplitude', 'max_amp',
+                   'sustain_level', 'attack_t', 'decay_t', 'release_t', 'dr_target', 'attack_multiplier',
+                   'decay_multiplier', 'release_multiplier', 'attack_asymptote', 'decay_asymptote', 'bendable')
+
+    def __init__(self, output, capacity: int = 32):
+        super().__init__(framerate)
+        self.output = output
+        self.capacity = capacity
+        self.voices = [None] * capacity
+        self.active = np.zeros(capacity, dtype=bool)
+        self.stopping = np.zeros(capacity, dtype=bool)
+        self.started = np.zeros(capacity, dtype=np.int64)
+        self.note_count = 0
+        self.faded_frames = np.zeros(capacity, dtype=np.int64)
+        self.voice_amplitude = np.ones(capacity, dtype=np.float32)
+        self.note_frequency = np.zeros(capacity)
+        self.fade_frames = int(fade_in_time * framerate)
+        self.lfo = TremoloLFO(output)
+        self.pass_filter = PassFilterBank(capacity, sos=output.filter_sos)
+        self.svf = StateVariableFilterBank(capacity)
+        self.pitch = PitchModulation(output)
+        self.glide_octaves = np.zeros(capacity)
+        self.glide_elapsed = np.zeros(capacity, dtype=np.int64)
+        self.glide_frames = np.ones(capacity, dtype=np.int64)
+        self.frame = 0
+        self.position = 0
+        self.events = deque()
+        self.scheduled = []
+        self.event_count = 0
+        self.oscillator_count = None
+        self.update_routing()
+
+    def __str__(self):
+        return f'VoiceBank({np.count_nonzero(self.active)}/{self.capacity})'
+
+    def allocate_state(self, oscillator_count: int):
+        """
+        Allocate the per-oscillator, per-voice state arrays.
+        """
+        shape = (oscillator_count, self.capacity)
+        self.oscillator_count = oscillator_count
+        self.frequency = np.zeros(shape)
+        self.phase = np.zeros(shape)
+        self.stage = np.full(shape, IDLE)
+        self.level = np.zeros(shape)
+        self.amplitude = np.zeros(shape)
+        self.max_amp = np.zeros(shape)
+        self.sustain_level = np.zeros(shape)
+        self.attack_t = np.zeros(shape)
+        self.decay_t = np.zeros(shape)
+        self.release_t = np.zeros(shape)
+        self.dr_target = np.zeros(shape)
+        self.attack_multiplier = np.zeros(shape)
+        self.decay_multiplier = np.zeros(shape)
+        self.release_multiplier = np.zeros(shape)
+        self.attack_asymptote = np.zeros(shape)
+        self.decay_asymptote = np.zeros(shape)
+        self.bendable = np.zeros(shape, dtype=bool)
+        self.active[:] = False
+        for voice in getattr(self, 'voices', []):
+            if voice is not None: voice.slot = None
+        self.voices = [None] * self.capacity
+
+    def update_routing(self):
+        """
+        Get the compiled FM algorithm of the patch (see Routing), and a snapshot of the list of oscillators,
+        which is used until the routing is updated again.
+        """
+        oscillators = self.oscillators = list(self.output.oscillators)
+        if len(oscillators) != self.oscillator_count:
+            self.allocate_state(len(oscillators))
+        self.plan = Routing.compile(oscillators)
+        self.carriers = self.plan.carriers
+
+    def free_slot(self) -> int:
+        """
+        Returns the first free slot in the bank. If the bank is full, the oldest voice is cut, the oldest of the
+        voices which are being stopped if there are any.
+        """
+        free = np.flatnonzero(~self.active)
+        if len(free) > 0: return int(free[0])
+        slots = np.flatnonzero(self.stopping)
+        if len(slots) == 0: slots = np.arange(self.capacity)
+        return int(slots[np.argmin(self.started[slots])])
+
+    def resize(self, capacity: int):
+        """
+        Change the number of slots. The sounding voices are moved to the first slots, with their state. If they
+        do not all fit, the voices which are being stopped are cut first, then the oldest ones.
+        """
+        slots = np.flatnonzero(self.active)
+        order = sorted(slots, key=lambda slot: (not self.stopping[slot], self.started[slot]))
+        cut = max(len(slots) - capacity, 0)
+        for slot in order[:cut]:
+            self.voices[slot].slot = None
+        keep = np.sort(np.array(order[cut:], dtype=np.int64))
+        for name in self.slot_arrays:
+            array = getattr(self, name)
+            resized = np.zeros(array.shape[:-1] + (capacity,), dtype=array.dtype)
+            resized[..., :len(keep)] = array[..., keep]
+            setattr(self, name, resized)
+        voices = [self.voices[slot] for slot in keep]
+        for slot, voice in enumerate(voices):
+            voice.slot = slot
+        self.voices = voices + [None] * (capacity - len(voices))
+        self.pass_filter.resize(keep, capacity)
+        self.svf.resize(keep, capacity)
+        self.capacity = capacity
+
+    def note_on(self, voice: Voice) -> int:
+        """
+        Start a voice in a free slot. The frequencies, amplitudes and envelope parameters of the oscillators are
+        copied from the frozen patch of the voice into the bank.
+        """
+        slot = self.free_slot()
+        if self.voices[slot] is not None: self.voices[slot].slot = None
+        patch = voice.patch
+        self.frequency[:, slot] = patch.frequencies(voice.frequency)
+        self.phase[:, slot] = 0.0
+        self.stage[:, slot] = ATTACK
+        self.level[:, slot] = 0.0
+        self.amplitude[:, slot] = patch.amplitude
+        self.max_amp[:, slot] = patch.max_amp
+        self.sustain_level[:, slot] = patch.sustain_level
+        self.attack_t[:, slot] = patch.attack_t
+        self.decay_t[:, slot] = patch.decay_t
+        self.release_t[:, slot] = patch.release_t
+        self.dr_target[:, slot] = patch.dr_target
+        self.attack_multiplier[:, slot] = patch.attack_multiplier
+        self.decay_multiplier[:, slot] = patch.decay_multiplier
+        self.attack_asymptote[:, slot] = patch.attack_asymptote
+        self.decay_asymptote[:, slot] = patch.decay_asymptote
+        self.bendable[:, slot] = ~patch.fixed_frequency
+        self.faded_frames[slot] = 0
+        self.stopping[slot] = False
+        self.voice_amplitude[slot] = voice.amplitude
+        self.note_frequency[slot] = voice.frequency
+        self.glide_octaves[slot] = self.pitch.glide_start(voice.frequency)
+        self.glide_elapsed[slot] = 0
+        self.glide_frames[slot] = max(1, int(self.output.glide_time * self.framerate))
+        self.pass_filter.reset(slot)
+        self.svf.note_on(slot, voice.frequency, self.filter_envelope())
+        self.note_count += 1
+        self.started[slot] = self.note_count
+        self.voices[slot] = voice
+        voice.slot = slot
+        self.active[slot] = True
+        return slot
+
+    def note_off(self, voice: Voice):
+        """
+        Set all oscillators of a voice to the release state. As in ADSREnvelope.release(), the release
+        multiplier is calculated from the current amplitude of each envelope.
+        """
+        slot = voice.slot
+        if slot is None or slot == PENDING or self.voices[slot] is not voice: return
+        release_t = self.release_t[:, slot]
+        releasing = release_t != 0.0
+        base = self.level[releasing, slot] + self.dr_target[releasing, slot]
+        rate = (1.0 / (release_t[releasing] * self.framerate)) * np.log(self.dr_target[releasing, slot] / base)
+        self.release_multiplier[releasing, slot] = np.exp(rate)
+        self.stage[:, slot] = RELEASE
+        self.svf.note_off(slot)
+
+    def stop(self, voice: Voice):
+        """
+        Stop a voice quickly, e.g when it is stolen: all its oscillators are released over the fade-in time,
+        whatever their release time, and the slot is freed once it has faded out. Until then, it is the first
+        voice to be cut if the bank is full.
+        """
+        slot = voice.slot
+        if slot is None or slot == PENDING or self.voices[slot] is not voice: return
+        self.release_t[:, slot] = self.fade_frames / self.framerate
+        self.note_off(voice)
+        self.stopping[slot] = True
+
+    def filter_envelope(self):
+        """
+        Filter envelope of a new voice, from the settings of the output, or None if its amount is 0.
+        """
+        settings = dict(self.output.filter_envelope)
+        if not settings.pop("amount"): return None
+        envelope = ControlEnvelope(framerate=self.framerate, **settings)
+        envelope.gate(True)
+        return envelope
+
+    def voice_level(self, voice) -> float:
+        """
+        Current envelope amplitude of the loudest carrier of a voice, 0 if the voice is not in the bank.
+        """
+        if voice.slot is None or voice.slot == PENDING: return 0.0
+        return float((self.level[self.carriers, voice.slot] * self.amplitude[self.carriers, voice.slot]).max())
+
+    def schedule(self, frame: int, voice: Voice, on: bool = True):
+        """
+        Schedule a note-on (or note-off) of a voice at a frame of the bank's clock.
+        Can be called from another thread than the audio thread: the event is only queued.
+        """
+        if on: voice.slot = PENDING
+        self.events.append((frame, self.note_on if on else self.note_off, voice))
+
+    def schedule_stop(self, frame: int, voice: Voice):
+        """
+        Schedule the stop of a voice (see stop) at a frame of the bank's clock.
+        """
+        self.events.append((frame, self.stop, voice))
+
+    def schedule_bend(self, frame: int, ratio: float):
+        """
+        Schedule a pitch bend, as a frequency ratio applied to all voices (except fixed frequency oscillators).
+        """
+        self.events.append((frame, self.set_bend, ratio))
+
+    def set_bend(self, ratio: float):
+        self.pitch.set_bend(ratio)
+
+    def apply_events(self, frame: int):
+        """
+        Apply the scheduled events up to a frame.
+        """
+        while self.scheduled and self.scheduled[0][0] <= frame:
+            _, _, function, argument = heapq.heappop(self.scheduled)
+            function(argument)
+
+    def envelopes(self, slots: np.ndarray, frames: int) -> np.ndarray:
+        """
+        Vectorised ADSR envelopes, of shape (oscillators, voices, frames).
+        Each segment is computed in closed form, y(x) = c + (y(0) - c) * m^x (see ADSREnvelope), for all
+        envelopes at once. Envelopes which cross their threshold within the block switch state at that sample,
+        and the next segment is computed from there on the following pass.
+        """
+        stage = self.stage[:, slots]
+        level = self.level[:, slots]
+        if np.isin(stage, (SUSTAIN, IDLE)).all():
+            level = np.where(stage == SUSTAIN, self.sustain_level[:, slots], 0.0)
+            self.level[:, slots] = level
+            return np.broadcast_to(level.astype(np.float32)[..., None], stage.shape + (frames,))
+        max_amp = self.max_amp[:, slots]
+        sustain_level = self.sustain_level[:, slots]
+        attack_t, decay_t, release_t = self.attack_t[:, slots], self.decay_t[:, slots], self.release_t[:, slots]
+        multipliers = np.stack([self.attack_multiplier[:, slots], self.decay_multiplier[:, slots], self.release_multiplier[:, slots]])
+        asymptotes = np.stack([self.attack_asymptote[:, slots], self.decay_asymptote[:, slots], - self.dr_target[:, slots]])
+        thresholds = np.stack([max_amp, sustain_level, np.zeros_like(level)])
+        next_stages = np.array([DECAY, SUSTAIN, IDLE])
+
+        index = ramp(frames)
+        amps = np.zeros(stage.shape + (frames,), dtype=np.float32)
+        start = np.zeros(stage.shape, dtype=np.int64)
+        while True:
+            skip = (stage == ATTACK) & (attack_t == 0.0)
+            level[skip], stage[skip] = max_amp[skip], DECAY
+            skip = (stage == DECAY) & (decay_t == 0.0)
+            level[skip], stage[skip] = sustain_level[skip], SUSTAIN
+            skip = (stage == RELEASE) & ((release_t == 0.0) | (level <= 0.0))
+            level[skip], stage[skip] = 0.0, IDLE
+
+            pending = start < frames
+            sustaining = pending & (stage == SUSTAIN)
+            amps[sustaining] = np.where(index >= start[sustaining][:, None], sustain_level[sustaining][:, None], amps[sustaining])
+            level[sustaining] = sustain_level[sustaining]
+            idle = pending & (stage == IDLE)
+            level[idle] = 0.0
+            start[sustaining | idle] = frames
+
+            moving = pending & ~sustaining & ~idle
+            if not moving.any(): break
+            segment_type = np.clip(stage - ATTACK, 0, 2)
+            multiplier = np.take_along_axis(multipliers, segment_type[None], 0)[0]
+            asymptote = np.take_along_axis(asymptotes, segment_type[None], 0)[0]
+            threshold = np.take_along_axis(thresholds, segment_type[None], 0)[0]
+
+            exponent = index - start[..., None]
+            in_segment = exponent >= 0
+            segment = asymptote[..., None] + (level - asymptote)[..., None] * np.power(multiplier[..., None], np.maximum(exponent, 0))
+            crossed = in_segment & np.where((stage == ATTACK)[..., None], segment >= threshold[..., None], segment <= threshold[..., None])
+            has_crossed = moving & crossed.any(axis=-1)
+            end = np.where(has_crossed, np.argmax(crossed, axis=-1), frames)
+            write = moving[..., None] & in_segment & (index < end[..., None])
+            amps[write] = segment[write]
+
+            end_level = asymptote + (level - asymptote) * np.power(multiplier, frames - start)
+            level = np.where(has_crossed, threshold, np.where(moving, end_level, level))
+            stage = np.where(has_crossed, next_stages[segment_type], stage)
+            start = np.where(moving, end, start)
+
+        self.stage[:, slots] = stage
+        self.level[:, slots] = level
+        return amps
+
+    def render(self, frames: int, out: np.ndarray):
+        """
+        Render a block, split at the frames of the scheduled events.
+        """
+        while self.events:
+            frame, function, argument = self.events.popleft()
+            heapq.heappush(self.scheduled, (frame, self.event_count, function, argument))
+            self.event_count += 1
+        position = 0
+        while position < frames:
+            self.apply_events(self.frame + position)
+            end = frames
+            if self.scheduled: end = min(end, self.scheduled[0][0] - self.frame)
+            self.position = position
+            self.render_block(end - position, out[position:end])
+            position = end
+        self.frame += frames
+
+    def pitch_ratios(self, slots: np.ndarray, frames: int, pitch: np.ndarray = None) -> np.ndarray:
+        """
+        Per-frame frequency ratios of the voices in the given slots, of shape (voices, frames), from the pitch
+        offsets shared by all voices (pitch bend and vibrato) and the glides of the voices.
+        None if the pitch of all the voices is constant over the block.
+        """
+        gliding = (self.glide_octaves[slots] != 0.0) & (self.glide_elapsed[slots] < self.glide_frames[slots])
+        self.glide_elapsed[slots] += frames
+        if pitch is None and not gliding.any(): return None
+        octaves = np.zeros((len(slots), frames)) if pitch is None else np.tile(pitch, (len(slots), 1))
+        if gliding.any():
+            glides = slots[gliding]
+            octaves[gliding] += PitchModulation.glide(self.glide_octaves[glides], self.glide_elapsed[glides] - frames,
+                                                      self.glide_frames[glides], frames)
+        return np.exp2(octaves)
+
+    def parameter_ramp(self, target, name: str, frames: int):
+        """
+        Values of a modulated parameter over the part of the block being rendered, or None (see parameter_ramp).
+        """
+        return parameter_ramp(self.output, target, name, frames, self.position)
+
+    def oscillator_increments(self, slots: np.ndarray, frames: int) -> np.ndarray:
+        """
+        Phase increments of the oscillators of the voices in the given slots, of shape (oscillators, voices, 1),
+        or (oscillators, voices, frames) if the frequency ratio of an oscillator which follows the note, or the
+        frequency of a fixed frequency oscillator, is modulated.
+        """
+        increments = (self.frequency[:, slots] / self.framerate)[..., None]
+        for node, oscillator in enumerate(self.oscillators):
+            ratios = self.parameter_ramp(oscillator, "frequency_ratio", frames)
+            frequencies = self.parameter_ramp(oscillator, "frequency", frames)
+            if ratios is None and frequencies is None: continue
+            if increments.shape[-1] == 1: increments = np.repeat(increments, frames, axis=-1)
+            bendable = self.bendable[node, slots]
+            if ratios is not None:
+                increments[node, bendable] = self.note_frequency[slots[bendable], None] * ratios / self.framerate
+            if frequencies is not None:
+                increments[node, ~bendable] = frequencies / self.framerate
+        return increments
+
+    def modulate_envelopes(self, slots: np.ndarray, frames: int) -> dict:
+        """
+        Take the modulated envelope settings of the oscillators at the start of the block, for all the voices,
+        and recompute the multipliers and asymptotes of their attack and decay segments (see ADSREnvelope).
+        A modulated release time is taken when a voice is released (see note_off). Returns the ramps of the
+        modulated sustain levels over the block, by oscillator.
+        """
+        sustains = {}
+        for node, oscillator in enumerate(self.oscillators):
+            settings = {}
+            for name in ADSREnvelope.envelope_settings:
+                values = self.parameter_ramp(oscillator.envelope, name, frames)
+                if values is not None: settings[name] = values
+            if not settings: continue
+            for name, times in (("attack", self.attack_t), ("decay", self.decay_t), ("release", self.release_t)):
+                if name in settings: times[node, slots] = max(settings[name][0], 0.0)
+            if "sustain" in settings:
+                sustains[node] = np.clip(settings["sustain"], 0.0, 1.0) * self.max_amp[node, slots, None]
+                self.sustain_level[node, slots] = sustains[node][:, 0]
+            if settings.keys() - {"release"}:
+                self.set_multipliers(node, slots)
+        return sustains
+
+    def set_multipliers(self, node: int, slots: np.ndarray):
+        """
+        Multipliers and asymptote of the attack and decay segments of an oscillator of the voices in the given
+        slots, from their times and sustain levels, as in ADSREnvelope.set_multipliers.
+        """
+        max_amp, sustain_level = self.max_amp[node, slots], self.sustain_level[node, slots]
+        attack_t, decay_t, dr_target = self.attack_t[node, slots], self.decay_t[node, slots], self.dr_target[node, slots]
+        a_target = self.attack_asymptote[node, slots] - max_amp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            attack = np.exp((1.0 / (attack_t * self.framerate)) * np.log(a_target / (max_amp + a_target)))
+            decay = np.exp((1.0 / (decay_t * self.framerate)) * np.log(dr_target / (max_amp - sustain_level + dr_target)))
+        self.attack_multiplier[node, slots] = np.where(attack_t != 0.0, attack, 0.0)
+        self.decay_multiplier[node, slots] = np.where(decay_t != 0.0, decay, 0.0)
+        self.decay_asymptote[node, slots] = sustain_level - dr_target
+
+    def render_block(self, frames: int, out: np.ndarray):
+        out.fill(0.0)
+        tremolo = self.lfo.advance(frames, self.position)
+        pitch = self.pitch.advance(frames, self.position)
+        slots = np.flatnonzero(self.active)
+        if len(slots) == 0: return
+        oscillators = self.oscillators
+
+        # The phases are accumulated from block to block in double precision and wrapped,
+        # the phases within a block and the signals are computed in single precision
+        increments = self.oscillator_increments(slots, frames)
+        phase = self.phase[:, slots]
+        ratios = self.pitch_ratios(slots, frames, pitch)
+        if ratios is None and increments.shape[-1] == 1:
+            increments = increments[..., 0]
+            self.phase[:, slots] = (phase + increments * frames) % 1.0
+            phases = phase.astype(np.float32)[..., None] + increments.astype(np.float32)[..., None] * ramp(frames, np.float32)
+            increments = increments[..., None]
+        else:
+            # Pitch bend, glide, vibrato and frequency modulation: one increment per frame, integrated with a
+            # cumulative sum
+            if ratios is not None: increments = np.where(self.bendable[:, slots, None], increments * ratios, increments)
+            cumulative = np.cumsum(increments, axis=-1)
+            self.phase[:, slots] = (phase + cumulative[..., -1]) % 1.0
+            phases = ((phase[..., None] + cumulative - increments) % 1.0).astype(np.float32)
+
+        # Unit envelopes, which sustain at the modulated sustain levels, scaled by the (modulated) amplitudes
+        sustains = self.modulate_envelopes(slots, frames)
+        sustaining = self.stage[:, slots] == SUSTAIN
+        envelopes = self.envelopes(slots, frames)
+        if sustains:
+            envelopes = np.array(envelopes)
+            for node, sustain in sustains.items():
+                rows = sustaining[node] & (self.stage[node, slots] == SUSTAIN)
+                envelopes[node, rows] = sustain[rows]
+                self.sustain_level[node, slots[rows]] = self.level[node, slots[rows]] = sustain[rows, -1]
+        amps = envelopes * self.amplitude[:, slots, None].astype(np.float32)
+        for node, oscillator in enumerate(oscillators):
+            amplitude = self.parameter_ramp(oscillator, "amplitude", frames)
+            if amplitude is not None: np.multiply(envelopes[node], amplitude.astype(np.float32), out=amps[node])
+
+        # FM: modulators are evaluated before the oscillators they modulate
+        signals = {}
+        for node, parents, silent in self.plan.steps:
+            if silent:
+                signals[node] = np.zeros(phases[node].shape, dtype=np.float32)
+            elif parents:
+                signal = np.multiply(phases[node], np.float32(2.0 * np.pi))
+                for parent in parents:
+                    if len(parents) > 1: signal += signals[parent] / len(parents)
+                    else: signal += signals[parent]
+                np.cos(signal, out=signal)
+                signal *= amps[node]
+                signals[node] = signal
+            else:
+                parameters = {}
+                for name in oscillators[node].waveform_parameters:
+                    values = self.parameter_ramp(oscillators[node], name, frames)
+                    if values is not None: parameters[name] = values
+                signal = oscillators[node].waveform(phases[node], increments[node], **parameters).astype(np.float32, copy=False)
+                signal *= amps[node]
+                signals[node] = signal
+        if self.carriers: voices = sum(signals[c] for c in self.carriers)
+        else: voices = np.zeros((len(slots), frames), dtype=np.float32)
+        if len(self.carriers) > 1: voices /= len(self.carriers)
+
+        # Tremolo, from the LFO shared by all voices, which runs on the clock of the bank
+        if tremolo is not None: voices *= tremolo
+
+        # Pass filter, with one filter state per voice
+        output = self.output
+        filter_type = "low" if output.filter_type == "lowpass" else "high"
+        if output.filter_engine == "svf":
+            cutoff = self.parameter_ramp(output, "filter_cutoff", frames)
+            resonance = self.parameter_ramp(output, "filter_resonance", frames)
+            if cutoff is None: cutoff = output.filter_cutoff
+            if resonance is None: resonance = output.filter_resonance
+            cutoffs = self.svf.cutoffs(slots, frames, cutoff, output.filter_keytrack, output.filter_envelope["amount"])
+            voices = self.svf.filter(voices, slots, cutoffs, resonance, filter_type)
+        else:
+            if self.pass_filter.sos != output.filter_sos:
+                self.pass_filter = PassFilterBank(self.capacity, sos=output.filter_sos)
+            # A modulated cutoff is taken once per block, on a grid of the cached designs (see PassFilter)
+            cutoff = PassFilter.block_cutoff(output, output.filter_cutoff, frames, self.position, self.framerate)
+            voices = self.pass_filter.filter(voices, slots, cutoff, filter_type)
+
+        # Fade in new voices to avoid popping sounds
+        fading = self.faded_frames[slots] < self.fade_frames
+        if fading.any():
+            fade = (self.faded_frames[slots][fading, None] + ramp(frames)) / self.fade_frames
+            voices[fading] *= np.minimum(fade, 1.0)
+        self.faded_frames[slots] += frames
+
+        # Amplitude of each voice, e.g from the velocity of its note
+        amplitude = self.voice_amplitude[slots]
+        if (amplitude != 1.0).any(): voices *= amplitude[:, None]
+
+        out += voices.sum(axis=0)
+        self.free_finished(slots)
+
+    def free_finished(self, slots: np.ndarray):
+        """
+        Free the slots of the voices whose carriers are all idle, i.e whose release is over.
+        """
+        finished = (self.stage[self.carriers][:, slots] == IDLE).all(axis=0)
+        for slot in slots[finished]:
+            self.active[slot] = False
+            self.voices[slot].slot = None
+            self.voices[slot] = None
+
+    def data(self):
+        while True:
+            out = np.zeros(blocksize, dtype=np.float32)
+            self.render(blocksize, out)
+            yield out
@@ -2,10 +2,20 @@ from abc import ABC, abstractmethod
 from typing import Generator, Optional, List
 import numpy as np
 import random
-import sounddevice as sd
+from functools import lru_cache
 from pysynth.params import blocksize, framerate
 
 
+@lru_cache(maxsize=8)
+def ramp(frames: int, dtype=np.float64) -> np.ndarray:
+    """
+    Cached sample indices [0, 1, ..., frames - 1], shared by all phase accumulators.
+    """
+    indices = np.arange(frames, dtype=dtype)
+    indices.flags.writeable = False
+    return indices
+
+
 class Oscillator(ABC):
     """
     Abstract oscillator class.
@@ -17,8 +27,17 @@ class Oscillator(ABC):
     def data(self) -> Generator[List[float], None, None]:
         pass
 
+    @abstractmethod
+    def render(self, frames: int, out: np.ndarray):
+        """
+        Write the next block of frames into out, a preallocated float32 array.
+        """
+        pass
+
 
 class BaseOscillator(Oscillator):
+    # Attributes of the waveform which can be passed to waveform() as ramps, e.g when they are modulated
+    waveform_parameters = ()
 
     def __init__(self, frequency, amplitude, framerate, name):
         super().__init__(framerate)
@@ -29,6 +48,9 @@ class BaseOscillator(Oscillator):
         self.to_oscillators = []        
         self.fixed_frequency = False
         self.frequency_ratio = 1.0
+        self.phase = 0.0
+        self.increment = 0.0
+        self.pitch = None
         self.envelope = {
             "attack": 0.0,
             "decay": 0.0,
@@ -45,18 +67,71 @@ class BaseOscillator(Oscillator):
         self.amplitude = 0.0
         self.disabled = True
 
+    @staticmethod
+    def phase_block(phase: float, increment: float, frames: int = blocksize):
+        """
+        Phase accumulator. Phases are normalised (expressed in cycles), so that the phase of a whole
+        block can be computed in a single array operation: phase + increment * [0, 1, ..., frames - 1].
+        The returned start phase for the next block is wrapped to [0, 1), which keeps the precision of
+        the accumulator constant however long the oscillator has been running (unlike t * frequency).
+
+        The increment can also be an array of one increment per frame, e.g for a frequency which varies over
+        the block: the phases are then integrated with a cumulative sum, and wrapped.
+        """
+        if np.ndim(increment):
+            increments = np.cumsum(increment[:frames], dtype=np.float64)
+            phases = (phase + increments - increment[:frames]) % 1.0
+            return phases, (phase + increments[-1]) % 1.0
+        phases = phase + increment * ramp(frames)
+        return phases, (phase + increment * frames) % 1.0
+
+    def advance(self, frames: int = blocksize, frequency=None) -> np.ndarray:
+        """
+        Returns the normalised phases of the next block of frames, and advances the oscillator phase.
+        The frequency is self.frequency, or a per-frame frequency array, and is multiplied by self.pitch,
+        the per-frame frequency ratios of the block (pitch bend, glide, vibrato, see PitchFilter), if set.
+        """
+        if frequency is None: frequency = self.frequency
+        if self.pitch is not None: frequency = frequency * self.pitch[:frames]
+        self.increment = frequency / self.framerate
+        phases, self.phase = self.phase_block(self.phase, self.increment, frames)
+        return phases
+
+    @abstractmethod
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        """
+        Unit amplitude waveform evaluated on an array of normalised phases. The phase increments (scalar,
+        or broadcastable to the phases) are used by band-limited waveforms (see PolyBlepOscillator): without
+        them, the naive waveform is returned, e.g for LFOs.
+        """
+        pass
+
+    def render(self, frames: int, out: np.ndarray, modulate: bool = False, frequency=None):
+        """
+        Block equivalent of data(single_samples=False): writes the waveform scaled by the oscillator amplitude,
+        or the phases in radians if modulate is set. The frequency can be given per frame (see advance).
+        """
+        phases = self.advance(frames, frequency)
+        if modulate: np.multiply(phases, 2.0 * np.pi, out=out)
+        else: np.multiply(self.waveform(phases, self.increment), self.amplitude, out=out)
+
 
 class SineWave(BaseOscillator):
     """
     Pure sine wave oscillator.
     Modulate flag in blocks() allows for FM modulation.
+    With single_samples=False, whole blocks are rendered at once from the phase accumulator.
     """
     def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = ""):
         super().__init__(frequency, amplitude, framerate, name)
 
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        return np.sin(2.0 * np.pi * phase)
+
     def data(self, modulate=False, single_samples=True) -> Generator[List[float], None, None]:
         increment = 2.0 * np.pi / self.framerate
         t = 0.0
+        phase = 0.0
         frequency = self.frequency
         while True:
             if single_samples:
@@ -65,35 +140,152 @@ class SineWave(BaseOscillator):
                 else: yield np.sin(t * frequency)
                 t += increment
             else:
-                block = []
-                for _ in range(blocksize):
-                    if modulate:
-                        block.append(t * frequency)
-                    else: block.append(self.amplitude * np.sin(t * frequency))
-                    t += increment
-                yield block
+                phases, phase = self.phase_block(phase, frequency / self.framerate)
+                if modulate:
+                    yield 2.0 * np.pi * phases
+                else: yield self.amplitude * self.waveform(phases)
+
+
+class PolyBlepOscillator(BaseOscillator):
+    """
+    Base class of the band-limited oscillators. The naive waveforms have discontinuities (square, saw, pulse)
+    or corners (triangle), whose harmonics extend above the Nyquist frequency and alias back into the audible
+    band. PolyBLEP (polynomial band-limited step) corrects the samples on either side of each discontinuity
+    with a polynomial residual, and PolyBLAMP (band-limited ramp, its integral) does the same for corners.
+    The residuals only depend on the distance of a sample to the discontinuity, in samples, i.e on its phase
+    and the phase increment: they are computed for a whole block at once.
+    """
+    @staticmethod
+    def distances(t: np.ndarray, dt):
+        """
+        Samples within dt of a discontinuity at phase 0, given their phases t and increments dt: the masks of the
+        samples after it and before it, and their distances to it, in samples, in [0, 1) and [-1, 0).
+        """
+        shape = np.broadcast_shapes(np.shape(t), np.shape(dt))
+        t = np.broadcast_to(t, shape)
+        after, before = t < dt, t > 1.0 - dt
+        if np.ndim(dt):
+            dt = np.broadcast_to(dt, shape)
+            return after, t[after] / dt[after], before, (t[before] - 1.0) / dt[before]
+        return after, t[after] / dt, before, (t[before] - 1.0) / dt
+
+    @staticmethod
+    def poly_blep(t: np.ndarray, dt) -> np.ndarray:
+        """
+        Residual of a unit step (from -1 to 1 for a discontinuity at phase 0) at phases t, for increments dt.
+        The residual is 0 beyond one sample of the discontinuity, and is only evaluated within it (see distances).
+        """
+        after, x, before, y = PolyBlepOscillator.distances(t, dt)
+        residual = np.zeros(after.shape)
+        residual[after] = 2.0 * x - x * x - 1.0
+        residual[before] = y * y + 2.0 * y + 1.0
+        return residual
+
+    @staticmethod
+    def poly_blamp(t: np.ndarray, dt) -> np.ndarray:
+        """
+        Residual of a change of slope of 2 per sample (the integral of poly_blep) at phase 0, at phases t,
+        for increments dt.
+        """
+        after, x, before, y = PolyBlepOscillator.distances(t, dt)
+        residual = np.zeros(after.shape)
+        x, y = x - 1.0, y + 1.0
+        residual[after] = -x * x * x / 3.0
+        residual[before] = y * y * y / 3.0
+        return residual
+
+    @staticmethod
+    def increments(increment):
+        """
+        Absolute phase increments, limited so that the residuals on either side of a discontinuity do not overlap.
+        """
+        return np.clip(np.abs(increment), 1e-9, 0.5)
+
+    def data(self, modulate=False) -> Generator[List[float], None, None]:
+        while True:
+            out = np.zeros(blocksize, dtype=np.float32)
+            self.render(blocksize, out, modulate=modulate)
+            yield out
 
 
-class SquareWave(BaseOscillator):
+class SquareWave(PolyBlepOscillator):
     """
-    Pure square wave oscillator.
+    Square wave oscillator, band-limited with PolyBLEP when rendered at audio rate.
     """
     def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = ""):
         super().__init__(frequency, amplitude, framerate, name)
 
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        phase = phase % 1.0
+        square = np.where(phase < 0.5, 1.0, -1.0)
+        if increment is None: return square
+        dt = self.increments(increment)
+        return square + self.poly_blep(phase, dt) - self.poly_blep((phase + 0.5) % 1.0, dt)
+
     def data(self, modulate=False, single_samples=True) -> Generator[List[float], None, None]:
         increment = 1.0 / self.framerate
         t = 0.0
+        phase = 0.0
         while True:
             if single_samples:
                 yield self.amplitude if int(2*t*self.frequency) % 2 == 0 else -self.amplitude
                 t += increment
             else:
-                block = []
-                for _ in range(blocksize):
-                    block.append(self.amplitude if int(2*t*self.frequency) % 2 == 0 else -self.amplitude)
-                    t += increment
-                yield block
+                phases, phase = self.phase_block(phase, self.frequency / self.framerate)
+                yield self.amplitude * self.waveform(phases, self.frequency / self.framerate)
+
+
+class SawtoothWave(PolyBlepOscillator):
+    """
+    Rising sawtooth oscillator, band-limited with PolyBLEP.
+    """
+    def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = ""):
+        super().__init__(frequency, amplitude, framerate, name)
+
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        phase = phase % 1.0
+        saw = 2.0 * phase - 1.0
+        if increment is None: return saw
+        return saw - self.poly_blep(phase, self.increments(increment))
+
+
+class TriangleWave(PolyBlepOscillator):
+    """
+    Triangle oscillator, band-limited with PolyBLAMP at its two corners.
+    """
+    def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = ""):
+        super().__init__(frequency, amplitude, framerate, name)
+
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        phase = phase % 1.0
+        triangle = 4.0 * np.abs(phase - 0.5) - 1.0
+        if increment is None: return triangle
+        dt = self.increments(increment)
+        # The slope changes by 8 per cycle, i.e 8 * dt per sample, at each corner
+        return triangle + 4.0 * dt * (self.poly_blamp((phase + 0.5) % 1.0, dt) - self.poly_blamp(phase, dt))
+
+
+class PulseWave(PolyBlepOscillator):
+    """
+    Pulse oscillator with a variable width (duty cycle, in (0, 1), 0.5 for a square wave), band-limited with
+    PolyBLEP. The width is an attribute, which can be modulated (see ModulationMatrix): waveform() then takes
+    an array of one width per frame. The DC offset of the pulse is removed, so that its level does not depend on
+    the width.
+    """
+    waveform_parameters = ("width",)
+
+    def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = "",
+                 width: float = 0.5):
+        super().__init__(frequency, amplitude, framerate, name)
+        self.width = width
+
+    def waveform(self, phase: np.ndarray, increment=None, width=None) -> np.ndarray:
+        phase = phase % 1.0
+        width = np.clip(self.width if width is None else width, 0.01, 0.99)
+        pulse = np.where(phase < width, 1.0, -1.0) - (2.0 * width - 1.0)
+        if increment is None: return pulse
+        dt = self.increments(increment)
+        return pulse + self.poly_blep(phase, dt) - self.poly_blep((phase + 1.0 - width) % 1.0, dt)
 
 
 class WhiteNoise(BaseOscillator):
@@ -103,6 +295,9 @@ class WhiteNoise(BaseOscillator):
     def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = ""):
         super().__init__(frequency, amplitude, framerate, name)
 
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        return np.random.uniform(-1.0, 1.0, np.shape(phase))
+
     def data(self, modulate=False) -> Generator[List[float], None, None]:
         increment = 2.0 * np.pi / self.framerate
         t = 0.0
@@ -114,6 +309,9 @@ class EmptyOscillator(BaseOscillator):
     def __init__(self, frequency: float = 0.0, amplitude: float = 0.1, framerate: int = framerate, name: str = ""):
         super().__init__(frequency, amplitude, framerate, name)
 
+    def waveform(self, phase: np.ndarray, increment=None) -> np.ndarray:
+        return np.zeros(np.shape(phase))
+
     def data(self, modulate=False) -> Generator[List[float], None, None]:
         while True:
             yield 0.0
\ No newline at end of file
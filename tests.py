@@ -35,6 +35,451 @@ def low_pass_filter(duration):
     audio_interface.play(filtered_sound)
     time.sleep(duration)
 
+### Benchmarks
+
+def waveform_benchmark(blocks=20, tolerance=1e-6):
+    """
+    Compare per-sample rendering with block rendering for a single voice, and check that they match within
+    tolerance. Block rendering of the square wave is band-limited (see PolyBlepOscillator), unlike the naive
+    per-sample square: they only match away from the edges, as the samples within a phase increment of an edge
+    are corrected by the PolyBLEP residual.
+    """
+    for waveform in (SineWave, SquareWave):
+        osc = waveform(440, amplitude=1.0)
+        samples = osc.data()
+        start = time.perf_counter()
+        per_sample = [[next(samples) for _ in range(blocksize)] for _ in range(blocks)]
+        sample_time = time.perf_counter() - start
+        block_gen = osc.data(single_samples=False)
+        start = time.perf_counter()
+        per_block = [next(block_gen) for _ in range(blocks)]
+        block_time = time.perf_counter() - start
+        error = np.abs(np.ravel(per_sample) - np.ravel(per_block))
+        increment = osc.frequency / osc.framerate
+        phases = (np.arange(len(error)) * increment) % 0.5
+        edges = np.minimum(phases, 0.5 - phases) <= increment if waveform is SquareWave else np.zeros(len(error), bool)
+        assert (error[~edges] < tolerance).all(), f'{waveform.__name__}: {error[~edges].max()}'
+        print(f'{waveform.__name__}: {1000 * sample_time / blocks:.3f} ms/block per sample, '
+              f'{1000 * block_time / blocks:.3f} ms/block vectorised ({sample_time / block_time:.0f}x), '
+              f'{np.count_nonzero(error > tolerance)} samples differ, all within an increment of an edge')
+
+
+def voices_benchmark(voices=32, blocks=10, algorithm="parallel"):
+    """
+    Time to render a block of `voices` simultaneous notes, with one filter pipeline per voice
+    and with the batched VoiceBank, compared with the real time budget of a block. Check that both render the
+    same signal, within the rounding of single precision: the VoiceBank computes the phases within a block in
+    single precision, so each of the signals of the voices and their 4 oscillators may be off by a float32
+    epsilon of its phase, in radians, and of the peak of the mix.
+    """
+    from pysynth.output import Output
+    rendered = {}
+    for batched in (False, True):
+        output = Output(batched=batched, backend="null")
+        output.stop()
+        for n in range(4):
+            osc = SineWave(name=str(n))
+            osc.frequency_ratio = n + 1
+            output.add_oscillator(osc, n)
+        output.choose_algorithm(algorithm)
+        output.max_voices = voices
+        for n in range(voices):
+            output.note_on(110.0 + 10 * n)
+        out = np.zeros((blocks, blocksize), dtype=np.float32)
+        start = time.perf_counter()
+        for block in out:
+            output.final_output.render(blocksize, block)
+        block_time = (time.perf_counter() - start) / blocks
+        rendered[batched] = out
+        print(f'{"batched" if batched else "per voice"}: {1000 * block_time:.2f} ms/block for {voices} voices '
+              f'({1000 * blocksize / framerate:.2f} ms budget)')
+    error = np.abs(rendered[True] - rendered[False]).max()
+    phase = 2 * np.pi * (1.0 + 4 * (110.0 + 10 * (voices - 1)) * blocksize / framerate)
+    tolerance = 4 * voices * np.finfo(np.float32).eps * (np.abs(rendered[False]).max() + 0.1 * phase)
+    assert error <= tolerance, f'batched and per voice outputs differ by {error}'
+    print(f'batched and per voice outputs match within {error:.2e} ({tolerance:.2e} allowed)')
+
+
+def allocator_benchmark(events=100000, capacity=16, keys=24):
+    """
+    Dense MIDI input: random note-ons and note-offs over a small range of keys, with many repeated notes,
+    through the VoiceAllocator with each stealing policy.
+    """
+    import random
+    from pysynth.allocator import VoiceAllocator
+    random.seed(0)
+    messages = [(random.random() < 0.6, random.randrange(keys)) for _ in range(events)]
+    for policy in VoiceAllocator.policies:
+        levels = {}
+        allocator = VoiceAllocator(capacity, policy, level=lambda voice: levels[voice],
+                                   finished=lambda voice: levels[voice] < 0.01)
+        steals = 0
+        start = time.perf_counter()
+        for n, (on, key) in enumerate(messages):
+            if on:
+                levels[n] = random.random()
+                slot, released, stolen = allocator.note_on(key, n)
+                steals += stolen is not None
+                assert allocator.notes[key] == n and stolen not in allocator, (policy, n, stolen)
+            else:
+                allocator.note_off(key)
+        elapsed = time.perf_counter() - start
+        print(f'{policy}: {1e6 * elapsed / events:.2f} us/event, {steals} voices stolen by note-ons')
+
+
+def allocator_policy_check():
+    """
+    Take all the slots of a VoiceAllocator with 4 notes of known levels, release two of them, and check the voice
+    which each stealing policy steals for a new note: the first started voice, the quietest voice, and the first
+    started of the released voices.
+    """
+    from pysynth.allocator import VoiceAllocator
+    levels = [0.5, 0.6, 0.9, 0.2]
+    expected = {"oldest": 0, "quietest": 3, "releasing": 1}
+    for policy in VoiceAllocator.policies:
+        allocator = VoiceAllocator(4, policy, level=lambda voice: levels[voice])
+        for key in range(4):
+            allocator.note_on(key, key)
+        allocator.note_off(2)
+        allocator.note_off(1)
+        slot, released, stolen = allocator.note_on(4, 4)
+        assert stolen == expected[policy] and released == [], (policy, stolen)
+        assert sorted(allocator.voices()) == sorted({0, 1, 2, 3, 4} - {stolen}), (policy, allocator.voices())
+        print(f'{policy}: stole voice {stolen}')
+    allocator = VoiceAllocator(2, "releasing")
+    allocator.note_on(0, 0)
+    allocator.note_on(1, 1)
+    assert allocator.note_on(2, 2)[2] == 0, 'releasing should steal the oldest voice when all notes are held'
+
+
+def allocator_restrike_check(capacity=4):
+    """
+    Re-strike a held key while all the slots of the VoiceAllocator are taken, with each stealing policy:
+    the voice which the key releases keeps its slot and rings out, another voice is stolen.
+    """
+    from pysynth.allocator import VoiceAllocator
+    for policy in VoiceAllocator.policies:
+        allocator = VoiceAllocator(capacity, policy, level=lambda voice: voice[1])
+        # The re-struck key is the oldest and the quietest voice
+        voices = [(key, 0.1 + key) for key in range(capacity)]
+        for key, voice in enumerate(voices):
+            allocator.note_on(key, voice)
+        slot, released, stolen = allocator.note_on(0, (0, 1.0))
+        assert voices[0] in allocator and released == [voices[0]], (policy, allocator.voices())
+        assert stolen is not None and stolen not in allocator, (policy, stolen)
+        print(f'{policy}: re-struck key released {released[0]}, stole {stolen}')
+    allocator = VoiceAllocator(1)
+    allocator.note_on(0, "first")
+    assert allocator.note_on(0, "second") == (0, ["first"], "first") and allocator.voices() == ["second"]
+
+
+def event_timing_check(frame=1000, length=3000):
+    """
+    Schedule a note at a frame inside a block of a VoiceBank, and the same note at frame 0 of another bank:
+    the first bank is silent until the frame of the note-on, and from there renders the same signal as the second,
+    including the release from the frame of the note-off.
+    """
+    from pysynth.output import Output
+    rendered = []
+    for start in (frame, 0):
+        output = Output(backend="null")
+        output.stop()
+        for n in range(4):
+            osc = SineWave(name=str(n))
+            osc.frequency_ratio = n + 1
+            osc.envelope.update(attack=0.01, release=0.02)
+            output.add_oscillator(osc, n)
+        output.choose_algorithm("parallel")
+        clock = output.final_output.frame
+        output.start_note(440.0, clock + start)
+        output.end_note(440.0, clock + start + length)
+        out = np.zeros(3 * blocksize, dtype=np.float32)
+        for block in out.reshape(-1, blocksize):
+            output.final_output.render(blocksize, block)
+        rendered.append(out)
+    delayed, reference = rendered
+    assert not delayed[:frame + 1].any(), f'output before the note-on at frame {frame}'
+    assert np.abs(reference[1:4]).min() > 0, 'no output after the note-on'
+    error = np.abs(delayed[frame:] - reference[:len(reference) - frame]).max()
+    # The blocks are split at different frames, so the single precision phases are rounded differently
+    tolerance = 4 * np.finfo(np.float32).eps * 0.1 * 2 * np.pi * (1.0 + 4 * 440.0 * blocksize / framerate)
+    assert error < tolerance, f'note scheduled at frame {frame} differs by {error}'
+    print(f'note-on at frame {frame} and note-off at frame {frame + length}: output matches within {error:.2e} '
+          f'({tolerance:.2e} allowed)')
+
+
+def pitch_check(glide_time=0.05, blocks=3):
+    """
+    Render a sine wave whose frequency is given per frame over two blocks, and check it against the sine of the
+    integrated phase increments. Then glide from one note to another in a VoiceBank, and check the phase of the
+    new voice against the sum of its increments, which move linearly in octaves to the note, and stay at the
+    increment of the note once the glide is over.
+    """
+    from pysynth.output import Output
+    frequencies = np.linspace(200.0, 800.0, 2 * blocksize)
+    increments = frequencies / framerate
+    expected = 0.1 * np.sin(2 * np.pi * (np.cumsum(increments) - increments))
+    oscillator = SineWave(amplitude=0.1)
+    out = np.zeros(2 * blocksize, dtype=np.float32)
+    for block, frequency in zip(out.reshape(2, blocksize), frequencies.reshape(2, blocksize)):
+        oscillator.render(blocksize, block, frequency=frequency)
+    assert np.abs(out - expected).max() < 1e-6, np.abs(out - expected).max()
+
+    output = Output(backend="null")
+    output.stop()
+    for n in range(4):
+        output.add_oscillator(SineWave(name=str(n)), n)
+    output.choose_algorithm("parallel")
+    output.glide_time = glide_time
+    bank = output.final_output
+    block = np.zeros(blocksize, dtype=np.float32)
+    output.start_note(220.0, bank.frame)
+    bank.render(blocksize, block)
+    output.start_note(440.0, bank.frame)
+    for _ in range(blocks):
+        bank.render(blocksize, block)
+    slot = output.allocator.notes[440.0].slot
+    length = int(glide_time * framerate)
+    octaves = -1.0 * np.clip(1.0 - np.arange(blocks * blocksize) / length, 0.0, 1.0)
+    phase = np.sum(440.0 * 2.0 ** octaves / framerate) % 1.0
+    error = abs((bank.phase[0, slot] - phase + 0.5) % 1.0 - 0.5)
+    assert error < 1e-9, f'the phase of the gliding voice is off by {error}'
+    bank.render(blocksize, block)
+    step = (bank.phase[0, slot] - phase - 440.0 * blocksize / framerate) % 1.0
+    assert min(step, 1.0 - step) < 1e-9, 'the increment should be the note increment after the glide'
+    print(f'per frame frequency and glide over {length} frames: phases match within {error:.2e} cycles')
+
+
+def midi_file_tempo_check(tempo=250000, division=480):
+    """
+    Read a Standard MIDI File whose tempo is set at tick 0 (faster than the default 120 BPM), with a note of
+    one beat at tick 0, and check that the note lasts one beat at that tempo.
+    """
+    import os
+    import struct
+    import tempfile
+    from pysynth.render import read_midi_file
+    track = (b'\x00\xff\x51\x03' + tempo.to_bytes(3, 'big') + b'\x00\x90\x45\x64'
+             + bytes([0x80 | (division >> 7), division & 0x7F]) + b'\x80\x45\x00' + b'\x00\xff\x2f\x00')
+    data = b'MThd' + struct.pack('>IHHh', 6, 0, 1, division) + b'MTrk' + struct.pack('>I', len(track)) + track
+    with tempfile.NamedTemporaryFile(suffix='.mid', delete=False) as f:
+        f.write(data)
+    try:
+        notes = read_midi_file(f.name)
+    finally:
+        os.remove(f.name)
+    assert len(notes) == 1 and notes[0].start == 0.0, notes
+    assert abs(notes[0].duration - tempo / 1e6) < 1e-9, f'{notes[0].duration}s instead of {tempo / 1e6}s'
+    print(f'tick 0 tempo: one beat lasts {notes[0].duration}s')
+
+
+def parallel_render_check(phrases=10, notes=15, capacity=4, workers=(1, 2, 4)):
+    """
+    Render phrases of random notes, separated by rests, with OfflineRenderer and with ParallelRenderer, with a
+    polyphony limit which makes voices be stolen. Check that the mixes are the same sample for sample, whatever
+    the number of workers, and compare the rendering times. The phrases are the segments which ParallelRenderer
+    spreads over the workers: it can only be faster than OfflineRenderer with several cores.
+    """
+    import os
+    import random
+    from pysynth.patch import Patch
+    from pysynth.render import Note, OfflineRenderer, ParallelRenderer
+    random.seed(0)
+    notes = sorted(Note(2.5 * phrase + random.uniform(0.0, 1.5), random.uniform(0.05, 0.5),
+                        110 * 2 ** (random.randrange(36) / 12), random.randrange(30, 128))
+                   for phrase in range(phrases) for _ in range(notes))
+    patch = Patch.from_dict({"tremolo": {"frequency": 5.0, "sensitivity": 0.5},
+                             "filter": {"cutoff": 2000, "resonance": 2.0, "envelope": {"amount": 2.0}},
+                             "pitch": {"glide": 0.05, "vibrato": {"frequency": 5.0, "depth": 0.5}}})
+    start = time.perf_counter()
+    offline = OfflineRenderer(patch, capacity=capacity).render(notes)
+    print(f'offline: {time.perf_counter() - start:.2f}s')
+    for count in workers:
+        renderer = ParallelRenderer(patch, capacity=capacity, workers=count)
+        start = time.perf_counter()
+        parallel = renderer.render(notes)
+        elapsed = time.perf_counter() - start
+        assert np.array_equal(offline, parallel), f'{count} workers: the mixes differ'
+        print(f'{count} workers ({len(renderer.segments(renderer.get_events(notes)))} segments, '
+              f'{os.cpu_count()} cores): {elapsed:.2f}s')
+
+
+def modulation_ramp_check(period=64, frames=1000, blocks=3, frequency=3.0):
+    """
+    Render blocks of a source which records the ramps of two parameters of the ModulationMatrix: one modulated by
+    a MIDI controller which steps from 0 to 1 between two blocks, the other by an LFO. The step is ramped linearly
+    and reaches its target at the end of the first control period, and the LFO ramp takes the values of the
+    LFO at every control point, including the end of a block which is not a multiple of the period.
+    """
+    from types import SimpleNamespace
+    from pysynth.modulation import ModulationMatrix, ModulationRoute, ControlLFO, MidiControl
+    output = SimpleNamespace(controls={})
+    target = SimpleNamespace(control=0.0, lfo=0.0)
+    matrix = ModulationMatrix(control_period=period)
+    matrix.add(ModulationRoute(target, "control", MidiControl(output, 1)))
+    matrix.add(ModulationRoute(target, "lfo", ControlLFO(frequency)))
+    ramps = []
+    recorder = SimpleNamespace(render=lambda frames, out: ramps.append((matrix.ramp(target, "control"),
+                                                                         matrix.ramp(target, "lfo"))))
+    for block in range(blocks):
+        if block == 1: output.controls[1] = 1.0
+        matrix.render(frames, np.zeros(frames, dtype=np.float32), recorder)
+    control = ramps[1][0]
+    assert not ramps[0][0].any() and (ramps[2][0] == 1.0).all(), 'the controller should be constant between steps'
+    assert np.allclose(control[:period + 1], np.linspace(0.0, 1.0, period + 1)), control[:period + 1]
+    assert (control[period:] == 1.0).all(), 'the controller should reach its value at the first control point'
+    lfo = np.concatenate([lfo for _, lfo in ramps])
+    # The end of a block is the start of the next one
+    points = (np.arange(0, frames, period) + frames * np.arange(blocks)[:, None]).ravel()
+    expected = np.sin(2 * np.pi * frequency * points / framerate)
+    assert np.allclose(lfo[points], expected, atol=1e-9), np.abs(lfo[points] - expected).max()
+    print(f'control period {period}: controller step ramped over {period} frames, LFO exact at the control points')
+
+
+def modulation_benchmark(voices=8, blocks=10, periods=(1, 16, 64, 256), batched=True):
+    """
+    Time to render a block of `voices` notes without modulation, then with the filter cutoff, the tremolo rate,
+    and the amplitude and the sustain level of an oscillator modulated by LFOs, for several control periods
+    (a period of 1 frame is audio rate modulation). The modulated settings are left unchanged.
+    """
+    from pysynth.output import Output
+    from pysynth.modulation import ModulatedFilter, ControlLFO
+    output = Output(batched=batched, backend="null")
+    output.stop()
+    for n in range(4):
+        output.add_oscillator(SineWave(name=str(n)), n)
+    output.choose_algorithm("parallel")
+    output.set_am_modulator(SineWave(frequency=5.0, amplitude=0.5))
+    output.max_voices = voices
+    for n in range(voices):
+        output.note_on(110.0 + 10 * n)
+    out = np.zeros(blocksize, dtype=np.float32)
+    source = ModulatedFilter(output.final_output, output.modulation)
+    def block_time():
+        start = time.perf_counter()
+        for _ in range(blocks):
+            source.render(blocksize, out)
+        return (time.perf_counter() - start) / blocks
+    print(f'no modulation: {1000 * block_time():.2f} ms/block ({1000 * blocksize / framerate:.2f} ms budget)')
+    oscillator = output.oscillators[0]
+    settings = (output.filter_cutoff, output.am_modulator.frequency, oscillator.amplitude, oscillator.envelope["sustain"])
+    for period in periods:
+        output.modulation.control_period = period
+        routes = [output.modulate(output, "filter_cutoff", ControlLFO(0.5), depth=2.0, mode="octaves", maximum=20000),
+                  output.modulate(output.am_modulator, "frequency", ControlLFO(0.2), depth=2.0),
+                  output.modulate(oscillator, "amplitude", ControlLFO(3.0), depth=0.5, mode="multiply"),
+                  output.modulate(oscillator.envelope, "sustain", ControlLFO(1.0), depth=-0.5, minimum=0.0)]
+        print(f'control period {period}: {1000 * block_time():.2f} ms/block ({1000 * blocksize / framerate:.2f} ms budget)')
+        for route in routes:
+            output.unmodulate(route)
+        assert np.isfinite(out).all(), f'control period {period}: the output is not finite'
+        assert settings == (output.filter_cutoff, output.am_modulator.frequency, oscillator.amplitude,
+                            oscillator.envelope["sustain"]), 'the modulation changed the settings'
+
+
+def filter_benchmark(voices=16, blocks=10):
+    """
+    Time to filter a block of `voices` voices with the butterworth PassFilterBank at a fixed cutoff, and with
+    the StateVariableFilterBank at a fixed cutoff, then with a cutoff sweep, key tracking and a filter envelope
+    on every voice. Check that the state-variable filter has the frequency response of the bilinear transform
+    at a fixed cutoff, and that the moving cutoff path gives the same output as the fixed cutoff path.
+    """
+    from pysynth.modulation import ControlEnvelope
+    for filter_type in ("low", "high", "band"):
+        svf = StateVariableFilterBank(1)
+        impulse = np.zeros((1, 8192), dtype=np.float32)
+        impulse[0, 0] = 1.0
+        response = svf.filter(impulse, np.zeros(1, dtype=np.int64), np.full((1, 8192), 1000.0), 2.0, filter_type)[0]
+        w, h = StateVariableFilterBank.frequency_response(1000.0, 2.0, filter_type)
+        spectrum = np.exp(-2j * np.pi * np.outer(w, np.arange(len(response))) / framerate) @ response
+        assert np.abs(np.abs(spectrum) - np.abs(h)).max() < 1e-4, f'{filter_type}: frequency response differs'
+    data = np.random.uniform(-1.0, 1.0, (voices, blocksize)).astype(np.float32)
+    slots = np.arange(voices)
+    cutoffs = np.repeat(np.geomspace(200.0, 5000.0, voices)[:, None], blocksize, axis=1)
+    fixed, moving = StateVariableFilterBank(voices), StateVariableFilterBank(voices)
+    for _ in range(2):
+        error = np.abs(fixed.filter_fixed(data, slots, cutoffs[:, 0], np.full(voices, 2.0), "low")
+                       - moving.filter_moving(data, slots, cutoffs, np.full((voices, blocksize), 2.0), "low")).max()
+        assert error < 1e-5 and np.abs(fixed.state - moving.state).max() < 1e-5, f'the paths differ by {error}'
+    butterworth = PassFilterBank(voices)
+    start = time.perf_counter()
+    for _ in range(blocks):
+        butterworth.filter(data, slots, 1000.0, "low")
+    print(f'butterworth: {1000 * (time.perf_counter() - start) / blocks:.2f} ms/block for {voices} voices')
+    svf = StateVariableFilterBank(voices)
+    start = time.perf_counter()
+    for _ in range(blocks):
+        svf.filter(data, slots, svf.cutoffs(slots, blocksize, 1000.0), 2.0, "low")
+    print(f'state-variable, fixed cutoff: {1000 * (time.perf_counter() - start) / blocks:.2f} ms/block '
+          f'for {voices} voices')
+    for slot in slots:
+        envelope = ControlEnvelope(0.01, 0.5, 0.2, 0.2)
+        envelope.gate(True)
+        svf.note_on(slot, 110.0 * (1 + slot), envelope)
+    start = time.perf_counter()
+    for n in range(blocks):
+        cutoffs = svf.cutoffs(slots, blocksize, 200.0 * 2 ** n, keytrack=0.5, envelope_amount=2.0)
+        svf.filter(data, slots, cutoffs, 2.0, "low")
+    print(f'state-variable, moving cutoff: {1000 * (time.perf_counter() - start) / blocks:.2f} ms/block '
+          f'for {voices} voices ({1000 * blocksize / framerate:.2f} ms budget)')
+
+
+def band_limited_benchmark(blocks=100):
+    """
+    Time to render a block with the naive waveforms and with their PolyBLEP/PolyBLAMP versions. Check that the
+    band-limited waveforms only differ from the naive ones within one increment of their discontinuities and corners.
+    """
+    edges = {SineWave: (), SquareWave: (0.0, 0.5), SawtoothWave: (0.0,), TriangleWave: (0.0, 0.5), PulseWave: (0.0, 0.5)}
+    for waveform in (SineWave, SquareWave, SawtoothWave, TriangleWave, PulseWave):
+        osc = waveform(440, amplitude=1.0)
+        out = np.zeros(blocksize, dtype=np.float32)
+        start = time.perf_counter()
+        for _ in range(blocks):
+            phases = osc.advance(blocksize)
+            np.multiply(osc.waveform(phases), osc.amplitude, out=out)
+        naive_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(blocks):
+            osc.render(blocksize, out)
+        block_time = time.perf_counter() - start
+        phases = osc.advance(blocksize) % 1.0
+        distances = np.full(blocksize, np.inf)
+        for edge in edges[waveform]:
+            distances = np.minimum(distances, np.abs((phases - edge + 0.5) % 1.0 - 0.5))
+        far = distances >= osc.increment
+        assert (osc.waveform(phases, osc.increment)[far] == osc.waveform(phases)[far]).all(), waveform.__name__
+        print(f'{waveform.__name__}: {1000 * naive_time / blocks:.3f} ms/block naive, '
+              f'{1000 * block_time / blocks:.3f} ms/block band-limited')
+
+
+def aliasing(waveform, frequency, naive=False, frames=2 ** 15):
+    """
+    Aliasing of an oscillator at a given frequency: the energy of the spectrum outside of the harmonics
+    of the frequency, relative to the energy of the harmonics, in dB.
+    """
+    osc = waveform(frequency, amplitude=1.0)
+    out = np.zeros(frames, dtype=np.float32)
+    if naive: out[:] = osc.waveform(osc.advance(frames))
+    else: osc.render(frames, out)
+    spectrum = np.abs(np.fft.rfft(out * np.blackman(frames))) ** 2
+    frequencies = np.fft.rfftfreq(frames, 1 / framerate)
+    harmonics = np.zeros(len(spectrum), dtype=bool)
+    for n in range(1, int(framerate / 2 / frequency) + 1):
+        harmonics |= np.abs(frequencies - n * frequency) < 6 * framerate / frames
+    return 10 * np.log10(spectrum[~harmonics].sum() / spectrum[harmonics].sum())
+
+
+def aliasing_measurement(frequencies=(440.0, 1760.3, 3520.7)):
+    """
+    Aliasing of the naive and band-limited waveforms (see aliasing), for notes up to A7. The band-limited waveforms
+    should alias at least 10 dB less.
+    """
+    for waveform in (SquareWave, SawtoothWave, TriangleWave, PulseWave):
+        for frequency in frequencies:
+            naive, band_limited = aliasing(waveform, frequency, naive=True), aliasing(waveform, frequency)
+            assert band_limited < naive - 10.0, f'{waveform.__name__} at {frequency} Hz: {band_limited} dB'
+            print(f'{waveform.__name__} at {frequency:.0f} Hz: {naive:.1f} dB naive, {band_limited:.1f} dB band-limited')
+
 
 if __name__ == '__main__':
     global audio_interface